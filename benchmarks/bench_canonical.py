@@ -0,0 +1,128 @@
+# bench_canonical.py
+#
+# Times deduplicating the complexes of a reaction network into species,
+# grouping them into resting sets and resting-set reactions, and looking these
+# up in dicts, once with Complex.canonical_key and once with the former
+# canonical_form (LegacyComplex), which rotated the complex in place and
+# rendered a dot-paren structure for every rotation. LegacyComplex runs on
+# the current Structure, so its rotations are pair-table remaps. As in an
+# enumerated network, every species appears several times, as separate
+# Complex objects with rotated strands. The networks are random: the
+# enumerated case studies have a few dozen complexes, not thousands.
+#
+# Usage: python benchmarks/bench_canonical.py [num_species ...]
+
+import sys
+import time
+import random
+
+from kinda.objects import Domain, Strand, Complex, RestingSet, RestingSetReaction
+
+
+class LegacyComplex(Complex):
+  """ Complex with the former canonical form, equality and hash. """
+  @property
+  def canonical_form(self):
+    if self._canonical_form is not None:
+      return self._canonical_form
+
+    c_domains = [[d.name for d in d_list] for d_list in self.base_domains()]
+    c_strands = self.strands
+    c_structure = self.structure
+
+    for _ in range(len(self.strands)):
+      self.rotate_strands()
+      domains = [[d.name for d in d_list] for d_list in self.base_domains()]
+      if (c_domains > domains or
+          (c_strands == self.strands and
+           c_structure.to_dotparen() > self.structure.to_dotparen())):
+        c_domains = domains
+        c_strands = self.strands
+        c_structure = self.structure
+
+    self._canonical_form = (tuple(c_strands), c_structure)
+    return self._canonical_form
+
+  def __eq__(self, other):
+    return self.canonical_form.__eq__(other.canonical_form)
+
+  def __lt__(self, other):
+    return self.canonical_form.__lt__(other.canonical_form)
+
+  def __hash__(self):
+    return hash(self.canonical_form)
+
+
+def random_dotparen(lengths, rng):
+  """ Returns a random non-pseudoknotted dot-paren structure. """
+  chars, stack = [], []
+  for i in range(sum(lengths)):
+    r = rng.random()
+    if r < 0.3:
+      stack.append(i)
+      chars.append('(')
+    elif r < 0.6 and stack:
+      stack.pop()
+      chars.append(')')
+    else:
+      chars.append('.')
+  for i in stack:
+    chars[i] = '.'
+  strands, start = [], 0
+  for length in lengths:
+    strands.append(''.join(chars[start:start + length]))
+    start += length
+  return '+'.join(strands)
+
+def random_network(num_species, rng, copies = 3):
+  """ Returns a list of (strands, structure, rotation) triples, with copies
+  entries for each of num_species species. """
+  domains = [Domain(name = 'd{}'.format(i), sequence = 'N' * rng.randint(5, 15))
+             for i in range(20)]
+  strands = [Strand(name = 's{}'.format(i), domains = rng.sample(domains, 3))
+             for i in range(40)]
+  species = []
+  for _ in range(num_species):
+    cpx_strands = [rng.choice(strands) for _ in range(rng.randint(1, 4))]
+    structure = random_dotparen([s.length for s in cpx_strands], rng)
+    species.append((cpx_strands, structure))
+  return [(s, structure, rng.randrange(len(s)))
+          for s, structure in species for _ in range(copies)]
+
+def bench_network(network, complex_class, rng):
+  complexes = []
+  for strands, structure, rotation in network:
+    cpx = complex_class(strands = strands, structure = structure)
+    cpx.rotate_strands(rotation)
+    complexes.append(cpx)
+  order = list(range(len(complexes)))
+  rng.shuffle(order)
+
+  t = time.perf_counter()
+  species = set(complexes)
+  restingsets = [RestingSet(complexes = [complexes[i] for i in order[j:j+3]])
+                 for j in range(0, len(order) - 2, 3)]
+  rs_index = {rs: i for i, rs in enumerate(restingsets)}
+  reactions = [RestingSetReaction(reactants = [a], products = [b])
+               for a, b in zip(restingsets, restingsets[1:])]
+  rxn_index = {rxn: i for i, rxn in enumerate(reactions)}
+  found = sum(rs in rs_index for rs in restingsets)
+  found += sum(rxn in rxn_index for rxn in reactions)
+  return time.perf_counter() - t, len(species), found
+
+
+def main(sizes):
+  print(f"{'species':>8} {'complexes':>10} {'legacy s':>10} {'new s':>10} {'speedup':>8}")
+  for size in sizes:
+    network = random_network(size, random.Random(size))
+    legacy_time, legacy_species, legacy_found = bench_network(
+      network, LegacyComplex, random.Random(0))
+    new_time, new_species, new_found = bench_network(
+      network, Complex, random.Random(0))
+    assert new_species <= size and new_found == legacy_found
+    print(f"{size:8d} {len(network):10d} {legacy_time:10.3f} {new_time:10.3f} "
+          f"{legacy_time / new_time:8.1f}")
+
+
+if __name__ == '__main__':
+  main([int(a) for a in sys.argv[1:]] or [300, 1000, 3000])
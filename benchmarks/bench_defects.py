@@ -0,0 +1,147 @@
+# bench_defects.py
+#
+# Times the classification of secondary structures of the resting sets of PIL
+# systems by their maximum domain defect to each resting set conformation (see
+# kinda.objects.utils.max_domain_defect()), per structure: the former
+# nucleotide-by-nucleotide implementation (legacy), the pair-table
+# implementation for one Complex at a time, and the batched version for a
+# stack of pair tables as used by the NUPACK workers. The structures are the
+# resting set conformations with randomly opened base pairs. PIL files are
+# loaded as by the KinDA script, i.e. enumerated with peppercorn unless they
+# give the resting sets and reactions.
+#
+# Usage: python benchmarks/bench_defects.py [pilfile ...] [--structures N]
+
+import sys
+import time
+import random
+
+import numpy as np
+import peppercornenumerator.objects as enumobj
+
+import kinda
+from kinda.objects import utils, Complex
+from kinda.objects.io_KinDA import read_pil
+from kinda.scripts.KinDA import peppercorn
+from kinda.objects.structure import Structure, dotparen_pair_table
+
+
+def legacy_defect(complex, structure):
+  """ The former utils.defect(). """
+  defect = 0
+  for strand_num, strand in enumerate(complex.strands):
+    for i in range(strand.length):
+      if (complex.bound_to(strand_num, i) != structure.bound_to(strand_num, i)
+          and structure.bound_to(strand_num, i) != '?'):
+        defect += 1
+  return defect
+
+def legacy_domain_defect(complex, strand_num, domain_num, structure):
+  """ The former utils.domain_defect(). """
+  strandlist = [lst[:] for lst in structure.to_strandlist()]
+  strands = structure.strands
+  domain_start = sum([d.length for d in strands[strand_num].domains[:domain_num]])
+  domain_end = domain_start + strands[strand_num].domains[domain_num].length
+  n = 0
+  for strand_n, strand_struct in enumerate(strandlist):
+    for i, bound in enumerate(strand_struct):
+      is_domain = (strand_n == strand_num and domain_start <= i < domain_end)
+      is_bound_to_domain = (bound != None and bound != '?'
+                           and bound[0] == strand_num
+                           and domain_start <= bound[1] < domain_end)
+      if not is_domain and not is_bound_to_domain:
+        strandlist[strand_n][i] = '?'
+      else:
+        n += 1
+  new_struct = Structure(structure = strandlist, strands = structure.strands)
+  return legacy_defect(complex, new_struct) / float(n)
+
+def legacy_max_domain_defect(complex, structure):
+  """ The former utils.max_domain_defect(). """
+  max_defect = 0
+  for strand_num, strand_domains in enumerate(complex.base_domains()):
+    for domain_num, domain in enumerate(strand_domains):
+      if domain.length > 0:
+        defect = legacy_domain_defect(complex, strand_num, domain_num, structure)
+        max_defect = max(defect, max_defect)
+  return max_defect
+
+
+def perturbed_structures(restingset, num, rng):
+  """ Returns num dot-paren structures of the resting set's strands, each a
+  conformation of the resting set with some of its base pairs opened. """
+  targets = [c.structure.to_dotparen() for c in restingset.complexes]
+  structures = []
+  for _ in range(num):
+    table = dotparen_pair_table(rng.choice(targets))
+    for i in np.flatnonzero(table > np.arange(len(table))):
+      if rng.random() < 0.1:
+        table[table[i]] = table[i] = -1
+    chars = ['.' if j < 0 else '(' if j > i else ')' for i, j in enumerate(table)]
+    strands, start = [], 0
+    for strand in restingset.complexes[0].strands:
+      strands.append(''.join(chars[start:start + strand.length]))
+      start += strand.length
+    structures.append('+'.join(strands))
+  return structures
+
+
+def load_system(pilpath):
+  """ Reads a PIL file as KinDA.py main() does. """
+  cxs, det, rss, con = read_pil(pilpath, True)
+  if not (det and rss and con):
+    # Systems may reuse domain names of those read before
+    enumobj.clear_memory()
+    cxs, det, rss, con = read_pil(peppercorn(pilpath, True), is_file = False)
+  return kinda.System(cxs, rss, det, con, enumeration = False)
+
+
+def bench_restingset(restingset, num_structures, rng):
+  strands = restingset.complexes[0].strands
+  structures = perturbed_structures(restingset, num_structures, rng)
+  targets = [c.structure for c in restingset.complexes]
+
+  t = time.perf_counter()
+  legacy = [[legacy_max_domain_defect(Complex(strands = strands, structure = s), target)
+             for s in structures] for target in targets]
+  legacy_time = time.perf_counter() - t
+
+  t = time.perf_counter()
+  single = [[utils.max_domain_defect(Complex(strands = strands, structure = s), target)
+             for s in structures] for target in targets]
+  single_time = time.perf_counter() - t
+
+  t = time.perf_counter()
+  pair_tables = np.array([dotparen_pair_table(s) for s in structures])
+  batch = [utils.max_domain_defects(pair_tables, target) for target in targets]
+  batch_time = time.perf_counter() - t
+
+  assert np.allclose(legacy, single) and np.allclose(legacy, batch)
+  return legacy_time, single_time, batch_time
+
+
+def main(pilpaths, num_structures = 200):
+  rng = random.Random(0)
+  print(f"{'resting set':30} {'nt':>5} {'cplx':>5} "
+        f"{'legacy us':>11} {'single us':>11} {'batch us':>10}")
+  for pilpath in pilpaths:
+    system = load_system(pilpath)
+    print(f"# {pilpath}")
+    for restingset in sorted(system.get_restingsets(), key = str):
+      times = bench_restingset(restingset, num_structures, rng)
+      per_struct = [1e6 * t / num_structures for t in times]
+      length = sum(s.length for s in restingset.complexes[0].strands)
+      print(f"{str(restingset)[:30]:30} {length:5d} {len(restingset.complexes):5d} "
+            f"{per_struct[0]:11.1f} {per_struct[1]:11.1f} {per_struct[2]:10.1f}")
+    system.shutdown()
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  num_structures = 200
+  if '--structures' in args:
+    i = args.index('--structures')
+    num_structures = int(args[i + 1])
+    del args[i:i + 2]
+  main(args or ['case_studies/Fig67_Zhang2007/Zhang2007.pil',
+                'case_studies/Fig9_Kotani2017/kotani2017_F2.pil'], num_structures)
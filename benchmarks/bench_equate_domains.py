@@ -0,0 +1,140 @@
+# bench_equate_domains.py
+#
+# Times parsing PIL designs in which each 'equal' directive equates several
+# composite (sup-sequence) domains of the same length, split into sequences
+# in different places. utils.equate_domains() is timed against the former
+# implementation (legacy_equate_domains()), which split and redirected
+# domains while walking pairs of base domains. Both must give every
+# sup-sequence the same sequence constraints; the number of base domains each
+# leaves behind is reported. The designs are generated, as no design in the
+# case studies uses 'equal'.
+#
+# Usage: python benchmarks/bench_equate_domains.py [num_equal ...] [--width N]
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+from kinda.objects import utils, io_PIL
+from kinda.objects.domain import Domain
+
+
+def legacy_split_domain(domain, pos):
+  """ The former utils.split_domain(). """
+  section1 = Domain(name = domain.name + "[:{0}]".format(pos),
+                    sequence = domain.sequence[:pos])
+  section2 = Domain(name = domain.name + "[{0}:]".format(pos + 1),
+                    sequence = domain.sequence[pos:])
+  domain.subdomains = [section1, section2]
+
+def legacy_equate_domains(domains):
+  """ The former utils.equate_domains(). """
+  def update_subdomains_list(subdomains):
+    new_subdomains = []
+    for i, d in enumerate(subdomains):
+      if d.is_composite:
+        new_subdomains.extend(d.subdomains)
+      else:
+        new_subdomains.append(d)
+    return new_subdomains
+  def equate_coincident_domains(domain1, domain2):
+    assert domain1.length == domain2.length
+    new_domain = Domain(name = "~(" + min(domain1.name, domain2.name) + ")",
+                        sequence = domain1.sequence)
+    new_domain.restrict_sequence(domain2.sequence)
+    domain1.subdomains = [new_domain]
+    domain2.subdomains = [new_domain]
+
+  domains = list(domains)
+  index = 1
+  while index < len(domains):
+    domains1 = domains[index-1].base_domains()
+    domains2 = domains[index].base_domains()
+    while len(domains1) != 0:
+      d1 = domains1[0]
+      d2 = domains2[0]
+      if d1.length > d2.length:
+        legacy_split_domain(d1, d2.length)
+        equate_coincident_domains(d1.subdomains[0], d2)
+      elif d2.length > d1.length:
+        legacy_split_domain(d2, d1.length)
+        equate_coincident_domains(d2.subdomains[0], d1)
+      elif d1.complementary_to(d2):
+        assert(d1.length % 2 == 0), "Unable to equate odd-length %s with its complement." % d1
+        legacy_split_domain(d1, d1.length / 2)
+        equate_coincident_domains(d1.subdomains[0], d1.subdomains[1].complement)
+      elif d1 != d2:
+        equate_coincident_domains(d1, d2)
+      domains1 = update_subdomains_list(domains1)[1:]
+      domains2 = update_subdomains_list(domains2)[1:]
+    index+=1
+
+
+def random_partition(total, rng):
+  lengths = []
+  while total > 0:
+    length = min(total, rng.randint(3, 12))
+    lengths.append(length)
+    total -= length
+  return lengths
+
+def random_design(num_equal, width, rng):
+  """ Returns the text of a PIL design with num_equal 'equal' directives, each
+  equating width sup-sequences of 200 to 600 nucleotides. """
+  lines = []
+  for i in range(num_equal):
+    total = rng.randint(200, 600)
+    names = []
+    for j in range(width):
+      parts = []
+      for k, length in enumerate(random_partition(total, rng)):
+        name = "q{0}_{1}_{2}".format(i, j, k)
+        sequence = ''.join(rng.choice('NNNNNNSWRYACGT') for _ in range(length))
+        lines.append("sequence {0} = {1} : {2}".format(name, sequence, length))
+        parts.append(name)
+      names.append("sup{0}_{1}".format(i, j))
+      lines.append("sup-sequence {0} = {1} : {2}".format(names[-1], ' '.join(parts), total))
+    lines.append("equal " + ' '.join(names))
+  return '\n'.join(lines) + '\n'
+
+def parse(path, equate):
+  utils.equate_domains, saved = equate, utils.equate_domains
+  try:
+    t = time.perf_counter()
+    domains, _, _ = io_PIL.from_PIL(path)
+    elapsed = time.perf_counter() - t
+  finally:
+    utils.equate_domains = saved
+  sequences = {d.name: str(d.sequence) for d in domains if d.name.startswith('sup')}
+  num_base_domains = len(set(b.name.rstrip('*') for d in domains for b in d.base_domains()))
+  return elapsed, sequences, num_base_domains
+
+
+def main(sizes, width = 3):
+  print(f"{'equal':>6} {'nt':>8} {'legacy s':>10} {'new s':>10} {'speedup':>8} "
+        f"{'legacy doms':>12} {'new doms':>9}")
+  for size in sizes:
+    text = random_design(size, width, random.Random(size))
+    with tempfile.NamedTemporaryFile('w', suffix = '.pil', delete = False) as f:
+      f.write(text)
+    try:
+      legacy_time, legacy_sequences, legacy_domains = parse(f.name, legacy_equate_domains)
+      new_time, new_sequences, new_domains = parse(f.name, utils.equate_domains)
+    finally:
+      os.remove(f.name)
+    assert legacy_sequences == new_sequences
+    nucleotides = sum(len(s) for s in new_sequences.values())
+    print(f"{size:6d} {nucleotides:8d} {legacy_time:10.3f} {new_time:10.3f} "
+          f"{legacy_time / new_time:8.1f} {legacy_domains:12d} {new_domains:9d}")
+
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  width = 3
+  if '--width' in args:
+    i = args.index('--width')
+    width = int(args[i + 1])
+    del args[i:i + 2]
+  main([int(a) for a in args] or [10, 30, 100], width)
@@ -0,0 +1,114 @@
+# bench_start_selection.py
+#
+# Times judging start structures of resting sets against their start
+# macrostates, per structure and for both selector modes: by calling the
+# selector once per structure, as Multistrand does when it samples start
+# complexes itself, and by StartStatePool's batched selection of all
+# structures of one NUPACK call (see kinda.simulation.startpool). Both must
+# accept the same structures; the acceptance rate is reported. The
+# structures are conformations of random resting sets with randomly opened
+# base pairs.
+#
+# Usage: python benchmarks/bench_start_selection.py [num_structures ...]
+
+import sys
+import time
+import random
+
+import numpy as np
+
+from kinda.objects import Domain, Strand, Complex, RestingSet
+from kinda.objects.structure import dotparen_pair_table
+from kinda.statistics.stats_utils import create_boltzmann_selector
+
+
+def random_dotparen(lengths, rng):
+  """ Returns a random non-pseudoknotted dot-paren structure. """
+  chars, stack = [], []
+  for i in range(sum(lengths)):
+    r = rng.random()
+    if r < 0.3:
+      stack.append(i)
+      chars.append('(')
+    elif r < 0.6 and stack:
+      stack.pop()
+      chars.append(')')
+    else:
+      chars.append('.')
+  for i in stack:
+    chars[i] = '.'
+  return split_strands(chars, lengths)
+
+def split_strands(chars, lengths):
+  strands, start = [], 0
+  for length in lengths:
+    strands.append(''.join(chars[start:start + length]))
+    start += length
+  return '+'.join(strands)
+
+def random_restingsets(num, rng):
+  domains = [Domain(name = 'd{}'.format(i), sequence = 'N' * rng.randint(5, 15))
+             for i in range(20)]
+  restingsets = []
+  for i in range(num):
+    strands = [Strand(name = 's{}_{}'.format(i, j), domains = rng.sample(domains, 4))
+               for j in range(rng.randint(1, 3))]
+    lengths = [s.length for s in strands]
+    restingsets.append(RestingSet(complexes = [
+      Complex(name = 'c{}_{}'.format(i, j), strands = strands,
+              structure = random_dotparen(lengths, rng))
+      for j in range(rng.randint(1, 3))]))
+  return restingsets
+
+def perturbed_structures(restingset, num, rng):
+  """ Returns num dot-paren structures of the resting set's strands, each a
+  conformation of the resting set with some of its base pairs opened. """
+  targets = [c.structure.to_dotparen() for c in restingset.complexes]
+  lengths = [s.length for s in restingset.complexes[0].strands]
+  structures = []
+  for _ in range(num):
+    table = dotparen_pair_table(rng.choice(targets))
+    for i in np.flatnonzero(table > np.arange(len(table))):
+      if rng.random() < 0.1:
+        table[table[i]] = table[i] = -1
+    chars = ['.' if j < 0 else '(' if j > i else ')' for i, j in enumerate(table)]
+    structures.append(split_strands(chars, lengths))
+  return structures
+
+
+def bench_mode(restingsets, structures, mode, threshold):
+  selectors = [create_boltzmann_selector(rs, mode, threshold) for rs in restingsets]
+
+  t = time.perf_counter()
+  legacy = [[selector(s) for s in structs]
+            for selector, structs in zip(selectors, structures)]
+  legacy_time = time.perf_counter() - t
+
+  t = time.perf_counter()
+  batch = [list(selector.select(np.array([dotparen_pair_table(s) for s in structs])))
+           for selector, structs in zip(selectors, structures)]
+  batch_time = time.perf_counter() - t
+
+  assert legacy == batch
+  accepted = sum(sum(b) for b in batch) / sum(len(s) for s in structures)
+  return legacy_time, batch_time, accepted
+
+
+def main(sizes):
+  rng = random.Random(0)
+  restingsets = random_restingsets(20, rng)
+  print(f"{'mode':18} {'structs':>8} {'legacy us':>10} {'batch us':>9} "
+        f"{'speedup':>8} {'accepted':>9}")
+  for size in sizes:
+    structures = [perturbed_structures(rs, size, rng) for rs in restingsets]
+    num = len(restingsets) * size
+    for mode, threshold in [('count-by-complex', 0.9), ('count-by-domain', 0.51)]:
+      legacy_time, batch_time, accepted = bench_mode(
+        restingsets, structures, mode, threshold)
+      print(f"{mode:18} {num:8d} {1e6 * legacy_time / num:10.1f} "
+            f"{1e6 * batch_time / num:9.1f} {legacy_time / batch_time:8.1f} "
+            f"{accepted:9.1%}")
+
+
+if __name__ == '__main__':
+  main([int(a) for a in sys.argv[1:]] or [100, 1000])
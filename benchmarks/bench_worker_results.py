@@ -0,0 +1,76 @@
+# bench_worker_results.py
+#
+# Compares what a Multistrand worker sends back to the main process per batch:
+# the whole MS Options object (legacy) vs. the compact record produced by
+# multistrandjob.pack_results(). Reports pickled bytes per trajectory and the
+# CPU time the main process spends unpickling and processing each batch.
+#
+# Usage: python benchmarks/bench_worker_results.py [pilfile] [num_batches] [batch_size]
+
+import sys
+import time
+
+import dill
+
+from multistrand.system import SimSystem as MSSimSystem
+
+import kinda
+from kinda.simulation import multistrandjob, workerpool
+
+
+def legacy_process(job, ms_options):
+  """ The per-trajectory Python loop formerly run in the main process. """
+  results = ms_options.interface.results
+  tag_ids = job.tag_id_dict
+  tags = [tag_ids[r.tag] for r in results]
+  valid = [t != tag_ids[multistrandjob.MS_TIMEOUT]
+           and t != tag_ids[multistrandjob.MS_ERROR] for t in tags]
+  times = [r.time for r in results]
+  kcolls = [r.collision_rate for r in results]
+  invalid = [{
+      'end_time': times[i],
+      'seed': results[i].seed,
+      'start_structure': results[i].start_state,
+      'end_state': [list(v) for v in ms_options.interface.end_states[i]]
+    } for i in range(len(results)) if not valid[i]]
+  return tags, valid, times, kcolls, invalid
+
+
+def main(pilpath = 'examples/simple.pil', num_batches = 20, batch_size = 100):
+  system = kinda.from_pil(pilpath)
+  rxn = sorted(system.get_reactions())[0]
+  job = system.get_stats(rxn).get_multistrandjob()
+  job_spec = workerpool.get_job_spec(job.job_key)
+
+  legacy_bytes = compact_bytes = 0
+  legacy_cpu = compact_cpu = 0.0
+  job.preallocate_batch(num_batches * batch_size)
+  for _ in range(num_batches):
+    ms_options = job.create_ms_options(batch_size)
+    MSSimSystem(ms_options).start()
+    ms_options.free_sim_system()
+
+    legacy_msg = dill.dumps(ms_options)
+    compact_msg = dill.dumps(multistrandjob.pack_results(ms_options, job_spec))
+    legacy_bytes += len(legacy_msg)
+    compact_bytes += len(compact_msg)
+
+    t = time.process_time()
+    legacy_process(job, dill.loads(legacy_msg))
+    legacy_cpu += time.process_time() - t
+
+    t = time.process_time()
+    job.process_results(dill.loads(compact_msg))
+    compact_cpu += time.process_time() - t
+
+  num_sims = num_batches * batch_size
+  print(f"reaction: {rxn}")
+  print(f"trajectories: {num_sims} ({num_batches} batches of {batch_size})")
+  print(f"{'':10} {'bytes/traj':>12} {'parent CPU us/traj':>20}")
+  print(f"{'legacy':10} {legacy_bytes / num_sims:12.1f} {1e6 * legacy_cpu / num_sims:20.2f}")
+  print(f"{'compact':10} {compact_bytes / num_sims:12.1f} {1e6 * compact_cpu / num_sims:20.2f}")
+  system.shutdown()
+
+
+if __name__ == '__main__':
+  main(*[f(a) for f, a in zip([str, int, int], sys.argv[1:])])
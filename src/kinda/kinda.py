@@ -10,6 +10,7 @@ from . import options
 from .objects import Complex, RestingSet, Reaction, RestingSetReaction
 from .statistics import stats_utils
 from .statistics.stats import RestingSetStats, RestingSetRxnStats
+from .simulation.workerpool import WorkerPool
 
 
 class System:
@@ -81,6 +82,17 @@ class System:
       self._peppercorn_params = {}
       self._enum_job = None
 
+    # Worker processes shared by the Multistrand and NUPACK jobs of all stats
+    # objects. They are only started once simulations are requested.
+    self._worker_pool = WorkerPool()
+
+    # Identifies the checkpoint log that continues the database this System was
+    # imported from (see kinda.objects.io_KinDA.CheckpointLog)
+    self.checkpoint_id = None
+    # Batches of the SQLite database this System was imported from (see
+    # kinda.objects.io_SQLite.SQLiteWriter)
+    self.sqlite_batches = None
+
     # Make stats objects separately, not during initialization. You may want to 
     # specify or query parameters before ...
     self._rs_to_stats = None
@@ -130,7 +142,8 @@ class System:
         list(self._condensed_reactions),
         kinda_params = self._kinda_params,
         multistrand_params = self._multistrand_params,
-        nupack_params = self._nupack_params
+        nupack_params = self._nupack_params,
+        worker_pool = self._worker_pool
     )
     # Pull out spurious reactions/resting sets
     self._spurious_restingsets = set(self._rs_to_stats.keys()) - self._restingsets
@@ -141,6 +154,21 @@ class System:
     for rs_stats in self._rs_to_stats.values():
       rs_stats.c_max = self._kinda_params['max_concentration']
 
+  @property
+  def worker_pool(self):
+    """
+    Returns the WorkerPool shared by all Multistrand and NUPACK jobs of this
+    system.
+    """
+    return self._worker_pool
+
+  def shutdown(self):
+    """
+    Stops the worker processes used for Multistrand and NUPACK computations.
+    They are started again automatically if more data is requested later.
+    """
+    self._worker_pool.shutdown()
+
   ## Basic get functions for system objects
   @property
   def initialization_params(self):
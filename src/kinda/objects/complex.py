@@ -13,14 +13,43 @@ This module defines a simple dna `complex` object.
 
 from functools import total_ordering
 
+import numpy as np
+
 from .structure import Structure
 
 
+def least_rotation(seq):
+  """
+  Returns the smallest k such that seq[k:] + seq[:k] is the lexicographically
+  least rotation of seq, using Booth's algorithm (linear in len(seq)).
+  """
+  doubled = list(seq) + list(seq)
+  failure = [-1] * len(doubled)
+  k = 0
+  for j in range(1, len(doubled)):
+    elem = doubled[j]
+    i = failure[j - k - 1]
+    while i != -1 and elem != doubled[k + i + 1]:
+      if elem < doubled[k + i + 1]:
+        k = j - i - 1
+      i = failure[i]
+    if elem != doubled[k + i + 1]:  # i == -1
+      if elem < doubled[k]:
+        k = j
+      failure[j - k] = -1
+    else:
+      failure[j - k] = i + 1
+  return k
+
+
 @total_ordering
 class Complex:
   """
   A representation of a single connected complex of strands.
   """
+  __slots__ = ('id', 'name', '_canonical_form', '_canonical_key',
+               '_canonical_rotation', '_hash', '_strands', '_length', '_structure')
+
   id_counter = 0
   
   def __init__(self, *args, **kargs):
@@ -43,6 +72,7 @@ class Complex:
     Complex.id_counter += 1
     
     self._canonical_form = None
+    self._canonical_key = None
     
     # Assign name
     if 'name' in kargs: self.name = kargs['name']
@@ -86,7 +116,7 @@ class Complex:
     Sets the binding of this complex. Accepts a structure in dot-paren or
     strand-list notation.
     """
-    assert self._canonical_form is None, "Complex should be treated as immutable."
+    assert self._canonical_key is None, "Complex should be treated as immutable."
     self._structure = Structure(structure = new_struct,
                                 strands = self._strands)
 
@@ -106,31 +136,46 @@ class Complex:
     """
     return self._structure.pseudoknotted
 
+  @property
+  def canonical_key(self):
+    """
+    Returns a tuple that is equal for two complexes iff they are the same
+    complex up to rotation of the strands, and which orders complexes by
+    (in)equality. Each element describes a strand in the canonical strand
+    order: the names of its base domains and, for each nucleotide, the
+    distance to its partner along the complex (UNBOUND and UNSPECIFIED are
+    kept as is). As the distances do not change under rotation, the canonical
+    order is the least rotation of this sequence. This is computed as needed
+    and stored, together with its hash.
+    """
+    if self._canonical_key is None:
+      table = self._structure.pair_table
+      offsets = self._structure.strand_offsets.tolist()
+      n = len(table)
+      distances = np.where(table >= 0, (table - np.arange(n)) % max(n, 1), table).tolist()
+      elems = [(tuple(d.name for d in strand.base_domains_tuple()),
+                tuple(distances[offsets[i]:offsets[i+1]]))
+               for i, strand in enumerate(self._strands)]
+      k = least_rotation(elems)
+      self._canonical_rotation = k
+      self._canonical_key = tuple(elems[k:] + elems[:k])
+      self._hash = hash(self._canonical_key)
+    return self._canonical_key
+
   @property
   def canonical_form(self):
     """
-    Returns a strandlist-structure pair of the complex's canonical form, which
-    can be used to compare two complexes. This is computed as needed and stored
-    to save time in the future.
-    """
-    if self._canonical_form is not None:
-      return self._canonical_form
-
-    c_domains = [[d.name for d in d_list] for d_list in self.base_domains()]
-    c_strands = self.strands
-    c_structure = self.structure
-
-    for _ in range(len(self.strands)):
-      self.rotate_strands()
-      domains = [[d.name for d in d_list] for d_list in self.base_domains()]
-      if (c_domains > domains or
-          (c_strands == self.strands and
-           c_structure.to_dotparen() > self.structure.to_dotparen())):
-        c_domains = domains
-        c_strands = self.strands
-        c_structure = self.structure
-
-    self._canonical_form = (tuple(c_strands), c_structure)
+    Returns a strandlist-structure pair of the complex's canonical form (see
+    canonical_key), without rotating this complex. This is computed as needed
+    and stored to save time in the future.
+    """
+    if self._canonical_form is None:
+      self.canonical_key
+      k = self._canonical_rotation
+      structure = Structure(structure = self._structure.to_strandlist(),
+                            strands = self._strands)
+      structure.rotate_strands(k)
+      self._canonical_form = (tuple(self._strands[k:] + self._strands[:k]), structure)
     return self._canonical_form
 
   ## Mutators
@@ -138,6 +183,11 @@ class Complex:
     amount = amount % len(self._strands)
     self._strands = self._strands[amount:] + self._strands[:amount]
     self._structure.rotate_strands(amount)
+    # The canonical key is the same for every rotation, but the canonical
+    # rotation is relative to the current strand order
+    if self._canonical_key is not None:
+      self._canonical_rotation = (self._canonical_rotation - amount) % len(self._strands)
+    self._canonical_form = None
 
   ## DNA object hierarchy
   @property
@@ -160,14 +210,30 @@ class Complex:
     Returns True if the two complexes have the same canonical representation.
     """
     assert isinstance(other, self.__class__)
-    return self.canonical_form.__eq__(other.canonical_form)
+    if self is other:  return True
+    return (self.__hash__() == other.__hash__()
+            and self._canonical_key == other._canonical_key)
 
   def __lt__(self, other):
     assert isinstance(other, self.__class__)
-    return self.canonical_form.__lt__(other.canonical_form)
+    return self.canonical_key.__lt__(other.canonical_key)
 
   def __hash__(self):
-    return hash(self.canonical_form)
+    if self._canonical_key is None:  self.canonical_key
+    return self._hash
+
+  ## Pickling
+  def __getstate__(self):
+    # The stored hash depends on the hash seed of the process (e.g. in
+    # 'spawn' worker processes), so it is recomputed on unpickling
+    return (None, {slot: getattr(self, slot) for slot in self.__slots__
+                   if slot != '_hash' and hasattr(self, slot)})
+
+  def __setstate__(self, state):
+    for slot, value in state[1].items():
+      setattr(self, slot, value)
+    if self._canonical_key is not None:
+      self._hash = hash(self._canonical_key)
   
   ## Output
   def __str__(self):
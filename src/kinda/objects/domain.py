@@ -24,6 +24,13 @@ class Domain:
   """
   id_counter = 0
 
+  # Generation counters of the domain hierarchy (see subdomains) and of the
+  # sequence constraints of all domains. The base domains and sequences of
+  # Domains and Strands are stored when computed, and recomputed as needed
+  # once a counter has changed.
+  hierarchy_generation = 0
+  sequence_generation = 0
+
   def __init__(self, *args, **kargs ):
     """
     Initialization:
@@ -42,6 +49,9 @@ class Domain:
     # Assign id
     self.id = Domain.id_counter
     Domain.id_counter += 1
+
+    self._base_domains_generation = None
+    self._sequence_generation = None
     
     # Assign name
     if 'name' in kargs: self.name = kargs['name']
@@ -69,7 +79,13 @@ class Domain:
   def sequence(self):
     """Returns the Constraints object or concatenation of the constraint
     string of the subdomains."""
-    return Sequence("".join([d._sequence for d in self.base_domains()]))
+    if not self.is_composite:
+      return self._sequence
+    generation = (Domain.hierarchy_generation, Domain.sequence_generation)
+    if self._sequence_generation != generation:
+      self._sequence_cache = Sequence("".join([d._sequence for d in self.base_domains_tuple()]))
+      self._sequence_generation = generation
+    return self._sequence_cache
 
   @sequence.setter
   def sequence(self, new_seq):
@@ -77,18 +93,20 @@ class Domain:
     If repeated domains are assigned different sequences, the result is
     the intersection of those constraints."""
     assert len(new_seq) == self._length, "KinDA: ERROR: Cannot change domain length after initialization"
-    for d in self.base_domains():
+    for d in self.base_domains_tuple():
       d._sequence = Sequence("N" * d._length)
-    self.add_sequence(new_seq)
+    Domain.sequence_generation += 1
+    self.restrict_sequence(new_seq)
 
   def restrict_sequence(self, constraints):
     """Applies the sequence constraints on top of existing sequence constraints on this domain."""
     assert len(constraints) == self._length
     i = 0
-    for d in self.base_domains():
+    for d in self.base_domains_tuple():
       subsequence = constraints[i : i+d._length]
       d._sequence = d._sequence.intersection(subsequence)
       i += d._length
+    Domain.sequence_generation += 1
 
   ## Equivalence and complementarity
   @property
@@ -139,13 +157,23 @@ class Domain:
     is_composite flag to True. """
     self._subdomains = domains
     self.is_composite = True
+    Domain.hierarchy_generation += 1
 
   def base_domains(self):
     """Breaks down the domain into non-composite domains."""
-    if self.is_composite:
-      return sum([d.base_domains() for d in self._subdomains], [])
-    else:
-      return [self]
+    return list(self.base_domains_tuple())
+
+  def base_domains_tuple(self):
+    """Returns the non-composite domains of this domain as a tuple, which is
+    stored until the domain hierarchy changes."""
+    if self._base_domains_generation != Domain.hierarchy_generation:
+      if self.is_composite:
+        self._base_domains = tuple(base for d in self._subdomains
+                                   for base in d.base_domains_tuple())
+      else:
+        self._base_domains = (self,)
+      self._base_domains_generation = Domain.hierarchy_generation
+    return self._base_domains
      
   ## (In)equality
   def __eq__(self, other):
@@ -189,6 +217,8 @@ class ComplementaryDomain( Domain):
     requested in terms of the given domain.
     """
     self._complement = complemented_domain
+    self._base_domains_generation = None
+    self._sequence_generation = None
 
   ## Basic properties  
   @property
@@ -232,7 +262,11 @@ class ComplementaryDomain( Domain):
     constraints are the complementary-reverse of the constraints of this
     domain's complement.
     """
-    return self._complement.sequence.complement
+    generation = (Domain.hierarchy_generation, Domain.sequence_generation)
+    if self._sequence_generation != generation:
+      self._sequence_cache = self._complement.sequence.complement
+      self._sequence_generation = generation
+    return self._sequence_cache
 
   @property
   def sequence(self):
@@ -257,7 +291,7 @@ class ComplementaryDomain( Domain):
     Applies the given constraints on top of any existing sequence constraints on
     this ComplementaryDomain.
     """
-    self._complement.add_sequence(constraints.complement)
+    self._complement.restrict_sequence(constraints.complement)
     
   ## Equivalence and complementarity
   @property
@@ -291,11 +325,15 @@ class ComplementaryDomain( Domain):
     is_composite field to True. """
     self._complement.subdomains = [d.complement for d in reversed(domains)]
 
-  def base_domains(self):
-    """ Returns the list of non-composite domains that compose this
-    ComplementaryDomain. This is the complementary-reverse of the list
-    for its complement."""
-    return [d.complement for d in reversed(self._complement.base_domains())]
+  def base_domains_tuple(self):
+    """ Returns the non-composite domains that compose this
+    ComplementaryDomain. This is the complementary-reverse of those of its
+    complement."""
+    if self._base_domains_generation != Domain.hierarchy_generation:
+      self._base_domains = tuple(d.complement for d in
+                                 reversed(self._complement.base_domains_tuple()))
+      self._base_domains_generation = Domain.hierarchy_generation
+    return self._base_domains
 
   ## (In)equality
   def __eq__(self, other):
@@ -2,8 +2,14 @@
 Provides utility functions for exporting/importing data from a KinDA session.
 """
 
+import os
 import json
+import uuid
+import shutil
+import struct
 import pickle
+import zipfile
+import functools
 import itertools as it
 
 import numpy as np
@@ -14,16 +20,30 @@ from peppercornenumerator.input import PilFormatError
 from .. import __version__, System
 from .. import objects as dna
 from . import io_PIL
+from . import io_SQLite
+from ..simulation.sim_utils import ResultsSummary
 
 
 ###############################
 #       Export Utilities      #
 ###############################
 
-def export_data(sstats, filepath, use_pickle = False):
+# Formats of databases written by export_data()
+DB_FORMATS = ('json', 'pickle', 'npy', 'npz', 'sqlite')
+
+def export_data(sstats, filepath, use_pickle = False, checkpoint_id = None,
+    db_format = None):
   """ Exports data of this KinDA object so that it can be imported in a later Python session.
   Does not export the entire KinDA object (only the XXXStats data that has been collected).
-  Data is exported in JSON format.
+  Data is exported in JSON format, or in the format db_format (see DB_FORMATS):
+    - 'json' or 'pickle' (the default if use_pickle is True) store everything
+      in a single JSON or pickle file.
+    - 'npy' stores a JSON manifest and one NPY file per data array in the
+      directory filepath, 'npz' the same files in an uncompressed zip archive.
+      import_data() memory-maps the arrays of these binary formats.
+    - 'sqlite' stores the objects and batches of simulation and sampling data
+      in an SQLite database, to which several processes can add data at the
+      same time (see io_SQLite.SQLiteWriter).
   The following constructs are exported:
     - domains
     - strands
@@ -33,14 +53,102 @@ def export_data(sstats, filepath, use_pickle = False):
     - resting-set reactions
     - resting-set statistics objects
     - resting-set-reaction statistics objects
+  Summary statistics of the data of each statistics object are stored as well,
+  so that import_data() can restore the data lazily.
+  A checkpoint_id is stored with the data if given (see CheckpointLog).
   Implemented, but badly and fragily dependent on KinDA object implementation """
+  if db_format == 'sqlite':
+    io_SQLite.SQLiteWriter(sstats, filepath, export_objects(sstats)).close()
+    return
+
+  sstats_dict, ids = _export_objects(sstats)
+  rs_to_id, complex_to_id, rsrxn_to_id = ids
+  rs_reactions = sstats._condensed_reactions
+  restingsets = sstats._restingsets
+  rsstats_to_dict = sstats_dict['resting-set-stats']
+  rs_summaries = {}
+  for rs in restingsets:
+    stats = sstats.get_stats(rs)
+    nupackjob = stats.get_nupackjob()
+    rs_summaries[rs_to_id[rs]] = {
+        'num_sims': nupackjob.total_sims,
+        'complex_counts': [int(n) for n in nupackjob.complex_counts]}
+    # Samples are stored as distinct structures with multiplicities
+    structures, multiplicities, similarities = nupackjob.get_sample_data()
+    rsstats_to_dict[rs_to_id[rs]]['sample_data'] = {
+        'structures': structures, 'multiplicities': np.array(multiplicities)}
+    for c in rs.complexes:
+      rsstats_to_dict[rs_to_id[rs]][complex_to_id[c]] = {
+        'prob': '{0} +/- {1}'.format(
+          stats.get_conformation_prob(c.name, 1, max_sims=0),
+          stats.get_conformation_prob_error(c.name, max_sims=0)),
+        'similarity_data': np.array(similarities[c.name])
+      }
+    assert np.sum(multiplicities) == stats.sampler.get_num_sims()
+
+  rsrxnstats_to_dict = sstats_dict['resting-set-reaction-stats']
+  rsrxn_summaries = {}
+  for rsrxn in rs_reactions:
+    stats = sstats.get_stats(rsrxn)
+    sim_data = dict(stats.get_simulation_data())
+    multijob = stats.get_multistrandjob()
+    rsrxn_summaries[rsrxn_to_id[rsrxn]] = {
+        'num_sims': multijob.total_sims,
+        'summary': multijob.get_simulation_summary().to_dict()}
+    if len(rsrxn.reactants) == 2:
+      rsrxnstats_to_dict[rsrxn_to_id[rsrxn]].update({
+        'prob': '{0} +/- {1}'.format(stats.get_prob(max_sims = 0), stats.get_prob_error(max_sims=0)),
+        'kcoll': '{0} +/- {1}'.format(stats.get_kcoll(max_sims = 0), stats.get_kcoll_error(max_sims=0)),
+        'k1': '{0} +/- {1}'.format(stats.get_k1(max_sims = 0), stats.get_k1_error(max_sims=0)),
+        'k2': '{0} +/- {1}'.format(stats.get_k2(max_sims = 0), stats.get_k2_error(max_sims=0)),
+        'simulation_data': sim_data,
+        'invalid_simulation_data': stats.get_invalid_simulation_data(),
+      })
+    elif len(rsrxn.reactants) == 1:
+      rsrxnstats_to_dict[rsrxn_to_id[rsrxn]].update({
+        'prob': '{0} +/- {1}'.format(stats.get_prob(max_sims = 0), stats.get_prob_error(max_sims=0)),
+        'k1': '{0} +/- {1}'.format(stats.get_k1(max_sims = 0), stats.get_k1_error(max_sims=0)),
+        'k2': '{0} +/- {1}'.format(stats.get_k2(max_sims = 0), stats.get_k2_error(max_sims=0)),
+        'simulation_data': sim_data,
+        'invalid_simulation_data': stats.get_invalid_simulation_data(),
+      })
+
+  sstats_dict['summaries'] = {
+    'resting-set-stats': rs_summaries,
+    'resting-set-reaction-stats': rsrxn_summaries
+  }
+  if checkpoint_id is not None:
+    sstats_dict['checkpoint_id'] = checkpoint_id
+
+  if db_format is None:
+    db_format = 'pickle' if use_pickle else 'json'
+  if db_format in ('npy', 'npz'):
+    _write_binary_db(sstats_dict, filepath, archive = (db_format == 'npz'))
+  elif db_format == 'pickle':
+    pickle.dump(_arrays_to_lists(sstats_dict), open(filepath, "wb"))
+  elif db_format == 'json':
+    json.dump(_arrays_to_lists(sstats_dict), open(filepath, 'w'))
+  else:
+    raise ValueError("Unknown database format '{}'.".format(db_format))
+
+def export_objects(sstats):
+  """
+  Returns a dict with the objects of sstats and the parameters of its
+  statistics objects, as exported by export_data() but without any simulation
+  or sampling data.
+  """
+  return _export_objects(sstats)[0]
+
+def _export_objects(sstats):
+  # Returns the dict of export_objects() and the ids given to the resting
+  # sets, complexes and resting-set reactions in it.
   ## Extract all objects to be exported
   rs_reactions = sstats._condensed_reactions
   restingsets = sstats._restingsets
   reactions = sstats._detailed_reactions
   complexes = sstats._complexes
   strands = set(sum([c.strands for c in complexes], []))
-  domains = set(sum([s.base_domains() for s in strands], []))
+  domains = set(d for s in strands for d in s.base_domains_tuple())
 
   # Note: We destroy the domain hierarchy and only store "base" domains.
   domain_to_id = {dom: 'dom{0}_{1}'.format(dom.id, dom.name) for dom in domains}
@@ -87,39 +195,11 @@ def export_data(sstats, filepath, use_pickle = False):
     stats = sstats.get_stats(rs)
     rsstats_to_dict[rs_to_id[rs]] = {
         'similarity_threshold': stats.get_similarity_threshold(), 'c_max': stats.c_max}
-    for c in rs.complexes:
-      c_data = list(stats.get_conformation_prob_data(c.name))
-      rsstats_to_dict[rs_to_id[rs]][complex_to_id[c]] = {
-        'prob': '{0} +/- {1}'.format(
-          stats.get_conformation_prob(c.name, 1, max_sims=0),
-          stats.get_conformation_prob_error(c.name, max_sims=0)),
-        'similarity_data': c_data
-      }
-      assert len(c_data) == stats.sampler.get_num_sims()
 
   rsrxnstats_to_dict = {}
   for rsrxn in rs_reactions:
     stats = sstats.get_stats(rsrxn)
-    sim_data = {key: d.tolist() for key,d in stats.get_simulation_data().items()}
-    if len(rsrxn.reactants) == 2:
-      rsrxnstats_to_dict[rsrxn_to_id[rsrxn]] = {
-        'prob': '{0} +/- {1}'.format(stats.get_prob(max_sims = 0), stats.get_prob_error(max_sims=0)),
-        'kcoll': '{0} +/- {1}'.format(stats.get_kcoll(max_sims = 0), stats.get_kcoll_error(max_sims=0)),
-        'k1': '{0} +/- {1}'.format(stats.get_k1(max_sims = 0), stats.get_k1_error(max_sims=0)),
-        'k2': '{0} +/- {1}'.format(stats.get_k2(max_sims = 0), stats.get_k2_error(max_sims=0)),
-        'simulation_data': sim_data,
-        'invalid_simulation_data': stats.get_invalid_simulation_data(),
-        'tag': stats.multijob_tag
-      }
-    elif len(rsrxn.reactants) == 1:
-      rsrxnstats_to_dict[rsrxn_to_id[rsrxn]] = {
-        'prob': '{0} +/- {1}'.format(stats.get_prob(max_sims = 0), stats.get_prob_error(max_sims=0)),
-        'k1': '{0} +/- {1}'.format(stats.get_k1(max_sims = 0), stats.get_k1_error(max_sims=0)),
-        'k2': '{0} +/- {1}'.format(stats.get_k2(max_sims = 0), stats.get_k2_error(max_sims=0)),
-        'simulation_data': sim_data,
-        'invalid_simulation_data': stats.get_invalid_simulation_data(),
-        'tag': stats.multijob_tag
-      }
+    rsrxnstats_to_dict[rsrxn_to_id[rsrxn]] = {'tag': stats.multijob_tag}
 
   # Prepare the overall dict object to be JSON-ed
   sstats_dict = {
@@ -134,11 +214,57 @@ def export_data(sstats, filepath, use_pickle = False):
     'initialization_params': sstats.initialization_params,
     'version': __version__
   }
+  return sstats_dict, (rs_to_id, complex_to_id, rsrxn_to_id)
+
+def _arrays_to_lists(obj):
+  if isinstance(obj, np.ndarray):
+    return obj.tolist()
+  elif isinstance(obj, dict):
+    return {k: _arrays_to_lists(v) for k,v in obj.items()}
+  elif isinstance(obj, list):
+    return [_arrays_to_lists(v) for v in obj]
+  return obj
+
+def _write_binary_db(sstats_dict, filepath, archive = False):
+  """
+  Writes sstats_dict as a JSON manifest in which every array is replaced by
+  {'__npy__': <name>}, and one NPY file per array. The files are written to
+  the directory filepath, or to an uncompressed zip archive if archive is True
+  (so that the arrays can be memory-mapped from the archive).
 
-  if use_pickle :
-    pickle.dump(sstats_dict, open(filepath, "wb"))
-  else :
-    json.dump(sstats_dict, open(filepath, 'w'))
+  The database is written to a temporary path first and then moved to
+  filepath, as an existing database at filepath may still be memory-mapped.
+  """
+  arrays = {}
+  def encode(obj):
+    if isinstance(obj, np.ndarray):
+      name = 'arrays/{}.npy'.format(len(arrays))
+      arrays[name] = obj
+      return {'__npy__': name}
+    elif isinstance(obj, dict):
+      return {k: encode(v) for k,v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+      return [encode(v) for v in obj]
+    return obj
+  manifest = json.dumps(encode(sstats_dict))
+
+  tmp_path = filepath + '.tmp'
+  if os.path.isdir(tmp_path):
+    shutil.rmtree(tmp_path)
+  if archive:
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as zf:
+      zf.writestr(BINARY_DB_MANIFEST, manifest)
+      for name, array in arrays.items():
+        with zf.open(name, 'w', force_zip64 = True) as f:
+          np.lib.format.write_array(f, np.ascontiguousarray(array))
+  else:
+    os.makedirs(os.path.join(tmp_path, 'arrays'))
+    for name, array in arrays.items():
+      with open(os.path.join(tmp_path, name), 'wb') as f:
+        np.lib.format.write_array(f, np.ascontiguousarray(array))
+    with open(os.path.join(tmp_path, BINARY_DB_MANIFEST), 'w') as f:
+      f.write(manifest)
+  replace_database(tmp_path, filepath)
 
 
 def format_rate_units(rate, arity, molarity, time):
@@ -272,13 +398,367 @@ def write_pil(KindaSystem: System, fh, spurious=False, unproductive=False,
                     rms1.name, rms2.name, depl))
 
 
+###############################
+#      Checkpoint Utilities   #
+###############################
+
+class CheckpointLog:
+  """
+  Append-only log of the simulation data gained by the jobs of a System since
+  the database at db_path was last written, so that a checkpoint costs only
+  as much as the new data instead of a full export_data().
+
+  New Multistrand trajectories (and replaced re-runs) and new NUPACK
+  similarity data are written to '<db_path>.log' as the jobs report them (see
+  MultistrandJob.add_data_listener()). Once the log has grown larger than
+  compact_ratio times the database (but at least min_compact_bytes), sync()
+  compacts it: the whole System is exported to the database, atomically, and
+  the log is started afresh. import_data() replays the log on top of the
+  database it continues.
+
+  The database and the log share a random checkpoint id, which is renewed with
+  every compaction. A log whose id does not match the database (e.g. because
+  a crash happened after compaction but before the log was reset) is
+  therefore ignored, as its data is already part of the database. The entries
+  themselves are positional and thus idempotent, and a truncated last entry
+  is skipped when the log is replayed.
+
+  Jobs are identified by the name of their resting set, or by the repr() of
+  the first resting-set reaction that uses the Multistrand job, which are
+  stable across sessions (unlike the ids used in the database).
+
+  Args:
+    sstats (System): The System whose data is logged.
+    db_path (str): Path of the database (see export_data()).
+    use_pickle (bool, optional): Database format, as in export_data().
+    db_format (str, optional): Database format, as in export_data().
+    resume (bool, optional): Continue an existing log, if it matches the
+      database sstats was imported from. Otherwise, the database is written
+      and a new log is started.
+  """
+  def __init__(self, sstats, db_path, use_pickle = True, resume = False,
+      compact_ratio = 1.0, min_compact_bytes = 2**24, db_format = None):
+    self._sstats = sstats
+    self.db_path = db_path
+    self.path = self.log_path(db_path)
+    self.use_pickle = use_pickle
+    self.db_format = db_format
+    self.compact_ratio = compact_ratio
+    self.min_compact_bytes = min_compact_bytes
+    self._file = None
+
+    self._job_keys = {}
+    for rs in sstats._restingsets:
+      self._job_keys[sstats.get_stats(rs).get_nupackjob()] = ('nupack', rs.name)
+    for rxn in sstats._condensed_reactions:
+      job = sstats.get_stats(rxn).get_multistrandjob()
+      self._job_keys.setdefault(job, ('ms', repr(rxn)))
+    for job in self._job_keys:
+      job.add_data_listener(self._log_change)
+
+    if (resume and sstats.checkpoint_id is not None
+        and read_checkpoint_header(self.path) == sstats.checkpoint_id):
+      # Drop a truncated last entry, so that new entries can be read again
+      self._file = open(self.path, 'r+b')
+      self._file.truncate(len_checkpoint_log(self.path))
+      self._file.seek(0, os.SEEK_END)
+    else:
+      self.compact()
+
+  @staticmethod
+  def log_path(db_path):
+    return db_path + '.log'
+
+  def _log_change(self, job, change):
+    if 'rows' in change:
+      change = dict(change, rows = {k: np.array(v) for k,v in change['rows'].items()})
+    pickle.dump(self._job_keys[job] + (change,), self._file)
+    self._file.flush()
+
+  def sync(self):
+    """
+    Makes sure that all logged data is on disk, and compacts the log into the
+    database if it has grown large.
+    """
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    log_size = os.path.getsize(self.path)
+    db_size = database_size(self.db_path)
+    if log_size > max(self.min_compact_bytes, self.compact_ratio * db_size):
+      self.compact()
+
+  def compact(self):
+    """ Writes the whole System to the database and starts a new log. """
+    if self._file is not None:
+      self._file.close()
+    checkpoint_id = uuid.uuid4().hex
+    tmp_path = self.db_path + '.partial'
+    export_data(self._sstats, tmp_path, self.use_pickle,
+                checkpoint_id = checkpoint_id, db_format = self.db_format)
+    replace_database(tmp_path, self.db_path)
+    self._sstats.checkpoint_id = checkpoint_id
+    self._file = open(self.path, 'wb')
+    pickle.dump({'checkpoint_id': checkpoint_id, 'version': __version__}, self._file)
+    self._file.flush()
+
+  def close(self, compact = True):
+    """
+    Stops logging, after compacting the log into the database (by default).
+    """
+    if compact:
+      self.compact()
+    for job in self._job_keys:
+      job.remove_data_listener(self._log_change)
+    self._file.close()
+
+
+def database_size(db_path):
+  """ Returns the size in bytes of a database file or directory (0 if none). """
+  if os.path.isdir(db_path):
+    return sum(os.path.getsize(os.path.join(d, f))
+               for d, _, files in os.walk(db_path) for f in files)
+  return os.path.getsize(db_path) if os.path.exists(db_path) else 0
+
+
+def replace_database(src, dst):
+  """
+  Moves the database src to dst, replacing any existing database. Files are
+  replaced atomically; a database directory is moved aside first, so that
+  one complete database exists at any time.
+  """
+  if not os.path.isdir(src) and not os.path.isdir(dst):
+    os.replace(src, dst)
+    return
+  old = None
+  if os.path.exists(dst):
+    old = dst + '.old'
+    if os.path.isdir(old):
+      shutil.rmtree(old)
+    os.replace(dst, old)
+  os.replace(src, dst)
+  if old is not None:
+    if os.path.isdir(old):
+      shutil.rmtree(old)
+    else:
+      os.remove(old)
+
+
+def open_checkpoint(sstats, db_path, use_pickle = True, resume = False,
+    db_format = None):
+  """
+  Returns an object that saves the data of sstats to the database at db_path
+  with every sync() and at close(): an io_SQLite.SQLiteWriter for SQLite
+  databases, and a CheckpointLog otherwise.
+  """
+  if db_format == 'sqlite':
+    return io_SQLite.SQLiteWriter(sstats, db_path, export_objects(sstats),
+                                  resume = resume)
+  return CheckpointLog(sstats, db_path, use_pickle, resume = resume,
+                       db_format = db_format)
+
+
+def read_checkpoint_header(log_path):
+  """ Returns the checkpoint id of the log at log_path, or None. """
+  if not os.path.exists(log_path):
+    return None
+  try:
+    with open(log_path, 'rb') as f:
+      return pickle.load(f).get('checkpoint_id')
+  except (EOFError, pickle.UnpicklingError, AttributeError):
+    return None
+
+
+def len_checkpoint_log(log_path):
+  """ Returns the length in bytes of the complete entries of the log. """
+  with open(log_path, 'rb') as f:
+    length = 0
+    while True:
+      try:
+        pickle.load(f)
+      except Exception:
+        return length
+      length = f.tell()
+
+
+def replay_checkpoint_log(sstats, log_path):
+  """
+  Adds the data of the checkpoint log at log_path to sstats, if the log
+  continues the database that sstats was imported from.
+  """
+  if read_checkpoint_header(log_path) != sstats.checkpoint_id:
+    return
+
+  ms_jobs, nupack_jobs = {}, {}
+  for rs in sstats._restingsets:
+    nupack_jobs[rs.name] = sstats.get_stats(rs).get_nupackjob()
+  for rxn in sstats._condensed_reactions:
+    ms_jobs[repr(rxn)] = sstats.get_stats(rxn).get_multistrandjob()
+
+  # Apply all changes to copies of the data, then set the data of each job once
+  ms_data, ms_invalid, nupack_data = {}, {}, {}
+  def write_rows(columns, start, rows):
+    end = start + len(next(iter(rows.values())))
+    for k, v in rows.items():
+      col = columns[k]
+      if len(col) < end:
+        col = np.concatenate((col, np.zeros(end - len(col), dtype = col.dtype)))
+      col[start:end] = v
+      columns[k] = col
+
+  with open(log_path, 'rb') as f:
+    pickle.load(f)
+    while True:
+      try:
+        kind, key, change = pickle.load(f)
+      except EOFError:
+        break
+      except (pickle.UnpicklingError, ValueError, TypeError):
+        print("# KinDA: WARNING: Ignoring truncated entry in checkpoint log {}.".format(log_path))
+        break
+      if kind == 'ms':
+        if key not in ms_jobs:
+          continue
+        job = ms_jobs[key]
+        if job not in ms_data:
+          ms_data[job] = {k: np.array(v) for k,v in job.get_simulation_data().items()}
+          ms_invalid[job] = {info['simulation_index']: info
+                             for info in job.get_invalid_simulation_data()}
+        if 'rows' in change:
+          write_rows(ms_data[job], change['start'], change['rows'])
+        for info in change.get('invalid', []):
+          ms_invalid[job][info['simulation_index']] = info
+        for index in change.get('invalid_removed', []):
+          ms_invalid[job].pop(index, None)
+      elif kind == 'nupack':
+        if key not in nupack_jobs:
+          continue
+        job = nupack_jobs[key]
+        if job not in nupack_data:
+          structures, multiplicities, similarities = job.get_sample_data()
+          nupack_data[job] = (structures, {'multiplicities': np.array(multiplicities)},
+                              {k: np.array(v) for k,v in similarities.items()})
+        structures, multiplicities, similarities = nupack_data[job]
+        structures[change['start']:] = change['structures']
+        if change['structures']:
+          write_rows(similarities, change['start'], change['similarities'])
+          write_rows(multiplicities, change['start'], {'multiplicities':
+            np.zeros(len(change['structures']), dtype = np.int64)})
+        np.add.at(multiplicities['multiplicities'], change['indices'], change['counts'])
+
+  for job, data in ms_data.items():
+    job.set_simulation_data(data)
+    job.set_invalid_simulation_data(
+      [ms_invalid[job][i] for i in sorted(ms_invalid[job])])
+  for job, (structures, multiplicities, similarities) in nupack_data.items():
+    job.set_sample_data(structures, multiplicities['multiplicities'], similarities)
+
+
 ###############################
 #       Import Utilities      #
 ###############################
 
-def import_data(filepath, use_pickle = False):
+BINARY_DB_MANIFEST = 'manifest.json'
+
+def is_binary_db(filepath):
+  """ True if filepath is a database in the 'npy' or 'npz' format. """
+  if os.path.isdir(filepath):
+    return os.path.exists(os.path.join(filepath, BINARY_DB_MANIFEST))
+  if not zipfile.is_zipfile(filepath):
+    return False
+  with zipfile.ZipFile(filepath) as zf:
+    return BINARY_DB_MANIFEST in zf.namelist()
+
+def _memmap_npy(path, offset = 0):
+  """ Memory-maps (copy-on-write) the NPY array at offset in the file path. """
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+      shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+      shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    data_offset = f.tell()
+  if np.prod(shape) == 0:
+    return np.empty(shape, dtype = dtype)
+  return np.memmap(path, dtype = dtype, mode = 'c', offset = data_offset,
+                   shape = shape, order = 'F' if fortran_order else 'C')
+
+def _read_binary_db(filepath, lazy = False):
+  """
+  Reads a database written by _write_binary_db(). If lazy is True, arrays are
+  replaced by functions that memory-map them.
+  """
+  if os.path.isdir(filepath):
+    with open(os.path.join(filepath, BINARY_DB_MANIFEST)) as f:
+      manifest = json.load(f)
+    load_array = lambda name: _memmap_npy(os.path.join(filepath, name))
+  else:
+    with zipfile.ZipFile(filepath) as zf:
+      manifest = json.loads(zf.read(BINARY_DB_MANIFEST))
+      offsets = {}
+      with open(filepath, 'rb') as f:
+        for info in zf.infolist():
+          if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError('Cannot memory-map compressed array {} in {}.'.format(
+              info.filename, filepath))
+          # The data follows the local file header, which has its own lengths
+          # of the file name and extra field
+          f.seek(info.header_offset)
+          header = f.read(30)
+          name_len, extra_len = struct.unpack('<HH', header[26:30])
+          offsets[info.filename] = info.header_offset + 30 + name_len + extra_len
+    load_array = lambda name: _memmap_npy(filepath, offsets[name])
+
+  def decode(obj):
+    if isinstance(obj, dict):
+      if set(obj) == {'__npy__'}:
+        if lazy:
+          return functools.partial(load_array, obj['__npy__'])
+        return load_array(obj['__npy__'])
+      return {k: decode(v) for k,v in obj.items()}
+    elif isinstance(obj, list):
+      return [decode(v) for v in obj]
+    return obj
+  return decode(manifest)
+
+def _load_array(data):
+  # Data arrays are given as functions returning them when imported lazily
+  return data() if callable(data) else np.asarray(data)
+
+def _load_arrays(data):
+  # Lazy SQLite imports give one function returning all arrays of a job
+  # (see io_SQLite.read_database())
+  if callable(data):
+    data = data()
+  return {key: _load_array(d) for key,d in data.items()}
+
+def _load_sample_data(sample_data, similarity_data):
+  # Returns NUPACK samples in the format of NupackSampleJob.get_sample_data().
+  # Databases of older versions store one similarity per sample.
+  similarities = _load_arrays(similarity_data)
+  if sample_data is None:
+    num_samples = len(next(iter(similarities.values()), []))
+    return [None] * num_samples, np.ones(num_samples, dtype = np.int64), similarities
+  return (list(sample_data['structures']),
+          _load_array(sample_data['multiplicities']), similarities)
+
+def import_data(filepath, use_pickle = False, replay_log = True, lazy = False):
   """ Imports a KinDA object as exported in the format specified by export_data()
 
+  The format of the database is detected automatically, except that
+  use_pickle must be set for pickle files. The data arrays of the binary
+  formats are memory-mapped (copy-on-write), so that they are only read from
+  disk as far as they are used.
+
+  If lazy is True, only the objects and the summary statistics of each
+  statistics object are restored; the raw simulation and sampling data of a
+  job is read when the job first needs it (e.g. when it is extended or its
+  data is requested). Databases without summary statistics (written by older
+  versions) are restored completely.
+
+  If replay_log is True and there is a checkpoint log that continues this
+  database (see CheckpointLog), the data in the log is added as well.
+
   Imports:
     - domains, strands, complexes, reactions, resting-sets, resting-set reactions
     - resting-set stats:
@@ -289,7 +769,11 @@ def import_data(filepath, use_pickle = False):
     - resting-set reaction stats:
         => load
   """
-  if use_pickle:
+  if io_SQLite.is_sqlite_db(filepath):
+    sstats_dict = io_SQLite.read_database(filepath, lazy)
+  elif is_binary_db(filepath):
+    sstats_dict = _read_binary_db(filepath, lazy)
+  elif use_pickle:
     sstats_dict = pickle.load(open(filepath, "rb"))
   else:
     sstats_dict = json.load(open(filepath))
@@ -352,6 +836,10 @@ def import_data(filepath, use_pickle = False):
     nupack_params = nparams,
     peppercorn_params = pparams)
 
+  summaries = sstats_dict.get('summaries', {}) if lazy else {}
+  rs_summaries = summaries.get('resting-set-stats', {})
+  rsrxn_summaries = summaries.get('resting-set-reaction-stats', {})
+
   for rs_id, data in sstats_dict['resting-set-stats'].items():
     stats = sstats.get_stats(restingsets[rs_id])
     if stats == None:
@@ -359,21 +847,28 @@ def import_data(filepath, use_pickle = False):
       continue
     nupackjob = stats.get_nupackjob()
     threshold = 0
+    sample_data = None
+    similarity_data = {}
     for key, val in data.items():
       if key == 'similarity_threshold':
         threshold = val
       elif key == 'c_max':
         stats.c_max = val
+      elif key == 'sample_data':
+        sample_data = val
       else:
-        c = complexes[key]
-        c_data = np.array(val['similarity_data'])
-        nupackjob.set_complex_prob_data(c.name, c_data)
-        if nupackjob.total_sims == 0:
-          nupackjob.total_sims = len(c_data)
-        else:
-          assert nupackjob.total_sims == len(c_data)
+        similarity_data[complexes[key].name] = val['similarity_data']
     assert threshold > 0
+
+    # The stored counts are those for the stored threshold
     stats.set_similarity_threshold(threshold)
+    summary = rs_summaries.get(rs_id)
+    if summary is not None:
+      nupackjob.set_lazy_sample_data(
+          functools.partial(_load_sample_data, sample_data, similarity_data),
+          summary['num_sims'], summary['complex_counts'])
+      continue
+    nupackjob.set_sample_data(*_load_sample_data(sample_data, similarity_data))
 
   for rsrxn_id, data in sstats_dict['resting-set-reaction-stats'].items():
     stats = sstats.get_stats(rs_reactions[rsrxn_id])
@@ -383,12 +878,24 @@ def import_data(filepath, use_pickle = False):
     multijob = stats.get_multistrandjob()
     stats.multijob_tag = data['tag']
 
-    num_sims = len(data['simulation_data']['tags'])
-    sim_data = {key:np.array(d) for key,d in data['simulation_data'].items()}
+    summary = rsrxn_summaries.get(rsrxn_id)
+    if summary is not None:
+      multijob.set_lazy_simulation_data(
+          functools.partial(_load_arrays, data['simulation_data']),
+          summary['num_sims'], ResultsSummary.from_dict(summary['summary']))
+      multijob.set_invalid_simulation_data(data['invalid_simulation_data'])
+      continue
+    sim_data = _load_arrays(data['simulation_data'])
+    num_sims = len(sim_data['tags'])
     multijob.set_simulation_data(sim_data)
     multijob.set_invalid_simulation_data(data['invalid_simulation_data'])
     multijob.total_sims = num_sims
 
+  sstats.sqlite_batches = sstats_dict.get('sqlite_batches')
+  sstats.checkpoint_id = sstats_dict.get('checkpoint_id')
+  if replay_log and sstats.checkpoint_id is not None:
+    replay_checkpoint_log(sstats, CheckpointLog.log_path(filepath))
+
   return sstats
 
 def _import_data_convert_version(sstats_dict, version):
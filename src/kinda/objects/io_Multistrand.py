@@ -12,7 +12,7 @@ def to_Multistrand_domains(domains):
   import multistrand.objects as MS
   
   ## Pull out just the base domains, which are the ones included in the dict
-  base_domains = set(sum([d.base_domains() for d in domains], []))
+  base_domains = set(base for d in domains for base in d.base_domains_tuple())
   ## Remove redundant complementary pairs of complexes (we only need one or the other)
   base_domains -= set([d.complement for d in base_domains if not d.is_complement])
 
@@ -139,8 +139,8 @@ def to_Multistrand(*args, **kargs):
                   + kargs.get('complexes', []))
   strands = set(sum([c.strands for c in complexes], [])
                 + kargs.get('strands', []))
-  domains = set(sum([s.base_domains() for s in strands], [])
-                + sum([d.base_domains() for d in kargs.get('domains', [])], []))
+  domains = set([d for s in strands for d in s.base_domains_tuple()]
+                + [b for d in kargs.get('domains', []) for b in d.base_domains_tuple()])
 
   ## Create dict of Multistrand Domain objects
   ms_domains = to_Multistrand_domains(domains)
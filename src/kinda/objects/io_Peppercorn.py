@@ -100,12 +100,12 @@ def to_Peppercorn(*args, **kargs):
   reactions = set(kargs.get('reactions', []))
   complexes = set(sum([list(r.reactants + r.products) for r in reactions], [])
                   + kargs.get('complexes', []))
-  domains = set([d for c in complexes for d_list in c.base_domains() for d in d_list]
-                + sum([d.base_domains() for d in kargs.get('domains', [])], []))
+  domains = set([d for c in complexes for s in c.strands for d in s.base_domains_tuple()]
+                + [b for d in kargs.get('domains', []) for b in d.base_domains_tuple()])
                 
   ## Convert domains, strands, complexes, and reactions
   enum_domains = {}
-  for d in set(sum([d.base_domains() for d in domains], [])):
+  for d in set(b for d in domains for b in d.base_domains_tuple()):
     enum_domains[d] = to_Peppercorn_domain(d)
   
   enum_complexes = {}
@@ -0,0 +1,489 @@
+"""
+Provides an SQLite storage backend for KinDA sessions, to which several KinDA
+processes can add simulation and sampling data at the same time.
+"""
+
+import io
+import os
+import json
+import uuid
+import bisect
+import sqlite3
+import functools
+
+import numpy as np
+
+from ..simulation.sim_utils import ResultsSummary
+from ..simulation.resultstore import ResultStore
+
+# Version of the table layout below
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+  kind TEXT NOT NULL,
+  id TEXT NOT NULL,
+  data TEXT NOT NULL,
+  PRIMARY KEY (kind, id)
+);
+CREATE TABLE IF NOT EXISTS trajectory_batches (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  job TEXT NOT NULL,
+  writer TEXT NOT NULL,
+  num_sims INTEGER NOT NULL,
+  summary TEXT NOT NULL,
+  invalid TEXT NOT NULL,
+  tags BLOB NOT NULL,
+  times BLOB NOT NULL,
+  valid BLOB NOT NULL,
+  kcoll BLOB
+);
+CREATE INDEX IF NOT EXISTS trajectory_batches_job ON trajectory_batches (job, id);
+CREATE TABLE IF NOT EXISTS sample_batches (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  job TEXT NOT NULL,
+  writer TEXT NOT NULL,
+  num_samples INTEGER NOT NULL,
+  complexes TEXT NOT NULL,
+  structures TEXT NOT NULL,
+  multiplicities BLOB NOT NULL,
+  similarities BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sample_batches_job ON sample_batches (job, id);
+"""
+
+# Kinds of objects stored in the objects table, as in the sections of
+# kinda.objects.io_KinDA.export_objects()
+OBJECT_KINDS = ('domains', 'strands', 'complexes', 'resting-sets', 'reactions',
+                'resting-set-reactions', 'resting-set-stats',
+                'resting-set-reaction-stats')
+
+TRAJECTORY_COLUMNS = ('tags', 'times', 'valid', 'kcoll')
+
+
+def is_sqlite_db(filepath):
+  """ True if filepath is an SQLite database. """
+  if not os.path.isfile(filepath):
+    return False
+  with open(filepath, 'rb') as f:
+    return f.read(16) == b'SQLite format 3\x00'
+
+
+def connect(filepath, timeout = 60.0, read_only = False):
+  """
+  Opens the database at filepath. Transactions are started explicitly (see
+  transaction()); a writer waits up to timeout seconds for other writers.
+  """
+  if read_only:
+    con = sqlite3.connect('file:{}?mode=ro'.format(filepath), uri = True,
+                          timeout = timeout, isolation_level = None)
+  else:
+    con = sqlite3.connect(filepath, timeout = timeout, isolation_level = None)
+    # Readers do not block the writer (and vice versa) in WAL mode
+    con.execute('PRAGMA journal_mode = WAL')
+    con.executescript(SCHEMA)
+  return con
+
+
+class transaction:
+  """
+  Context manager for a write transaction on con. The database is locked for
+  other writers from the start (BEGIN IMMEDIATE), so that whatever is read
+  within the transaction stays current until it is committed, and everything
+  is committed at once or not at all.
+  """
+  def __init__(self, con):
+    self._con = con
+
+  def __enter__(self):
+    self._con.execute('BEGIN IMMEDIATE')
+    return self._con
+
+  def __exit__(self, exc_type, exc, tb):
+    self._con.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+    return False
+
+
+def _to_blob(array):
+  f = io.BytesIO()
+  np.save(f, np.ascontiguousarray(array), allow_pickle = False)
+  return f.getvalue()
+
+def _from_blob(blob):
+  return np.load(io.BytesIO(blob), allow_pickle = False)
+
+
+def trajectory_job_key(reactant_names):
+  """
+  Returns the key under which the trajectories of the Multistrand job of the
+  given reactants (names of resting sets) are stored. All resting-set reactions
+  with the same reactants share a Multistrand job; unlike object ids, the
+  names are the same in every KinDA process.
+  """
+  return ' + '.join(sorted(reactant_names))
+
+
+def write_objects(con, objects):
+  """
+  Stores objects (as returned by io_KinDA.export_objects()) unless the database
+  already has objects. Returns True if they were stored.
+  """
+  if con.execute("SELECT 1 FROM meta WHERE key = 'version'").fetchone():
+    return False
+  con.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', [
+    ('version', json.dumps(objects['version'])),
+    ('schema_version', json.dumps(SCHEMA_VERSION)),
+    ('initialization_params', json.dumps(objects['initialization_params']))])
+  con.executemany('INSERT INTO objects (kind, id, data) VALUES (?, ?, ?)',
+    [(kind, obj_id, json.dumps(data))
+     for kind in OBJECT_KINDS for obj_id, data in objects[kind].items()])
+  return True
+
+
+def insert_trajectories(con, job, writer, data, invalid, start, end):
+  """
+  Stores rows start to end of the results data of a Multistrand job as a new
+  batch, with the invalid simulation records among them. Returns its id.
+  """
+  rows = {k: np.asarray(v[start:end]) for k,v in data.items()}
+  cur = con.execute(
+    'INSERT INTO trajectory_batches (job, writer, num_sims, summary, invalid, '
+    'tags, times, valid, kcoll) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+    (job, writer, end - start) + _trajectory_values(rows, invalid, start, end))
+  return cur.lastrowid
+
+def patch_trajectories(con, batch_id, data, invalid, start, rows):
+  """
+  Replaces the given rows of a batch (which starts at row start of the
+  results data) with those of the results data, along with their invalid
+  simulation records. The batch is read from con, so that rows changed by
+  other writers in the meantime are kept.
+  """
+  stored = con.execute('SELECT invalid, tags, times, valid, kcoll FROM '
+                       'trajectory_batches WHERE id = ?', (batch_id,)).fetchone()
+  batch = {k: _from_blob(blob) for k, blob in zip(TRAJECTORY_COLUMNS, stored[1:])
+           if blob is not None}
+  rows = np.asarray(sorted(rows), dtype = np.int64)
+  for k, column in batch.items():
+    column[rows - start] = np.asarray(data[k])[rows]
+  end = start + len(batch['tags'])
+  patched = set(rows.tolist())
+  batch_invalid = [dict(info, simulation_index = info['simulation_index'] + start)
+                   for info in json.loads(stored[0])
+                   if info['simulation_index'] + start not in patched]
+  batch_invalid.extend(info for info in invalid if info['simulation_index'] in patched)
+  batch_invalid.sort(key = lambda info: info['simulation_index'])
+  con.execute(
+    'UPDATE trajectory_batches SET summary = ?, invalid = ?, tags = ?, '
+    'times = ?, valid = ?, kcoll = ? WHERE id = ?',
+    _trajectory_values(batch, batch_invalid, start, end) + (batch_id,))
+
+def _trajectory_values(rows, invalid, start, end):
+  # Indices of invalid simulation records are stored relative to the batch
+  batch_invalid = [dict(info, simulation_index = info['simulation_index'] - start)
+                   for info in invalid if start <= info['simulation_index'] < end]
+  summary = ResultsSummary.from_results(rows).to_dict()
+  kcoll = _to_blob(rows['kcoll']) if 'kcoll' in rows else None
+  return (json.dumps(summary), json.dumps(batch_invalid), _to_blob(rows['tags']),
+          _to_blob(rows['times']), _to_blob(rows['valid']), kcoll)
+
+def insert_samples(con, job, writer, complex_names, structures, multiplicities,
+    similarities):
+  """
+  Stores a batch of NUPACK samples, given as distinct structures with their
+  multiplicities and their similarities to each of the complexes
+  complex_names (one row per complex), as in
+  NupackSampleJob.get_sample_data(). Returns its id.
+  """
+  multiplicities = np.asarray(multiplicities, dtype = np.int64)
+  similarities = np.asarray(similarities, dtype = np.float64).reshape(
+    len(complex_names), len(structures))
+  cur = con.execute(
+    'INSERT INTO sample_batches (job, writer, num_samples, complexes, '
+    'structures, multiplicities, similarities) VALUES (?, ?, ?, ?, ?, ?, ?)',
+    (job, writer, int(np.sum(multiplicities)), json.dumps(list(complex_names)),
+     json.dumps(list(structures)), _to_blob(multiplicities),
+     _to_blob(similarities)))
+  return cur.lastrowid
+
+
+def load_trajectories(filepath, batch_ids):
+  """
+  Returns the concatenated results data of the given trajectory batches
+  (e.g. all batches of one reaction, see read_database()).
+  """
+  con = connect(filepath, read_only = True)
+  try:
+    columns = {k: [] for k in TRAJECTORY_COLUMNS}
+    for batch_id in batch_ids:
+      row = con.execute('SELECT tags, times, valid, kcoll FROM trajectory_batches '
+                        'WHERE id = ?', (batch_id,)).fetchone()
+      for k, blob in zip(TRAJECTORY_COLUMNS, row):
+        if blob is not None:
+          columns[k].append(_from_blob(blob))
+  finally:
+    con.close()
+  if not batch_ids:
+    return {k: np.empty(0, dtype = ResultStore.COLUMN_DTYPES[k])
+            for k in TRAJECTORY_COLUMNS}
+  return {k: np.concatenate(arrays) for k, arrays in columns.items() if arrays}
+
+
+def read_trajectory_batches(con, job):
+  """
+  Returns the batches of trajectories stored for job as a list of (batch id,
+  number of trajectories), with their invalid simulation records (indexed as
+  in the concatenated batches) and a ResultsSummary of all of them.
+  """
+  batch_list, num_sims = [], 0
+  summary, invalid = ResultsSummary(), []
+  for batch_id, n, batch_summary, batch_invalid in con.execute(
+      'SELECT id, num_sims, summary, invalid FROM trajectory_batches '
+      'WHERE job = ? ORDER BY id', (job,)):
+    invalid.extend(dict(info, simulation_index = info['simulation_index'] + num_sims)
+                   for info in json.loads(batch_invalid))
+    summary.merge(ResultsSummary.from_dict(json.loads(batch_summary)))
+    batch_list.append((batch_id, n))
+    num_sims += n
+  return batch_list, invalid, summary
+
+
+def read_sample_batches(con, job, complex_names):
+  """
+  Returns the batches of NUPACK samples stored for job as a list of (batch
+  id, number of samples), with the concatenated sample data of the batches
+  as a tuple (structures, multiplicities, similarities), where similarities
+  has the similarity data of each of the given complex names. A structure
+  may appear in several batches.
+  """
+  batch_list, structures, multiplicities = [], [], []
+  similarities = {name: [] for name in complex_names}
+  for batch_id, num_samples, names, batch_structures, counts, blob in con.execute(
+      'SELECT id, num_samples, complexes, structures, multiplicities, '
+      'similarities FROM sample_batches WHERE job = ? ORDER BY id', (job,)):
+    structures.extend(json.loads(batch_structures))
+    multiplicities.append(_from_blob(counts))
+    for name, row in zip(json.loads(names), _from_blob(blob)):
+      if name in similarities:
+        similarities[name].append(row)
+    batch_list.append((batch_id, num_samples))
+  multiplicities = (np.concatenate(multiplicities) if multiplicities
+                    else np.zeros(0, dtype = np.int64))
+  return batch_list, (structures, multiplicities,
+      {name: np.concatenate(data) if data else np.zeros(0)
+       for name, data in similarities.items()})
+
+
+def read_database(filepath, lazy = False):
+  """
+  Reads the database at filepath into a dict in the format written by
+  io_KinDA.export_data(), so that it can be imported with io_KinDA.import_data().
+
+  The trajectories of all batches of a Multistrand job are concatenated in the
+  order of their ids. If lazy is True, they are given as functions that read
+  them (see load_trajectories()), along with the summary statistics of every
+  reaction. NUPACK samples are always read.
+
+  The ids of the batches are stored in the dict under 'sqlite_batches', for
+  an SQLiteWriter that continues the database.
+  """
+  con = connect(filepath, read_only = True)
+  try:
+    meta = {key: json.loads(value)
+            for key, value in con.execute('SELECT key, value FROM meta')}
+    if meta.get('schema_version') != SCHEMA_VERSION:
+      raise ValueError('Unsupported version {} of SQLite database {}.'.format(
+        meta.get('schema_version'), filepath))
+    sstats_dict = {kind: {} for kind in OBJECT_KINDS}
+    for kind, obj_id, data in con.execute('SELECT kind, id, data FROM objects'):
+      sstats_dict[kind][obj_id] = json.loads(data)
+    sstats_dict['version'] = meta['version']
+    sstats_dict['initialization_params'] = meta['initialization_params']
+    batches = {'trajectories': {}, 'samples': {}}
+
+    # NUPACK samples of each resting set
+    for rs_id, rs in sstats_dict['resting-sets'].items():
+      complex_ids = {sstats_dict['complexes'][c_id]['name']: c_id
+                     for c_id in rs['complexes']}
+      batches['samples'][rs['name']], sample_data = read_sample_batches(
+          con, rs['name'], complex_ids)
+      structures, multiplicities, similarities = sample_data
+      stats = sstats_dict['resting-set-stats'].get(rs_id)
+      if stats is None:
+        continue
+      stats['sample_data'] = {'structures': structures,
+                              'multiplicities': multiplicities}
+      for name, c_id in complex_ids.items():
+        stats[c_id] = {'similarity_data': similarities[name]}
+
+    # Multistrand trajectories of each resting-set reaction (reactions with the
+    # same reactants share the trajectories of their Multistrand job)
+    summaries, job_data = {}, {}
+    for rsrxn_id, stats in sstats_dict['resting-set-reaction-stats'].items():
+      rsrxn = sstats_dict['resting-set-reactions'][rsrxn_id]
+      job = trajectory_job_key([sstats_dict['resting-sets'][rs_id]['name']
+                                for rs_id in rsrxn['reactants']])
+      if job not in batches['trajectories']:
+        batch_list, invalid, summary = read_trajectory_batches(con, job)
+        batch_ids = [batch_id for batch_id, _ in batch_list]
+        num_sims = sum(n for _, n in batch_list)
+        batches['trajectories'][job] = batch_list
+        if lazy:
+          sim_data = functools.partial(load_trajectories, filepath, batch_ids)
+        else:
+          sim_data = load_trajectories(filepath, batch_ids)
+        job_data[job] = (sim_data, invalid, num_sims, summary.to_dict())
+      sim_data, invalid, num_sims, summary = job_data[job]
+      stats['simulation_data'] = sim_data
+      stats['invalid_simulation_data'] = invalid
+      if lazy:
+        summaries[rsrxn_id] = {'num_sims': num_sims, 'summary': summary}
+  finally:
+    con.close()
+
+  sstats_dict['summaries'] = {'resting-set-reaction-stats': summaries}
+  sstats_dict['sqlite_batches'] = dict(batches, path = os.path.abspath(filepath))
+  return sstats_dict
+
+
+class SQLiteWriter:
+  """
+  Adds the simulation and sampling data of the jobs of a System to an SQLite
+  database. Several KinDA processes (e.g. simulating different reactions, or
+  the same reactions with different seeds) may write to the same database.
+
+  Every sync() stores the data gained since the last sync() as new batches,
+  in a single transaction (see transaction()), so that concurrent writers
+  never overwrite each other's data and a crash leaves either all or none of
+  the new data behind. Trajectories that were stored before but have changed
+  since (re-runs of timed-out trajectories, see MultistrandJob.rerun_tasks())
+  are patched into their batches as stored at the time, so that the re-runs
+  of other writers in the same batches are kept.
+
+  Jobs are identified by names that are the same in every process (see
+  trajectory_job_key()). Processes writing to the same database should be
+  restored from it, so that they share its objects and reaction tags.
+
+  Args:
+    sstats (System): The System whose data is stored.
+    db_path (str): Path of the database.
+    objects (dict, optional): The objects of sstats, as returned by
+      io_KinDA.export_objects(). Stored if the database has no objects yet.
+    resume (bool, optional): Continue the database that sstats was imported
+      from, i.e. only store data that is not in the database yet. Otherwise,
+      any existing database at db_path is replaced.
+    timeout (float, optional): Seconds to wait for other writers.
+  """
+  def __init__(self, sstats, db_path, objects = None, resume = False,
+      timeout = 60.0):
+    self._sstats = sstats
+    self.db_path = db_path
+    self.writer_id = uuid.uuid4().hex
+    self.timeout = timeout
+
+    self._ms_jobs = {}
+    for rxn in sstats._condensed_reactions:
+      job = sstats.get_stats(rxn).get_multistrandjob()
+      self._ms_jobs[job] = trajectory_job_key([rs.name for rs in rxn.reactants])
+    self._nupack_jobs = {sstats.get_stats(rs).get_nupackjob(): rs.name
+                         for rs in sstats._restingsets}
+
+    # Stored trajectory batches of each Multistrand job as lists of
+    # (first row, batch id), and the number of rows stored
+    self._segments = {job: [] for job in self._ms_jobs}
+    self._stored = {job: 0 for job in self._ms_jobs}
+    # Rows of stored trajectories that have changed since
+    self._dirty = {job: set() for job in self._ms_jobs}
+    # Multiplicities of the stored samples of each NUPACK job (see
+    # NupackSampleJob.get_new_sample_data())
+    self._stored_samples = {job: np.zeros(0, dtype = np.int64)
+                            for job in self._nupack_jobs}
+
+    loaded = getattr(sstats, 'sqlite_batches', None)
+    if (resume and loaded is not None and os.path.exists(db_path)
+        and loaded['path'] == os.path.abspath(db_path)):
+      for job, key in self._ms_jobs.items():
+        for batch_id, n in loaded['trajectories'].get(key, []):
+          self._segments[job].append((self._stored[job], batch_id))
+          self._stored[job] += n
+      for job in self._nupack_jobs:
+        self._stored_samples[job] = job.get_sample_data()[1].copy()
+      self._con = connect(db_path, timeout)
+    else:
+      # Create a new database and move it into place when it is complete
+      tmp_path = db_path + '.partial'
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      self._con = connect(tmp_path, timeout)
+      with transaction(self._con):
+        write_objects(self._con, objects)
+      self.sync()
+      self._con.close()
+      for suffix in ('-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+          os.remove(db_path + suffix)
+      os.replace(tmp_path, db_path)
+      self._con = connect(db_path, timeout)
+
+    for job in self._ms_jobs:
+      job.add_data_listener(self._mark_dirty)
+
+  def _mark_dirty(self, job, change):
+    # New rows are stored by sync() anyway, only changes to stored rows matter
+    stored = self._stored[job]
+    if 'rows' in change:
+      n = len(next(iter(change['rows'].values())))
+      self._dirty[job].update(range(change['start'], min(change['start'] + n, stored)))
+    for info in change.get('invalid', []):
+      if info['simulation_index'] < stored:
+        self._dirty[job].add(info['simulation_index'])
+    self._dirty[job].update(i for i in change.get('invalid_removed', []) if i < stored)
+
+  def sync(self):
+    """ Stores all data gained (or changed) since the last sync(). """
+    with transaction(self._con) as con:
+      for job, key in self._ms_jobs.items():
+        self._sync_trajectories(con, job, key)
+      for job, key in self._nupack_jobs.items():
+        self._sync_samples(con, job, key)
+
+  def _sync_trajectories(self, con, job, key):
+    stored, segments = self._stored[job], self._segments[job]
+    if job.total_sims == stored and not self._dirty[job]:
+      return
+    data = job.get_simulation_data()
+    invalid = job.get_invalid_simulation_data()
+    starts = [start for start, _ in segments]
+    dirty = {}
+    for row in self._dirty[job]:
+      dirty.setdefault(bisect.bisect_right(starts, row) - 1, []).append(row)
+    for i, rows in sorted(dirty.items()):
+      start, batch_id = segments[i]
+      patch_trajectories(con, batch_id, data, invalid, start, rows)
+    self._dirty[job].clear()
+    if job.total_sims > stored:
+      batch_id = insert_trajectories(con, key, self.writer_id, data, invalid,
+                                     stored, job.total_sims)
+      segments.append((stored, batch_id))
+      self._stored[job] = job.total_sims
+
+  def _sync_samples(self, con, job, key):
+    stored = self._stored_samples[job]
+    if job.total_sims == np.sum(stored):
+      return
+    names = job.complex_names
+    structures, multiplicities, similarities = job.get_new_sample_data(stored)
+    insert_samples(con, key, self.writer_id, names, structures, multiplicities,
+                   [similarities[name] for name in names])
+    self._stored_samples[job] = job.get_sample_data()[1].copy()
+
+  def close(self):
+    """ Stores all new data and stops tracking changes. """
+    self.sync()
+    for job in self._ms_jobs:
+      job.remove_data_listener(self._mark_dirty)
+    self._con.close()
@@ -1,3 +1,7 @@
+import random
+
+import numpy as np
+
 # Global DNA nucelotide groups
 dna_base_group =  {"A": "A",   "T": "T",   "C": "C",   "G": "G",
                    "R": "AG",  "Y": "CT",  "W": "AT",  "S": "CG",  "M": "AC",  "K": "GT",
@@ -29,14 +33,36 @@ base_complement = dna_base_complement
 
 
 
+# Constraints as 4-bit masks of the allowed bases, one uint8 per nucleotide
+base_bits = {"A": 1, "C": 2, "G": 4, "T": 8}
+
+def _make_lookup_tables(base_group):
+  char_to_mask = np.full(256, 255, dtype = np.uint8)
+  mask_to_char = np.zeros(16, dtype = np.uint8)
+  for key, val in base_group.items():
+    mask = sum(base_bits[b] for b in val)
+    char_to_mask[ord(key)] = mask
+    mask_to_char[mask] = ord(key)
+  return char_to_mask, mask_to_char
+
+_char_to_mask, _mask_to_char = _make_lookup_tables(base_group)
+# Complement of each mask (swaps the bits of A and T, and of C and G)
+_mask_complement = np.array([((m & 1) << 3) | ((m & 8) >> 3) | ((m & 2) << 1) | ((m & 4) >> 1)
+                             for m in range(16)], dtype = np.uint8)
+
+def sequence_mask(sequence):
+  """
+  Returns the constraints of the given sequence as a uint8 NumPy array with
+  the bits of the allowed bases (see base_bits) set for each nucleotide.
+  """
+  chars = np.frombuffer(str(sequence).encode('ascii'), dtype = np.uint8)
+  mask = _char_to_mask[chars]
+  if np.any(mask == 255):
+    raise ValueError("Invalid sequence constraints {}".format(sequence))
+  return mask
+
 def base_group_intersect(g1, g2):
-  bases1 = set(base_group[g1])
-  bases2 = set(base_group[g2])
-  intersection = bases1.intersection(bases2)
-  for key, val in list(base_group.items()):
-    if intersection == set(val):
-      return key
-  return "x"
+  return chr(_mask_to_char[sequence_mask(g1)[0] & sequence_mask(g2)[0]])
   
 
 class Sequence(str):
@@ -44,19 +70,69 @@ class Sequence(str):
   The Sequence class represents a set of constraints on a sequence of
   nucleotides, with common operations provided for finding the complement or
   intersection of a constraints sequence. A Sequence object is immutable.
+
+  The operations work on the constraints as bit masks (see mask), which are
+  computed once per Sequence.
   """
+  @classmethod
+  def from_mask(cls, mask):
+    """ Returns the Sequence with the given constraints (see mask). """
+    seq = cls(_mask_to_char[mask].tobytes().decode('ascii'))
+    seq._mask = mask
+    return seq
+
+  @property
+  def mask(self):
+    """ The constraints of this sequence (see sequence_mask()). """
+    if '_mask' not in self.__dict__:
+      self._mask = sequence_mask(self)
+    return self._mask
+
   @property
   def complement(self):
-    c = "".join([base_complement[n] for n in reversed(self)])
-    return Sequence(c)
+    return Sequence.from_mask(_mask_complement[self.mask[::-1]])
     
   def intersection(self, other):
     if len(self) != len(other):
       print(f"Cannot intersect constraint sequences {self} and {other}")
       return Sequence("")
       
-    intersected = "".join([base_group_intersect(g1, g2) for g1, g2 in zip(self, other)])
-    return Sequence(intersected)
+    other_mask = other.mask if isinstance(other, Sequence) else sequence_mask(other)
+    return Sequence.from_mask(self.mask & other_mask)
+
+  @property
+  def is_satisfiable(self):
+    """ True iff every nucleotide allows at least one base (no 'x'). """
+    return bool(np.all(self.mask))
+
+  def random_realisations(self, num, base_probs = None, rng = None):
+    """
+    Returns a list of num random sequences satisfying these constraints, where
+    each nucleotide is one of its allowed bases with probability proportional
+    to base_probs (a dict of the probability of each base). rng is a NumPy
+    Generator, which is seeded from the random module if not given.
+    """
+    if base_probs == None:
+      base_probs = {'A': 0.2, 'T': 0.2, 'C': 0.3, 'G': 0.3}
+    if rng is None:
+      rng = np.random.default_rng(random.getrandbits(64))
+
+    # Cumulative probabilities of the bases allowed by each mask
+    bases = sorted(base_bits, key = base_bits.get)
+    weights = np.array([[base_probs[b] if m & base_bits[b] else 0.0 for b in bases]
+                        for m in range(16)])
+    cumulative = np.cumsum(weights, axis = 1)[self.mask]
+    totals = cumulative[:, -1]
+    assert np.all(totals > 0), "Cannot obtain sequence with constraint " + self
+
+    draws = rng.random((num, len(self))) * totals
+    chosen = np.minimum((draws[:, :, None] >= cumulative).sum(axis = 2), len(bases) - 1)
+    chars = np.frombuffer("".join(bases).encode('ascii'), dtype = np.uint8)[chosen]
+    return [row.tobytes().decode('ascii') for row in chars]
 
   def __add__(self, other):
     return self.intersection(other)
+
+  def __reduce__(self):
+    # Pickled without the mask
+    return (Sequence, (str(self),))
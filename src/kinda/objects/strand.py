@@ -39,6 +39,9 @@ class Strand:
     # Assign id
     self.id = Strand.id_counter
     Strand.id_counter += 1
+
+    self._base_domains_generation = None
+    self._sequence_generation = None
     
     # Assign name
     if 'name' in kargs: self.name = kargs['name']
@@ -73,7 +76,11 @@ class Strand:
     The sequence constraints associated with this strand, computing it as
     necessary from the domains.
     """
-    return Sequence("".join([d.sequence for d in self.base_domains()]))
+    generation = (Domain.hierarchy_generation, Domain.sequence_generation)
+    if self._sequence_generation != generation:
+      self._sequence_cache = Sequence("".join([d.sequence for d in self.base_domains_tuple()]))
+      self._sequence_generation = generation
+    return self._sequence_cache
 
   @sequence.setter
   def sequence( self, new_seq ):
@@ -83,8 +90,9 @@ class Strand:
     of all constraints assigned to the domain.
     """
     assert len(new_seq) == self._length
-    for d in self.base_domains():
+    for d in self.base_domains_tuple():
       d._sequence = Sequence("N" * d._length)
+    Domain.sequence_generation += 1
     self.restrict_sequence(new_seq)
 
   def restrict_sequence(self, constraints):
@@ -94,10 +102,11 @@ class Strand:
     """
     assert len(constraints) == self._length
     i = 0
-    for d in self.base_domains():
+    for d in self.base_domains_tuple():
       subconstraints = constraints[i : i+d._length]
       d._sequence = d._sequence.intersection(subconstraints)
       i += d._length
+    Domain.sequence_generation += 1
   
   ## Complementarity and equivalence
   @property
@@ -145,14 +154,25 @@ class Strand:
     """
     Returns the unique list of non-composite domains that compose this strand.
     """
-    return list(self.base_domains_iter())
+    return list(self.base_domains_tuple())
 
   def base_domains_iter(self):
     """
     Returns an interator for the unique list of non-composite domains composing
     this strand.
     """
-    return iter(based for d in self._domains for based in d.base_domains())
+    return iter(self.base_domains_tuple())
+
+  def base_domains_tuple(self):
+    """
+    Returns the non-composite domains composing this strand as a tuple, which
+    is stored until the domain hierarchy changes (see Domain.subdomains).
+    """
+    if self._base_domains_generation != Domain.hierarchy_generation:
+      self._base_domains = tuple(based for d in self._domains
+                                 for based in d.base_domains_tuple())
+      self._base_domains_generation = Domain.hierarchy_generation
+    return self._base_domains
 
   ## (In)equality
   def __eq__(self, other):
@@ -171,7 +191,7 @@ class Strand:
     return self.base_domains().__lt__(other.base_domains())
 
   def __hash__(self):
-    return hash(tuple(self.base_domains_iter()))
+    return hash(self.base_domains_tuple())
 
   ## Output
   def __str__(self):
@@ -196,6 +216,8 @@ class ComplementaryStrand(Strand):
     """
     self.id = complemented_strand.id
     self._complement = complemented_strand
+    self._base_domains_generation = None
+    self._sequence_generation = None
 
   ## Basic properties
   @property
@@ -225,7 +247,11 @@ class ComplementaryStrand(Strand):
     Returns the Sequence object for this ComplementaryStrand. This is the
     complementary-reverse of the sequence on its complement.
     """
-    return self._complement.sequence.complement
+    generation = (Domain.hierarchy_generation, Domain.sequence_generation)
+    if self._sequence_generation != generation:
+      self._sequence_cache = self._complement.sequence.complement
+      self._sequence_generation = generation
+    return self._sequence_cache
 
   @sequence.setter
   def sequence(self, new_seq):
@@ -278,13 +304,16 @@ class ComplementaryStrand(Strand):
     """
     return [d.complement for d in reversed(self._complement.domains)]
 
-  def base_domains(self):
+  def base_domains_tuple(self):
     """
-    Returns the unique list of non-composite domains for this
-    ComplementaryStrand. This is complementary-reverse of the list for this
-    strand's complement.
+    Returns the non-composite domains for this ComplementaryStrand. This is
+    complementary-reverse of those of this strand's complement.
     """
-    return [d.complement for d in reversed(self._complement.base_domains())]
+    if self._base_domains_generation != Domain.hierarchy_generation:
+      self._base_domains = tuple(d.complement for d in
+                                 reversed(self._complement.base_domains_tuple()))
+      self._base_domains_generation = Domain.hierarchy_generation
+    return self._base_domains
     
   ## (In)equality
   def __eq__(self, other):
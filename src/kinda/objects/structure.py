@@ -14,53 +14,72 @@ in the complex.
 
 from functools import total_ordering
 
+import numpy as np
+
+# Entries of pair tables (see Structure.pair_table) for nucleotides without
+# a binding partner
+UNBOUND = -1
+UNSPECIFIED = -2
+
 #####################
 # PARSING UTILITIES #
 #####################
     
-def parse_dotparen(structure):
+def dotparen_pair_table(structure):
   """
-  Parses the given dot-paren structure, returning a dict of the bound
-  nucleotides.
+  Returns the pair table (see Structure.pair_table) of the given
+  nucleotide-level dot-paren structure, without creating a Structure.
   """
-  strand_structs = structure.split("+")
-  
-  bond_dict = {}
+  table = []
   stack = []
-  for strand_num, strand_struct in enumerate(strand_structs):
-    i = 0
-    for char in strand_struct:
-      loc = (strand_num, i)
-      if char == '.':  # nucleotide is unbound
-        bond_dict[loc] = None
-        i += 1
-      elif char == '(':  # nucleotide is bound
-        stack.append(loc)
-        i += 1
-      elif char == ')':  # nucleotide is bound to top element of stack
-        j = stack.pop()
-        bond_dict[loc] = j
-        bond_dict[j] = loc
-        i += 1
-      elif char == '*' or char == '?':  # nucleotide binding is unspecified
-        bond_dict[loc] = '?'
-        i += 1
-      elif char != ' ':
+  for char in structure:
+    if char == '.':  # nucleotide is unbound
+      table.append(UNBOUND)
+    elif char == '(':  # nucleotide is bound
+      stack.append(len(table))
+      table.append(UNBOUND)
+    elif char == ')':  # nucleotide is bound to top element of stack
+      if not stack:
         raise ValueError("Invalid dot-paren structure.")
+      j = stack.pop()
+      table[j] = len(table)
+      table.append(j)
+    elif char == '*' or char == '?':  # nucleotide binding is unspecified
+      table.append(UNSPECIFIED)
+    elif char != '+' and char != ' ':
+      raise ValueError("Invalid dot-paren structure.")
+  if stack:
+    raise ValueError("Invalid dot-paren structure.")
+  return np.array(table, dtype = np.int32)
 
-  return bond_dict
+
+def check_dotparen_balanced(structure):
+  """
+  Raises a ValueError if the given dot-paren structure has unmatched
+  parentheses, without parsing it into a pair table.
+  """
+  chars = np.frombuffer(structure.encode(), dtype = np.uint8)
+  depth = np.cumsum((chars == ord('(')).astype(np.int64) - (chars == ord(')')))
+  if len(depth) > 0 and (depth.min() < 0 or depth[-1] != 0):
+    raise ValueError("Invalid dot-paren structure.")
 
   
-def parse_strandlist(structure):
+def strandlist_pair_table(structure, offsets):
   """
-  Parses the given strand-list structure specification, returning a dict of the
-  bonds in the structure.
+  Returns the pair table (see Structure.pair_table) of the given
+  nucleotide-level strand-list structure, where offsets are the numbers of
+  the first nucleotide of each strand.
   """
-  bond_dict = {}
-  for strand_num, strand_struct in enumerate(structure):
-    for i, elem in enumerate(strand_struct):
-      bond_dict[(strand_num, i)] = elem
-  return bond_dict
+  table = []
+  for strand_struct in structure:
+    for elem in strand_struct:
+      if elem == None:
+        table.append(UNBOUND)
+      elif elem == '?':
+        table.append(UNSPECIFIED)
+      else:
+        table.append(offsets[elem[0]] + elem[1])
+  return np.array(table, dtype = np.int32)
 
     
 def expand_domain_dotparen(structure, strands):
@@ -108,7 +127,16 @@ class Structure:
   A Structure object represents how the nucleotides in a complex are bound to
   each other. It may be input and output in a variety of forms, including
   dot-paren notation and strand-list notation (for Peppercorn).
+
+  The binding is stored as a pair table (see pair_table) of the strands in
+  the order in which the structure was set. Dot-paren structures are only
+  parsed when the binding is first needed, and rotating the strands remaps
+  the pair table rather than parsing the structure again.
   """
+  __slots__ = ('_strands', '_strand_order', '_source', '_table', '_offsets',
+               '_pseudoknotted', '_dotparen', '_strandlist', '_pair_table',
+               '_pair_offsets', '_domain_masks')
+
   def __init__(self, *args, **kargs):
     """
     Initialization:
@@ -122,9 +150,6 @@ class Structure:
     self._strand_order = list(range(len(self._strands)))
     
     self.structure = kargs['structure']
-
-    self._dotparen = None
-    self._strandlist = None
       
   @property
   def strands(self):
@@ -145,20 +170,28 @@ class Structure:
     """
     Sets this structure with a dot-paren string or strand-list representation.
     """
-    self._dotparen = None # reset these as they are no longer valid
-    self._strandlist = None
+    # The structure refers to the (possibly rotated) strands, so we need to
+    # finalize this rotation.
+    self._strands = self.strands
+    self._strand_order = list(range(len(self._strands)))
+    self._reset()
 
-    domains_per_strand = [len(s.base_domains()) for s in self.strands]
-    nucleos_per_strand = [s.length for s in self.strands]
+    offsets = [0]
+    for s in self._strands:
+      offsets.append(offsets[-1] + s.length)
+    self._offsets = np.array(offsets, dtype = np.int64)
+
+    domains_per_strand = [len(s.base_domains()) for s in self._strands]
+    nucleos_per_strand = [s.length for s in self._strands]
     if isinstance(struct, list):  ## Assume strand-list notation
       # determine if domain- or nucleotide-level specification
       elems_per_strand = [len(s) for s in struct]
       if elems_per_strand == domains_per_strand:  ## Assume domain-level specification
-        struct = expand_domain_strandlist(struct, self.strands)
+        struct = expand_domain_strandlist(struct, self._strands)
       else:
         assert elems_per_strand == nucleos_per_strand, "Invalid strand-list structure."
-      self._bond_dict = parse_strandlist(struct)
-      self._pseudoknotted = False
+      self._source = None
+      self._table = strandlist_pair_table(struct, offsets)
     else:  ## Assume dot-paren notation
       # determine if domain- or nucleotide-level specification
       chars_per_strand = [elem.count("(") +
@@ -166,17 +199,32 @@ class Structure:
                           elem.count(".") +
                           elem.count("*") for elem in struct.split("+")]
       if chars_per_strand == domains_per_strand:  ## Assume domain-level specification
-        struct = expand_domain_dotparen(struct, self.strands)
+        struct = expand_domain_dotparen(struct, self._strands)
       else:
         ## Check valid nucleotide-level specification
         assert chars_per_strand == nucleos_per_strand, "Invalid dot-paren structure."
-      self._bond_dict = parse_dotparen(struct)
-      self._pseudoknotted = self.check_pseudoknotted()
-      
-    # Since the structure now refers to the rotated strands, we need
-    # to finalize this rotation.
-    self._strands = self.strands
-    self._strand_order = list(range(len(self._strands)))
+      # Parsed on first use (see _parse()), but checked for unmatched
+      # parentheses right away
+      check_dotparen_balanced(struct)
+      self._source = struct.replace(" ", "").replace("?", "*")
+      self._table = None
+      self._dotparen = self._source
+    # Dot-paren structures cannot express pseudoknots, and strand-list
+    # structures are not checked
+    self._pseudoknotted = False
+
+  def _reset(self):
+    # Drops everything that depends on the strand order
+    self._dotparen = None
+    self._strandlist = None
+    self._pair_table = None
+    self._pair_offsets = None
+    self._domain_masks = None
+
+  def _parse(self):
+    if self._table is None:
+      self._table = dotparen_pair_table(self._source)
+    return self._table
     
   @property
   def pseudoknotted(self):
@@ -188,17 +236,57 @@ class Structure:
     return self._pseudoknotted
     
   ## Utility functions
+  @property
+  def pair_table(self):
+    """
+    Returns this structure as a pair table: an int32 NumPy array with an entry
+    for each nucleotide, numbered consecutively over all strands in their
+    current order, which is the number of the nucleotide it is bound to, or
+    UNBOUND, or UNSPECIFIED.
+    """
+    if self._pair_table is not None:  return self._pair_table
+
+    table = self._parse()
+    order = self._strand_order
+    if order == sorted(order):
+      self._pair_table, self._pair_offsets = table, self._offsets
+      return table
+
+    # Map the number of each nucleotide to its number in the current order
+    lengths = np.diff(self._offsets)
+    offsets = np.concatenate(([0], np.cumsum(lengths[order])))
+    position = np.empty(len(table), dtype = np.int32)
+    for new_num, num in enumerate(order):
+      position[self._offsets[num]:self._offsets[num+1]] = np.arange(
+        offsets[new_num], offsets[new_num+1])
+    rotated = np.empty_like(table)
+    rotated[position] = np.where(table >= 0, position[np.maximum(table, 0)], table)
+
+    self._pair_table, self._pair_offsets = rotated, offsets
+    return rotated
+
+  @property
+  def strand_offsets(self):
+    """
+    Returns the number of the first nucleotide of each strand in the pair
+    table (see pair_table), followed by the total number of nucleotides.
+    """
+    self.pair_table
+    return self._pair_offsets
+
   def bound_to(self, strand_num, index):
     """
     Returns the strand number and index of the nucleotide bound to the specified
     nucleotide, or None if it is unbound.
     """
-    real_strand_num = self._strand_order[strand_num]
-    real_bound_info = self._bond_dict[(real_strand_num, index)]
-    if real_bound_info == None or real_bound_info == '?':
-      return real_bound_info
-    else:
-      return (self._strand_order.index(real_bound_info[0]), real_bound_info[1])
+    offsets = self.strand_offsets
+    bound = int(self.pair_table[offsets[strand_num] + index])
+    if bound == UNBOUND:
+      return None
+    elif bound == UNSPECIFIED:
+      return '?'
+    bound_strand = int(np.searchsorted(offsets, bound, side = 'right')) - 1
+    return (bound_strand, bound - int(offsets[bound_strand]))
     
   def to_dotparen(self):
     """
@@ -209,57 +297,71 @@ class Structure:
     assert not self._pseudoknotted, "Cannot express pseudoknotted structure with dot-paren."
     if self._dotparen is not None:  return self._dotparen
 
-    dotparen = ""
-    for strand_num, strand in enumerate(self.strands):
-      for i in range(strand.length):
-        bound = self.bound_to(strand_num, i)
-        if bound == None:
-          dotparen += '.'
-        elif bound == '?':
-          dotparen += '*'
-        elif (strand_num, i) < bound:
-          dotparen += '('
-        else:
-          dotparen += ')'
-      dotparen += '+'
-
-    self._dotparen = dotparen[:-1]
+    table = self.pair_table
+    chars = np.full(len(table), ord(')'), dtype = np.uint8)
+    chars[table == UNBOUND] = ord('.')
+    chars[table == UNSPECIFIED] = ord('*')
+    chars[table > np.arange(len(table))] = ord('(')
+    chars = np.insert(chars, self.strand_offsets[1:-1], ord('+'))
+
+    self._dotparen = chars.tobytes().decode('ascii')
     return self._dotparen
-    
+
   def to_strandlist(self):
     """
     Returns a representation of this structure in strand-list notation.
     """
     if self._strandlist is not None:  return self._strandlist
 
-    strandlist = []
-    for strand_num, strand in enumerate(self.strands):
-      strand_struct = []
-      for i in range(strand.length):
-        strand_struct.append(self.bound_to(strand_num, i))
-      strandlist.append(strand_struct)
+    table = self.pair_table
+    offsets = self.strand_offsets
+    bound_strands = (np.searchsorted(offsets, table, side = 'right') - 1).tolist()
+    bound_indices = (table - offsets[np.maximum(bound_strands, 0)]).tolist()
+    elems = [None if bound == UNBOUND else '?' if bound == UNSPECIFIED
+             else (strand, index)
+             for bound, strand, index in zip(table.tolist(), bound_strands, bound_indices)]
+    strandlist = [elems[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
 
     self._strandlist = strandlist
     return strandlist
+
+  @property
+  def domain_masks(self):
+    """
+    Returns a boolean NumPy array with a row for each base domain of each
+    strand (in order), which marks the nucleotides of the domain and the
+    nucleotides bound to it in this structure (see pair_table).
+    """
+    if self._domain_masks is not None:  return self._domain_masks
+
+    table = self.pair_table
+    domains = [d for strand in self.strands for d in strand.base_domains()]
+    masks = np.zeros((len(domains), len(table)), dtype = bool)
+    start = 0
+    for row, domain in enumerate(domains):
+      end = start + domain.length
+      partners = table[start:end]
+      masks[row, start:end] = True
+      masks[row, partners[partners >= 0]] = True
+      start = end
+
+    self._domain_masks = masks
+    return masks
     
   def check_pseudoknotted(self):
     """
     Checks if the structure may have pseudoknots (when strands are in their
     current order). This is not a technical pseudoknot, which would require
     checking other strand orders, but is suitable for most purposes.
-
-    There may be a more efficient way to do this...
     """
     stack = []
-    for strand_num, strand in enumerate(self.strands):
-      for i in range(strand.length):
-        bound = self.bound_to(strand_num, i)
-        if bound != None and bound != '?' and (strand_num, i) < bound:
-          stack.append((strand_num, i))
-        elif bound != None and bound != '?' and bound < (strand_num, i):
-          if bound != stack.pop():
-            # There's a pseudoknot!
-            return True
+    for i, bound in enumerate(self.pair_table.tolist()):
+      if bound > i:
+        stack.append(i)
+      elif 0 <= bound < i:
+        if bound != stack.pop():
+          # There's a pseudoknot!
+          return True
     return False
     
   ## Modifiers
@@ -270,8 +372,9 @@ class Structure:
     """
     amount = amount % len(self._strands)
     self._strand_order = self._strand_order[amount:] + self._strand_order[:amount]
-    self._dotparen = None
-    self._strandlist = None
+    self._reset()
+    if self._strand_order == sorted(self._strand_order) and self._source is not None:
+      self._dotparen = self._source
 
   def __eq__(self, other):
     assert isinstance(other, self.__class__)
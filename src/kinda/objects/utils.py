@@ -1,25 +1,15 @@
 import itertools as it
 
+import numpy as np
+
+from .structure import UNSPECIFIED
+
 ## Sequence utilities
                   
 def random_sequence(sequence, base_probs = None):
-  import random
-  from .sequence import base_group
-  def choose_base(bases, base_probs):
-    prob_sum = sum([base_probs[b] for b in bases])
-    assert prob_sum > 0, "Cannot obtain sequence with constraint " + sequence
-    
-    n = random.uniform(0, prob_sum)
-    for b in bases:
-      n -= base_probs[b]
-      if n <= 0: return b
-    
-  if base_probs == None:
-    base_probs = {'A': 0.2, 'T': 0.2, 'C': 0.3, 'G': 0.3}
-    
-  return "".join([choose_base(base_group[b], base_probs) for b in sequence])
+  from .sequence import Sequence
+  return Sequence(sequence).random_realisations(1, base_probs)[0]
   
-## Functions for Domain objects
 def split_domain(domain, pos):  
   """ Splits a domain into two subdomains. """
   from .domain import Domain
@@ -33,106 +23,219 @@ def split_domain(domain, pos):
 
 
 def equate_domains(domains):
-  """This is pretty slow and inefficient."""
-  from .domain import Domain
-  
-  def update_subdomains_list(subdomains):
-    new_subdomains = []
-    for i, d in enumerate(subdomains):
-      if d.is_composite:
-        new_subdomains.extend(d.subdomains)
+  """
+  Constrains the given domains to have the same sequence, by making their
+  base domains composites of shared base domains. The shared base domains
+  are as long as possible, and their sequence constraints are the
+  intersection of those of all nucleotides they stand for.
+
+  The nucleotides of the base domains are merged into equivalence classes
+  with a union-find structure, in which a nucleotide may also be equated with
+  the complement of another (e.g. when a domain is equated with its
+  complement). A base domain is then cut wherever its nucleotides are not
+  followed by the same nucleotides everywhere else in their classes, and the
+  hierarchy of the pieces between cuts is built once at the end.
+  """
+  from .domain import Domain, ComplementaryDomain
+  from .sequence import Sequence, _mask_complement
+
+  # Number the nucleotides of the (non-complementary) base domains. Each
+  # domain is a list of nucleotides with a parity that is 1 for nucleotides
+  # of a complement.
+  base_domains, offsets, expansions = [], {}, []
+  num_nucleotides = 0
+  for domain in domains:
+    expansion = []
+    for d in domain.base_domains_tuple():
+      orig = d.complement if isinstance(d, ComplementaryDomain) else d
+      if id(orig) not in offsets:
+        offsets[id(orig)] = num_nucleotides
+        base_domains.append(orig)
+        num_nucleotides += orig.length
+      nucleotides = range(offsets[id(orig)], offsets[id(orig)] + orig.length)
+      if orig is d:
+        expansion.extend((n, 0) for n in nucleotides)
       else:
-        new_subdomains.append(d)
-    return new_subdomains
-  def equate_coincident_domains(domain1, domain2):
-    assert domain1.length == domain2.length
-    
-    # Make a new Domain with sequence from both domains
-    new_domain = Domain(name = "~(" + min(domain1.name, domain2.name) + ")",
-                        sequence = domain1.sequence)
-    new_domain.restrict_sequence(domain2.sequence)
-    
-    # Redirect domain1 and domain2 to point to new domain
-    domain1.subdomains = [new_domain]
-    domain2.subdomains = [new_domain]
-  
-  domains = list(domains)
-  index = 1
-  while index < len(domains):
-    domains1 = domains[index-1].base_domains()
-    domains2 = domains[index].base_domains()
-    
-    # Iterate through each the sub-domain lists for each Domain object,
-    # splitting up larger domain objects as needed
-    while len(domains1) != 0:
-      d1 = domains1[0]
-      d2 = domains2[0]
-      if d1.length > d2.length:
-        # The first subdomain of the first Domain is longer, so split it
-        split_domain(d1, d2.length)
-        equate_coincident_domains(d1.subdomains[0], d2)
-      elif d2.length > d1.length:
-        # The first subdomain of the second Domain is longer, so split it
-        split_domain(d2, d1.length)
-        equate_coincident_domains(d2.subdomains[0], d1)
-      elif d1.complementary_to(d2):
-        assert(d1.length % 2 == 0), "Unable to equate odd-length %s with its complement." % d1
-        split_domain(d1, d1.length / 2) # Split sequence in half, make the halves complementary
-        equate_coincident_domains(d1.subdomains[0], d1.subdomains[1].complement)
-      elif d1 != d2: # lengths are equal but they are not the same domain
-        # The domains coincide, so make them redirect to a common domain
-        equate_coincident_domains(d1, d2)
-        
-      domains1 = update_subdomains_list(domains1)[1:]
-      domains2 = update_subdomains_list(domains2)[1:]
-        
-    index+=1
-  
-    
+        expansion.extend((n, 1) for n in reversed(nucleotides))
+    expansions.append(expansion)
+  if len(expansions) < 2:
+    return
+
+  # Union-find, where parity[n] is 1 if nucleotide n is the complement of
+  # parent[n]
+  parent = list(range(num_nucleotides))
+  parity = [0] * num_nucleotides
+  size = [1] * num_nucleotides
+  def find(n):
+    path = []
+    while parent[n] != n:
+      path.append(n)
+      n = parent[n]
+    p = 0
+    for m in reversed(path):
+      p ^= parity[m]
+      parity[m] = p
+      parent[m] = n
+    return n
+
+  for expansion in expansions[1:]:
+    assert len(expansion) == len(expansions[0]), "Cannot equate domains of different lengths."
+    for (n1, p1), (n2, p2) in zip(expansions[0], expansion):
+      r1, r2 = find(n1), find(n2)
+      p = parity[n1] ^ parity[n2] ^ p1 ^ p2
+      if r1 == r2:
+        assert p == 0, "Unable to equate a nucleotide of {} with its complement.".format(
+          [d.name for d in domains])
+        continue
+      if size[r1] < size[r2]:
+        r1, r2 = r2, r1
+      parent[r2] = r1
+      parity[r2] = p
+      size[r1] += size[r2]
+  for n in range(num_nucleotides):
+    find(n)
+
+  # starts[n] is True if a new base domain starts at nucleotide n
+  starts = [False] * (num_nucleotides + 1)
+  for d in base_domains:
+    starts[offsets[id(d)]] = True
+  starts[num_nucleotides] = True
+
+  members = {}
+  for n, c in enumerate(parent):
+    members.setdefault(c, []).append(n)
+
+  def neighbours(n):
+    # The (class, parity) of the nucleotides after and before n, in the
+    # orientation of its class, or None at a cut
+    after = None if starts[n+1] else (parent[n+1], parity[n] ^ parity[n+1])
+    before = None if starts[n] else (parent[n-1], parity[n] ^ parity[n-1])
+    return (after, before) if parity[n] == 0 else (before, after)
+
+  def needs_cut(c, neighbour_set):
+    return len(neighbour_set) > 1 or any(nb is not None and nb[0] == c
+                                         for nb in neighbour_set)
+
+  # Cut until the nucleotides of each class have the same neighbours
+  queue, queued = list(members), set(members)
+  while queue:
+    c = queue.pop()
+    queued.discard(c)
+    afters, befores = set(), set()
+    for n in members[c]:
+      after, before = neighbours(n)
+      afters.add(after)
+      befores.add(before)
+    cuts = []
+    if needs_cut(c, afters):
+      cuts += [n + 1 if parity[n] == 0 else n for n in members[c]]
+    if needs_cut(c, befores):
+      cuts += [n if parity[n] == 0 else n + 1 for n in members[c]]
+    for pos in cuts:
+      if not starts[pos]:
+        starts[pos] = True
+        for affected in (parent[pos-1], parent[pos]):
+          if affected not in queued:
+            queued.add(affected)
+            queue.append(affected)
+
+  # Collect the pieces of each base domain. The first piece with a class
+  # defines the orientation of the new base domain for that class.
+  piece_of = {}
+  new_pieces = []
+  domain_pieces = []
+  for d in base_domains:
+    offset = offsets[id(d)]
+    pieces = []
+    i = offset
+    while i < offset + d.length:
+      j = i + 1
+      while not starts[j]:
+        j += 1
+      if parent[i] not in piece_of:
+        num = len(new_pieces)
+        new_pieces.append({'classes': [(parent[n], parity[n]) for n in range(i, j)],
+                           'labels': []})
+        for k, n in enumerate(range(i, j)):
+          assert parent[n] not in piece_of
+          piece_of[parent[n]] = (num, k, parity[n])
+        orientation = 0
+      else:
+        num, k, p = piece_of[parent[i]]
+        orientation = parity[i] ^ p
+        assert k == (0 if orientation == 0 else len(new_pieces[num]['classes']) - 1)
+      if i == offset and j == offset + d.length:
+        label = d.name
+      else:
+        label = "{0}[{1}:{2}]".format(d.name, i - offset, j - offset)
+      new_pieces[num]['labels'].append(label + "*" * orientation)
+      pieces.append((num, orientation))
+      i = j
+    domain_pieces.append((d, pieces))
+
+  # Intersect the constraints of the nucleotides of each class
+  masks = np.concatenate([d._sequence.mask for d in base_domains])
+  masks = np.where(np.array(parity, dtype = bool), _mask_complement[masks], masks)
+  class_masks = np.full(num_nucleotides, 15, dtype = np.uint8)
+  np.bitwise_and.at(class_masks, np.array(parent), masks)
+
+  # Build the hierarchy
+  new_domains = {}
+  for d, pieces in domain_pieces:
+    if len(pieces) == 1 and len(new_pieces[pieces[0][0]]['labels']) == 1:
+      continue  # d is not equated with anything
+    subdomains = []
+    for num, orientation in pieces:
+      if num not in new_domains:
+        piece = new_pieces[num]
+        mask = np.array([_mask_complement[class_masks[c]] if p else class_masks[c]
+                         for c, p in piece['classes']], dtype = np.uint8)
+        if len(piece['labels']) > 1:
+          name = "~(" + min(piece['labels']) + ")"
+        else:
+          name = piece['labels'][0]
+        new_domains[num] = Domain(name = name, sequence = Sequence.from_mask(mask))
+      subdomains.append(new_domains[num] if orientation == 0
+                        else new_domains[num].complement)
+    d.subdomains = subdomains
+
+
 ## Functions for Complex objects
+# The defects are computed on pair tables (see Structure.pair_table), so that
+# the structures of many samples can be compared with a target at once.
+
 def defect(complex, structure):
   """ Calculates the defect of the complex's structure against the given
   target structure. The defect is the number of nucleotides bound
   differently from the target. """
-  defect = 0
-  for strand_num, strand in enumerate(complex.strands):
-    for i in range(strand.length):
-      if (complex.bound_to(strand_num, i) != structure.bound_to(strand_num, i)
-          and structure.bound_to(strand_num, i) != '?'):
-        defect += 1
-  
-  return defect
+  target = structure.pair_table
+  return int(np.count_nonzero((complex.structure.pair_table != target)
+                              & (target != UNSPECIFIED)))
 
   
 def domain_defect(complex, strand_num, domain_num, structure):
-  """ Calculates the defect of the binding of the given domain in
+  """ Calculates the defect of the binding of the given (base) domain in
   the complex against the domain's expected binding given in the
   specified target structure. If the domain is not completely bound
   or unbound, the results are not very meaningful.
   The defect is calculated as a fraction of the domain's length."""
-  from .structure import Structure
-  
-  strandlist = [lst[:] for lst in structure.to_strandlist()]
-  strands = structure.strands
-
-  domain_start = sum([d.length
-                        for d
-                        in strands[strand_num].domains[:domain_num]])
-  domain_end = domain_start + strands[strand_num].domains[domain_num].length
-  n = 0
-  for strand_n, strand_struct in enumerate(strandlist):
-    for i, bound in enumerate(strand_struct):
-      is_domain = (strand_n == strand_num and domain_start <= i < domain_end)
-      is_bound_to_domain = (bound != None and bound != '?'
-                           and bound[0] == strand_num
-                           and domain_start <= bound[1] < domain_end)
-      if not is_domain and not is_bound_to_domain:
-        strandlist[strand_n][i] = '?'
-      else:
-        n += 1
-        
-  new_struct = Structure(structure = strandlist, strands = structure.strands)
-  return defect(complex, new_struct) / float(n)
+  row = sum(len(s.base_domains()) for s in structure.strands[:strand_num])
+  defects = domain_defects(complex.structure.pair_table[np.newaxis], structure)
+  return defects[0, row + domain_num]
+
+
+def domain_defects(pair_tables, structure):
+  """ Returns the domain defect (see domain_defect()) of each of the given
+  pair tables (one row per structure) for each base domain of the target
+  structure, as an array with one row per structure and one column per
+  domain (see Structure.domain_masks). Domains of length 0 have defect 0. """
+  target = structure.pair_table
+  masks = structure.domain_masks
+  mismatch = (np.asarray(pair_tables) != target) & (target != UNSPECIFIED)
+  sizes = np.sum(masks, axis = 1)
+  defects = mismatch.astype(float) @ masks.T.astype(float)
+  return np.divide(defects, sizes, out = np.zeros_like(defects),
+                   where = (sizes > 0))
 
   
 def max_domain_defect(complex, structure):
@@ -140,14 +243,40 @@ def max_domain_defect(complex, structure):
   complex when compared against the given structure. The defects are
   calculated as decimal fractions of the length of each domain, to
   make the defects comparable across different domains. """
-  domains = complex.base_domains()
-  max_defect = 0
-  for strand_num, strand_domains in enumerate(domains):
-    for domain_num, domain in enumerate(strand_domains):
-      if domain.length > 0:
-        defect = domain_defect(complex, strand_num, domain_num, structure)
-        max_defect = max(defect, max_defect)
-  return max_defect
+  return float(max_domain_defects(complex.structure.pair_table[np.newaxis],
+                                  structure)[0])
+
+
+def max_domain_defects(pair_tables, structure):
+  """ Returns the maximum domain defect (see max_domain_defect()) of each
+  of the given pair tables (one row per structure, e.g. from
+  structure.dotparen_pair_table()) against the target structure. """
+  return np.max(domain_defects(pair_tables, structure), axis = 1, initial = 0.0)
+
+
+def max_domain_defects_to(complex, pair_tables):
+  """ Returns max_domain_defect(complex, s) for the structure s of each of
+  the given pair tables (one row per structure of the complex's strands),
+  i.e. the maximum domain defect of the complex against many targets. """
+  pair_tables = np.atleast_2d(np.asarray(pair_tables))
+  num = len(pair_tables)
+  lengths = [d.length for s in complex.strands for d in s.base_domains_tuple()]
+  num_domains = len(lengths)
+  # Domain of each nucleotide and of its partner in each target
+  own = np.broadcast_to(np.repeat(np.arange(num_domains), lengths), pair_tables.shape)
+  partner = np.where(pair_tables >= 0, own[0][np.maximum(pair_tables, 0)], -1)
+  other = (partner >= 0) & (partner != own)
+  mismatch = ((complex.structure.pair_table != pair_tables)
+              & (pair_tables != UNSPECIFIED)).astype(float)
+
+  rows = np.arange(num)[:, np.newaxis] * num_domains
+  size = num * num_domains
+  sizes = (np.bincount((rows + own).ravel(), minlength = size)
+           + np.bincount((rows + partner)[other], minlength = size))
+  defects = (np.bincount((rows + own).ravel(), mismatch.ravel(), minlength = size)
+             + np.bincount((rows + partner)[other], mismatch[other], minlength = size))
+  defects = np.divide(defects, sizes, out = np.zeros(size), where = (sizes > 0))
+  return np.max(defects.reshape(num, num_domains), axis = 1, initial = 0.0)
   
   
 ## Functions for Macrostates
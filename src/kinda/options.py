@@ -10,6 +10,18 @@ kinda_params = {
   'enable_unimolecular_reactions': False,
   # any value >= 1000 should be sufficient
   'unimolecular_k1_scale': 1000,
+  # Increasing Multistrand simulation times (e.g. [10, 100]) with which
+  # timed-out trajectories are re-run, after the simulation_time of the
+  # Multistrand parameters; the last one is the cap. None disables re-runs.
+  'multistrand_timeout_escalation': None,
+  # Minimum number of secondary structures drawn from NUPACK at once, so that
+  # the partition function of a resting set is computed once per this many
+  # samples in each worker (see kinda.simulation.nupackjob.sample_global)
+  'nupack_sample_bulk_size': 1000,
+  # Minimum number of Multistrand start structures drawn from NUPACK at once
+  # for the start state pool of a resting set (see
+  # kinda.simulation.startpool.StartStatePool)
+  'multistrand_start_bulk_size': 1000,
   # Provides a default max concentration for each resting set, used for
   # system-level scores
   'max_concentration': 1e-7
@@ -11,14 +11,11 @@ cat input.pil | peppercorn -c -d [--options] | KinDA [--options]
         --backup kotani.db (exports results to kotani.db)
         --restore kotani.db (loads system from kotani.db)
         --database kotani.db (combines --backup and --restore)
+        --db-format npy (stores the backup as a memory-mappable directory)
+        --cache results.db (shares results of identical reactions and resting
+            sets, e.g. reporter systems, between analyses)
 
     Potential improvements:
-        *) it is not possible to load and extend a database, or to read out
-        just the relevant parts. (e.g. reporter systems might be redundant
-        between experiments, so why calculate them every time new?)
-        Unfortunately, I think one needs to store canonical complex forms for
-        that (possible with dsdobjects)
-
         *) the existing import/export structure is a little more rigid than
         necessary. A clearer separation of system and session-parameters would
         be nice (e.g. multiprocessing)
@@ -34,10 +31,14 @@ from peppercornenumerator.input import read_pil as pepper_read_pil
 from peppercornenumerator.output import write_pil as pepper_write_pil
 
 import kinda
-from kinda.objects.io_KinDA import read_pil, write_pil, import_data, export_data
+from kinda.objects.io_KinDA import (read_pil, write_pil, import_data, export_data,
+                                    open_checkpoint, DB_FORMATS)
 from kinda.statistics.stats import RestingSetRxnStats, RestingSetStats
 from kinda.simulation.nupackjob import NupackSampleJob
 from kinda.simulation.multistrandjob import MultistrandJob
+from kinda.simulation.sim_utils import Budget, budget_gap_message
+from kinda.simulation.scheduler import SimulationScheduler
+from kinda.simulation.resultcache import ResultCache
 
 
 def init_parameter_dicts(args):
@@ -65,6 +66,9 @@ def init_parameter_dicts(args):
         'multistrand_multiprocessing': not args.no_multiprocessing,
         'nupack_multiprocessing': not args.no_multiprocessing,
         'max_concentration': args.max_concentration,
+        'multistrand_timeout_escalation': args.multistrand_timeout_escalation,
+        'nupack_sample_bulk_size': args.nupack_sample_bulk_size,
+        'multistrand_start_bulk_size': args.multistrand_start_bulk_size,
     }
     
     mparams = {
@@ -99,43 +103,90 @@ def init_parameter_dicts(args):
     rate_params = {
         'relative_error':  args.error_goal if args.error_goal is not None else \
                            args.rate_error_goal,
-        'min_batch_size':  args.rate_batch_size[0],
-        'init_batch_size': args.rate_batch_size[1],
-        'max_batch_size':  args.rate_batch_size[2],
+        'min_batch_size':  args.rate_batch_size[0] if args.rate_batch_size else None,
+        'init_batch_size': args.rate_batch_size[1] if args.rate_batch_size else None,
+        'max_batch_size':  args.rate_batch_size[2] if args.rate_batch_size else None,
         'max_sims':        args.max_sims if args.max_sims is not None else \
-                           args.rate_max_sims
+                           args.rate_max_sims,
+        'timeout_escalation': args.multistrand_timeout_escalation
     }
-    rate_params['min_batch_size']  = min([rate_params['min_batch_size'], rate_params['max_sims']])
-    rate_params['init_batch_size'] = min([rate_params['init_batch_size'], rate_params['max_sims']])
+    for key in ['min_batch_size', 'init_batch_size']:
+        if rate_params[key] is not None:
+            rate_params[key] = min([rate_params[key], rate_params['max_sims']])
 
     prob_params = {
         'relative_error':  args.error_goal if args.error_goal is not None else args.prob_error_goal,
-        'min_batch_size':  args.prob_batch_size[0],
-        'init_batch_size': args.prob_batch_size[1],
-        'max_batch_size':  args.prob_batch_size[2],
+        'min_batch_size':  args.prob_batch_size[0] if args.prob_batch_size else None,
+        'init_batch_size': args.prob_batch_size[1] if args.prob_batch_size else None,
+        'max_batch_size':  args.prob_batch_size[2] if args.prob_batch_size else None,
         'max_sims':        args.max_sims if args.max_sims is not None else args.prob_max_sims
     }
-    prob_params['min_batch_size']  = min([prob_params['min_batch_size'], prob_params['max_sims']])
-    prob_params['init_batch_size'] = min([prob_params['init_batch_size'], prob_params['max_sims']])
+    for key in ['min_batch_size', 'init_batch_size']:
+        if prob_params[key] is not None:
+            prob_params[key] = min([prob_params[key], prob_params['max_sims']])
 
     return kparams, mparams, nparams, rate_params, prob_params
  
 
 def peppercorn(pilstring, is_file = False, params=None):
     cxs, rxns, strands = pepper_read_pil(pilstring, is_file, composite = True)
-    enum = peppercornenumerator.Enumerator(cxs.values(), rxns)
+    enum = peppercornenumerator.Enumerator(list(cxs.values()), rxns)
     enum.enumerate()
     return pepper_write_pil(enum, fh = None,
             detailed = True, condensed = True, composite = strands)
 
 
+def item_budget(budget, item_params):
+    """ Returns a Budget for a single resting set or reaction (or None).
+
+    Args:
+        budget (Budget): The budget of the whole system, or None.
+        item_params (dict): Arguments of the Budget for this item, or None.
+    """
+    if item_params is None:
+        return budget
+    return Budget(parent = budget, **item_params)
+
+
+def report_budget_gap(name, budget, value, error, rel_goal, num_sims):
+    """ Reports how far an estimate is from its error goal if its budget ran out. """
+    if budget is None or not budget.expired:
+        return
+    goal = rel_goal * value
+    if error == float('inf') or goal == 0.0:
+        exp_add_sims = None
+    else:
+        exp_add_sims = max(0, int(num_sims * ((error/goal)**2 - 1) + 1))
+    message = budget_gap_message(name, error, goal, exp_add_sims)
+    if message is not None:
+        print(message)
+
+
+def save_checkpoint(KindaSystem, backup, use_pickle, checkpoint = None, cache = None):
+    """ Saves new results to the checkpoint log, or exports all data to backup,
+    and adds them to the result cache. """
+    if cache is not None:
+        cache.sync()
+    if checkpoint is not None:
+        checkpoint.sync()
+    elif backup:
+        export_data(KindaSystem, backup, use_pickle)
+
+
 def calculate_all_complex_probabilities(KindaSystem, spurious, nsth, multip = True,
-        backup = None, verbose = 0, use_pickle = True, **kwargs):
+        backup = None, verbose = 0, use_pickle = True, budget = None,
+        restingset_budget = None, checkpoint = None, cache = None, **kwargs):
     """ TODO
 
     Args:
         KindaSystem():
         verbose (int):
+        budget (Budget): A time budget shared by all resting sets.
+        restingset_budget (dict): Arguments of a Budget for each resting set.
+        checkpoint (CheckpointLog): Saves new data instead of exporting the
+            whole System to backup after every resting set (see
+            kinda.objects.io_KinDA.open_checkpoint()).
+        cache (ResultCache): Receives new data after every resting set.
         kwargs (dict): Arguments that are passed on to get_conformation_probs() of the
             kinda.statistics.stats.RestingSetRxnStats() object.
 
@@ -160,10 +211,17 @@ def calculate_all_complex_probabilities(KindaSystem, spurious, nsth, multip = Tr
         # Query/calculate probabilities for all conformations 
         # (including the spurious conformation, denoted as None)
         num = rms_stats.get_num_sims()
-        rms_stats.get_conformation_probs(verbose = verbose, spurious = False, **kwargs)
-
-        if num != rms_stats.get_num_sims() and backup:
-            export_data(KindaSystem, backup, use_pickle)
+        rms_budget = item_budget(budget, restingset_budget)
+        rms_stats.get_conformation_probs(verbose = verbose, spurious = False,
+                                         budget = rms_budget, **kwargs)
+        for cx in rms.complexes:
+            report_budget_gap("resting set {}, complex {}".format(rms, cx.name),
+                rms_budget, rms_stats.get_conformation_prob(cx.name, max_sims = 0),
+                rms_stats.get_conformation_prob_error(cx.name, max_sims = 0),
+                kwargs['relative_error'], rms_stats.get_num_sims())
+
+        if num != rms_stats.get_num_sims():
+            save_checkpoint(KindaSystem, backup, use_pickle, checkpoint, cache)
 
         if verbose >= 2:
             tot = 0
@@ -174,52 +232,79 @@ def calculate_all_complex_probabilities(KindaSystem, spurious, nsth, multip = Tr
 
 
 def calculate_all_reaction_rates(KindaSystem, unproductive, spurious, multip = True,
-        backup = None, verbose = 0, use_pickle = True, **kwargs):
+        backup = None, verbose = 0, use_pickle = True, budget = None,
+        reaction_budget = None, checkpoint = None, cache = None, **kwargs):
     """Calculates reaction rates and error bars.
 
     There are three types of reactions:
         a) the regular reactions enumerated using peppercorn (and more?)
         b) unproductive reactions
 
+    The Multistrand simulations of all reactions are run at the same time
+    (see kinda.simulation.scheduler.SimulationScheduler), so that the cores
+    are kept busy until the last reaction has reached its error goal. The
+    results are reported per reaction afterwards.
+
+    Simulations stop early once the time budget of the system (budget) or of a
+    reaction (a Budget with the arguments reaction_budget) is used up; the
+    distance from the error goal is reported for every estimate that has not
+    reached it.
+
+    New results are saved whenever a reaction is done, to checkpoint (see
+    kinda.objects.io_KinDA.CheckpointLog) if given, or else to backup, and to
+    the result cache (see kinda.simulation.resultcache.ResultCache) if given.
     """
     rxns = KindaSystem.get_reactions(spurious = spurious, unproductive = unproductive)
 
-    ## Simulate each reaction
-    for e, rxn in enumerate(rxns, 1):
+    # Query/calculate k1 and k2 reaction rates to requested precision
+    goal = kwargs['relative_error']
+    maxs = kwargs['max_sims']
+    min_bs = kwargs['min_batch_size']
+    ini_bs = kwargs['init_batch_size']
+    max_bs = kwargs['max_batch_size']
+
+    def on_done(job, new_sims):
+        if new_sims:
+            save_checkpoint(KindaSystem, backup, use_pickle, checkpoint, cache)
+
+    scheduler = SimulationScheduler()
+    num_sims = []
+    budgets = []
+    for rxn in rxns:
+        rxn_stats = KindaSystem.get_stats(rxn)
+        rxn_stats.multijob.multiprocessing = multip
+        rxn_stats.multijob.timeout_escalation = kwargs.get('timeout_escalation')
+        num_sims.append(rxn_stats.get_num_sims())
+        budgets.append(item_budget(budget, reaction_budget))
+        scheduler.add_job(rxn_stats.multijob,
+                [(rxn_stats.multijob_tag, 'k1', goal),
+                 (rxn_stats.multijob_tag, 'k2', goal)], maxs,
+                init_batch_size = ini_bs,
+                min_batch_size = min_bs,
+                max_batch_size = max_bs,
+                on_done = on_done,
+                budget = budgets[-1])
+
+    if verbose:
+        print("\n# Simulating {} reactions concurrently.".format(len(rxns)))
+    scheduler.run()
+
+    ## Report the results of each reaction
+    for e, (rxn, num, rxn_budget) in enumerate(zip(rxns, num_sims, budgets), 1):
         if verbose :
             reactants = map(lambda x:x.name, rxn.reactants)
             products  = map(lambda x:x.name, rxn.products)
             print("\n# Analyzing reaction {}/{}: {} -> {}".format(e, len(rxns), 
                 ' + '.join(reactants), ' + '.join(products)))
     
-        # Get stats object
         rxn_stats = KindaSystem.get_stats(rxn)
-        rxn_stats.multijob.multiprocessing = multip
-    
-        # Query/calculate k1 and k2 reaction rates to requested precision
-        goal = kwargs['relative_error']
-        maxs = kwargs['max_sims']
-        min_bs = kwargs['min_batch_size']
-        ini_bs = kwargs['init_batch_size']
-        max_bs = kwargs['max_batch_size']
-
-        num = rxn_stats.get_num_sims()
         v = 2 if verbose == 1 else verbose
-        rxn_stats.get_raw_stat('k1', goal, maxs, 
-                init_batch_size = ini_bs, 
-                min_batch_size = min_bs, 
-                max_batch_size = max_bs, 
-                verbose = v)
-        maxs -= (rxn_stats.get_num_sims() - num)
-        assert maxs >= 0
-        rxn_stats.get_raw_stat('k2', goal, maxs, 
-            init_batch_size = ini_bs, 
-            min_batch_size = min_bs, 
-            max_batch_size = max_bs, 
-            verbose = verbose)
-
-        if num != rxn_stats.get_num_sims() and backup:
-            export_data(KindaSystem, backup, use_pickle)
+        for stat, v in [('k1', v), ('k2', verbose)]:
+            val, err = rxn_stats.get_raw_stat(stat, goal, 0, verbose = v)
+            report_budget_gap("{} of reaction {}".format(stat, rxn), rxn_budget,
+                              val, err, goal, rxn_stats.get_num_sims())
+        if verbose:
+            print("# {} new simulations.".format(rxn_stats.get_num_sims() - num))
 
 
 def merge_databases(ref_sys: kinda.System, databases: List[str],
@@ -248,13 +333,7 @@ def merge_databases(ref_sys: kinda.System, databases: List[str],
             assert isinstance(nupackjob, NupackSampleJob)
 
             # Now transfer the data
-            new_data = []
-            for cx in rs.complexes:
-                ref_data = list(nupackjob.get_complex_prob_data(cx.name))
-                new_data = list(new_stats.get_conformation_prob_data(cx.name))
-                nupackjob.set_complex_prob_data(cx.name, ref_data + new_data)
-            nupackjob.total_sims += len(new_data)
-            nupackjob.recompute_complex_counts()
+            nupackjob.add_sample_data(*new_stats.get_nupackjob().get_sample_data())
 
         ref_rxns = {repr(rxn): rxn for rxn in ref_sys._condensed_reactions}
         seen_reactants = set()
@@ -274,11 +353,14 @@ def merge_databases(ref_sys: kinda.System, databases: List[str],
             if new_reactants not in seen_reactants:
                 seen_reactants.add(new_reactants)
 
-                # Now transfer the data
+                # Now transfer the data, shifting the indices of the invalid
+                # simulations behind the existing ones
+                offset = multijob.total_sims
                 multijob.add_simulation_data(new_stats.get_simulation_data())
+                new_invalid = [dict(info, simulation_index = info['simulation_index'] + offset)
+                               for info in new_stats.get_invalid_simulation_data()]
                 multijob.set_invalid_simulation_data(
-                    multijob.get_invalid_simulation_data()
-                    + new_stats.get_invalid_simulation_data())
+                    multijob.get_invalid_simulation_data() + new_invalid)
 
 
 def main(args):
@@ -314,6 +396,10 @@ def main(args):
     export_pickle = False if args.backup_json else True
     args.backup = args.backup_json if args.backup_json else args.backup
     args.restore = args.restore_json if args.restore_json else args.restore
+    if args.db_format is None:
+        args.db_format = 'pickle' if export_pickle else 'json'
+    elif args.backup_json:
+        raise SystemExit('You may not specify --db-format with --backup-json.')
 
     # Session parameters
     unproductive = args.unproductive_reactions
@@ -341,10 +427,12 @@ def main(args):
         if args.verbose:
             print('# Importing options and parameters from {}.'.format(args.restore))
 
-        KindaSystem = import_data(args.restore, import_pickle)
+        KindaSystem = import_data(args.restore, import_pickle, lazy = args.lazy_restore)
 
         session_params = set(['nupack_multiprocessing', 'multistrand_multiprocessing',
-                'nupack_similarity_threshold', 'max_concentration'])
+                'nupack_similarity_threshold', 'max_concentration',
+                'multistrand_timeout_escalation', 'nupack_sample_bulk_size',
+                'multistrand_start_bulk_size'])
 
         for k,v in KindaSystem.initialization_params['kinda_params'].items():
             if k not in kparams:
@@ -414,22 +502,56 @@ def main(args):
         if args.verbose:
             print("# {} = {} nM".format(rms, 1e9 * rms_stats.c_max))
 
+    # Time budgets for the whole system and for each resting set / reaction
+    clock = args.budget_clock + '_seconds'
+    budget = None if args.time_budget is None else Budget(**{clock: args.time_budget})
+    prob_budget = None if args.prob_time_budget is None else {clock: args.prob_time_budget}
+    rate_budget = None if args.rate_time_budget is None else {clock: args.rate_time_budget}
+
+    # Reactions and resting sets that were analyzed before (in any system) start
+    # from the results in the cache.
+    cache = None
+    if args.cache:
+        cache = ResultCache(args.cache)
+        loaded = cache.attach(KindaSystem, args.verbose)
+        if args.verbose:
+            print("# Loaded results of {} jobs from cache {}.".format(loaded, args.cache))
+
+    # New results are appended to a log next to the backup file, which is
+    # compacted into the backup file when it grows large and at the end (or,
+    # for SQLite databases, added to the database as new batches). A restored
+    # backup file is continued, unless other databases were merged.
+    checkpoint = None
+    if args.backup:
+        checkpoint = open_checkpoint(KindaSystem, args.backup, export_pickle,
+                resume = (args.restore == args.backup and not args.merge),
+                db_format = args.db_format)
+
     # let's do 1)
     calculate_all_complex_probabilities(
         KindaSystem, spurious, args.nupack_similarity_threshold,
         not args.no_multiprocessing, args.backup, args.verbose, export_pickle,
-        **pparams)
+        budget = budget, restingset_budget = prob_budget,
+        checkpoint = checkpoint, cache = cache, **pparams)
 
     # let's do 2)
     calculate_all_reaction_rates(
         KindaSystem, unproductive, spurious, not args.no_multiprocessing,
-        args.backup, args.verbose, export_pickle, **rparams)
+        args.backup, args.verbose, export_pickle,
+        budget = budget, reaction_budget = rate_budget,
+        checkpoint = checkpoint, cache = cache, **rparams)
+
+    # All simulations are done, stop the worker processes.
+    KindaSystem.shutdown()
    
-    if args.backup and (not os.path.exists(args.backup) or args.merge):
-        export_data(KindaSystem, args.backup, export_pickle)
+    if cache is not None:
+        cache.close()
+
+    if checkpoint is not None:
+        checkpoint.close()
         if args.verbose:
             print("\n# Results stored in {} using {} format.".format(
-                args.backup, 'PICKLE' if export_pickle else 'JSON'))
+                args.backup, args.db_format.upper()))
 
     ######################
     # Print the results: #
@@ -476,6 +598,27 @@ def add_kinda_args(parser):
         # NOTE: It would be nice to store/load/update *any* given database
         # file, but that requires dsdobjects.
 
+    interface.add_argument('--db-format', default=None, choices=DB_FORMATS,
+        help="""Format of the backup file. The binary formats 'npy' (a directory)
+        and 'npz' (an uncompressed zip archive) store one NPY file per data
+        array, which are memory-mapped when the database is restored. The
+        'sqlite' format stores the data in batches, and several KinDA processes
+        restored from the same database (e.g. with --database) may add their
+        results to it at the same time. Binary and SQLite databases are
+        detected automatically when restoring.""")
+
+    interface.add_argument('--lazy-restore', action='store_true',
+        help="""Restore only the objects and summary statistics of the database
+        up front, and read the raw data of a reaction or resting set when it is
+        first needed (e.g. to reduce its error further).""")
+
+    interface.add_argument('--cache', default=None, metavar='<str>',
+        help="""Share results through the given SQLite database with any other
+        analysis that uses it. Reactions and resting sets are identified by
+        their sequences, structures and simulation parameters (not by their
+        names), and start from the results already in the cache. Several KinDA
+        processes may use the same cache at the same time.""")
+
     interface.add_argument('--force', action='store_true',
         help="""Overwrite existing files.""")
 
@@ -516,23 +659,52 @@ def add_kinda_args(parser):
             help="""Maximum number of NUPACK simulations for this Session.""")
 
     session.add_argument('--rate-batch-size', type=int, nargs=3, 
-            default = [50, 100, 1000], metavar='<int>',
-            help="""Adjust batch size for Multistrand simulations. 
+            default = None, metavar='<int>',
+            help="""Bound the number of Multistrand simulations that each
+            reaction may have in flight at a time.
 
                 - First argument: minimum batch size 
-                - Second argument: initial batch size 
+                - Second argument: initial batch size (before any data
+                  has been collected)
                 - Third argument: maximum batch size 
 
-            When using multiple cores, the batch size is divided by the number
-            of cores.  A smaller batch size can lead to slower run time when
-            using multiple cores, as all parallel jobs have to finish in order
-            to determine whether a new batch gets submitted. A large batch size
-            can lead to excess work in order to reach your error goals.""")
+            The simulations of all reactions are scheduled together: new
+            tasks are submitted continuously whenever a core is free, and the
+            error goals are checked as results arrive. Within these bounds,
+            the number of simulations in flight follows the estimated number
+            still needed to reach the error goal. By default, all three
+            values are chosen by the batch tuner from the measured simulation
+            throughput and the number of cores; given values override this
+            choice. A large batch size can lead to excess work in order to
+            reach your error goals.""")
 
     session.add_argument('--prob-batch-size', type=int, nargs=3,
-            default = [100, 100, 1000], metavar='<int>',
+            default = None, metavar='<int>',
             help="""Adjust batch size for NUPACK stochastic backtracking. 
-            Equivalent behavior to --rate-batch-size. """)
+            As for --rate-batch-size, but the values bound the number of
+            samples drawn between two evaluations of the error goal.""")
+
+    session.add_argument('--time-budget', type=float, default = None,
+            metavar='<float>',
+            help="""Time budget for all NUPACK and Multistrand simulations of
+            this Session [seconds]. No new simulations are started once it is
+            used up, and the distance from the error goal is reported for every
+            estimate that has not reached it. See --budget-clock.""")
+
+    session.add_argument('--rate-time-budget', type=float, default = None,
+            metavar='<float>',
+            help="""Time budget for the Multistrand simulations of each
+            reaction [seconds].""")
+
+    session.add_argument('--prob-time-budget', type=float, default = None,
+            metavar='<float>',
+            help="""Time budget for the NUPACK simulations of each resting set
+            [seconds].""")
+
+    session.add_argument('--budget-clock', action="store",
+            choices=('wall', 'cpu'), default = 'wall',
+            help="""Measure time budgets in wall-clock time or in CPU time
+            summed over all worker processes.""")
 
     session.add_argument('--max-concentration', type=float, default = 1e-7, 
             metavar='<float>',
@@ -548,9 +720,29 @@ def add_kinda_args(parser):
             metavar='<float>',
             help="""Maximum Multistrand simulation time [seconds].""")
 
+    session.add_argument('--multistrand-timeout-escalation', type=float, nargs='+',
+            default = None, metavar='<float>',
+            help="""Re-run Multistrand trajectories that time out after
+            --multistrand-timeout from the same seed with these successively
+            longer simulation times, until they finish. The last value is the
+            cap. Fast reactions then do not pay for a long timeout that only a
+            few slow reactions need [seconds].""")
+
     session.add_argument('--no-multiprocessing', action="store_true",
             help="""Switch off multiprocessing for Multistrand and NUPACK.""")
 
+    session.add_argument('--nupack-sample-bulk-size', type=int,
+            default = 1000, metavar='<int>',
+            help="""Draw at least this many secondary structures from NUPACK
+            at once in each worker, and sample further batches from these, so
+            that the partition function of a resting set is not recomputed
+            for every batch.""")
+    session.add_argument('--multistrand-start-bulk-size', type=int,
+            default = 1000, metavar='<int>',
+            help="""Draw at least this many Boltzmann-sampled start structures
+            of a resting set from NUPACK at once, and start the Multistrand
+            simulations of all its reactions from these.""")
+
     session.add_argument('--nupack-similarity-threshold', type=float, 
             default = 0.51, metavar='<float>',
             help="""Calculate complex probabilities (p-approximation) using this 
@@ -1,4 +1,10 @@
-__all__ = ['multistrandjob',
+__all__ = ['batchtuner',
+           'multistrandjob',
            'nupackjob',
-           'sim_utils']
+           'resultcache',
+           'resultstore',
+           'scheduler',
+           'sim_utils',
+           'startpool',
+           'workerpool']
           
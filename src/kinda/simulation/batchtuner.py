@@ -0,0 +1,145 @@
+# batchtuner.py
+#
+# Defines the BatchTuner class, which chooses batch sizes and task sizes for
+# Multistrand and NUPACK jobs from measured throughput and task overhead.
+
+import math
+
+
+class BatchTuner:
+  """
+  Learns how long a job's simulations (or samples) take and how much fixed
+  overhead each task sent to a worker costs, and derives batch and task sizes
+  from these measurements:
+
+    - sims_per_worker() is the smallest number of simulations per task for
+      which the per-task overhead stays below overhead_fraction of the task's
+      time, but small enough that a batch still consists of several tasks per
+      worker.
+    - batch_sizes() returns (init, min, max) bounds on the batch size for
+      reduce_error_to(): the minimum keeps every worker busy with one task,
+      and the maximum corresponds to about batch_seconds of wall time, so that
+      error estimates are updated regularly regardless of how slow the job is.
+    - round_batch() rounds a batch size up to a multiple of the number of
+      workers times the task size, so that no worker idles at the end of a
+      batch while the others finish an unequal share.
+
+  Measurements are exponentially smoothed, so the tuner adapts as a run
+  proceeds (e.g. when a job's trajectories become slower). Until the first
+  measurement, one simulation per task and small probing batches are used.
+
+  Args:
+    overhead_fraction (float, optional): Target upper bound on the fraction
+      of a task's time spent on overhead rather than simulating.
+    batch_seconds (float, optional): Target wall time of the largest batch.
+    smoothing (float, optional): Weight of each new measurement.
+    probe_tasks_per_worker (int, optional): Tasks per worker in the first
+      (probing) batch.
+  """
+  def __init__(self, overhead_fraction = 0.05, batch_seconds = 30.0,
+      smoothing = 0.3, probe_tasks_per_worker = 2):
+    self.overhead_fraction = overhead_fraction
+    self.batch_seconds = batch_seconds
+    self.smoothing = smoothing
+    self.probe_tasks_per_worker = probe_tasks_per_worker
+    self._seconds_per_sim = None
+    self._task_overhead = None
+    # Smoothed sums for the regression in record_batch()
+    self._batch_sums = None
+
+  @property
+  def seconds_per_sim(self):
+    """ Smoothed time a single worker needs per simulation (None if unknown). """
+    return self._seconds_per_sim
+
+  @property
+  def task_overhead(self):
+    """ Smoothed per-task overhead in seconds (None if unknown). """
+    return self._task_overhead
+
+  def _smooth(self, old, new):
+    if old is None:
+      return new
+    return (1 - self.smoothing) * old + self.smoothing * new
+
+  def record_task(self, num_sims, sim_seconds, overhead_seconds):
+    """
+    Records a task of num_sims simulations that spent sim_seconds simulating
+    and overhead_seconds on everything else (task setup, result packing and
+    transfer, processing in the main process).
+    """
+    if num_sims > 0:
+      self._seconds_per_sim = self._smooth(self._seconds_per_sim,
+                                           sim_seconds / num_sims)
+    self._task_overhead = self._smooth(self._task_overhead,
+                                       max(0.0, overhead_seconds))
+
+  def record_batch(self, num_sims, wall_seconds, processes = 1):
+    """
+    Records a batch of num_sims simulations that was split evenly into one
+    task per worker and took wall_seconds, for jobs that cannot time their
+    tasks individually. Simulation time and per-task overhead are separated by
+    a (smoothed) linear regression of task time on task size, which needs
+    batches of different sizes; until then, all time is attributed to the
+    simulations.
+    """
+    tasks = min(processes, num_sims)
+    if tasks == 0:
+      return
+    x, y = num_sims / tasks, wall_seconds
+    sums = [x, y, x*x, x*y, 1.0]
+    if self._batch_sums is None:
+      self._batch_sums = sums
+    else:
+      self._batch_sums = [self._smooth(a, b) for a, b in zip(self._batch_sums, sums)]
+    sx, sy, sxx, sxy, sw = self._batch_sums
+    var_x = sxx/sw - (sx/sw)**2
+    slope = (sxy/sw - sx*sy/sw**2) / var_x if var_x > 1e-9 * (sxx/sw) else 0.0
+    if slope > 0 and sy/sw - slope * sx/sw >= 0:
+      self._seconds_per_sim = slope
+      self._task_overhead = sy/sw - slope * sx/sw
+    else:
+      self._seconds_per_sim = self._smooth(self._seconds_per_sim, y / x)
+
+  def effective_seconds_per_sim(self, sims_per_worker = 1):
+    """
+    Returns the time a worker needs per simulation, including its share of the
+    task overhead for tasks of sims_per_worker simulations (None if unknown).
+    """
+    if not self._seconds_per_sim:
+      return None
+    seconds_per_sim = self._seconds_per_sim
+    if self._task_overhead is not None:
+      seconds_per_sim += self._task_overhead / sims_per_worker
+    return seconds_per_sim
+
+  def sims_per_worker(self, max_sims_per_worker = 1000):
+    """ Returns the number of simulations per task. """
+    if not self._seconds_per_sim or self._task_overhead is None:
+      return 1
+    f = self.overhead_fraction
+    chunk = self._task_overhead * (1 - f) / (f * self._seconds_per_sim)
+    # Keep tasks short compared to a batch, so that batches stay balanced
+    chunk = min(chunk, self.batch_seconds / (4 * self._seconds_per_sim))
+    return int(max(1, min(max_sims_per_worker, math.ceil(chunk))))
+
+  def batch_sizes(self, processes = 1, sims_per_worker = None):
+    """ Returns (init_batch_size, min_batch_size, max_batch_size). """
+    if sims_per_worker is None:
+      sims_per_worker = self.sims_per_worker()
+    unit = processes * sims_per_worker
+    min_batch_size = unit
+    init_batch_size = self.probe_tasks_per_worker * unit
+    seconds_per_sim = self.effective_seconds_per_sim(sims_per_worker)
+    if seconds_per_sim:
+      max_batch_size = self.round_batch(
+        int(self.batch_seconds * processes / seconds_per_sim),
+        processes, sims_per_worker)
+    else:
+      max_batch_size = init_batch_size
+    return init_batch_size, min_batch_size, max(max_batch_size, init_batch_size)
+
+  def round_batch(self, num_sims, processes = 1, sims_per_worker = 1):
+    """ Rounds num_sims up to a multiple of processes * sims_per_worker. """
+    unit = processes * sims_per_worker
+    return max(unit, unit * math.ceil(num_sims / unit))
@@ -5,18 +5,24 @@
 # (trajectory, transition, first passage, and first step) and collecting
 # and processing data relevant to each mode.
 
+import time
+import collections
 import itertools as it
-import signal
 
 import numpy as np
-import multiprocess
 
 from multistrand.options import Options as MSOptions
 from multistrand.options import Literals as MSLiterals
 from multistrand.system import SimSystem as MSSimSystem
+from multistrand.objects import Complex as MSComplex
 
 from ..objects import io_Multistrand, RestingSet, Complex
 from . import sim_utils
+from . import scheduler
+from .resultstore import ResultStore
+from .batchtuner import BatchTuner
+from . import workerpool
+from .workerpool import WorkerPool
 
 
 MS_TIMEOUT = MSLiterals.time_out
@@ -24,14 +30,149 @@ MS_NOINITIALMOVES = MSLiterals.no_initial_moves
 MS_ERROR = MSLiterals.sim_error
 
 
-def run_sims_global(job_spec):
-  """Multiprocessing function for performing a single simulation.
+def run_sims_global(task):
+  """Multiprocessing function for performing a batch of simulations.
+
+  The task consists only of the key of a registered job spec (see
+  MultistrandJob.job_key) and the number of trajectories to simulate, plus, to
+  re-run a timed-out trajectory with a longer time limit, a dict with its
+  'seed' and the new 'simulation_time' (see MultistrandJob.rerun_tasks()).
+
+  For jobs with start state pools, the task also lists the start structures
+  of each trajectory, one dot-paren structure per start complex (see
+  MultistrandJob.simulation_task()). The trajectories with the same start
+  structures are simulated by one Multistrand system.
+  """
+  job_key, num_sims = task[:2]
+  rerun = task[2] if len(task) > 2 else None
+  start_structures = task[3] if len(task) > 3 else None
+  started_at = time.time()
+  job_spec = workerpool.get_job_spec(job_key)
+  ms_options_dict = job_spec['ms_options']
+  if rerun is not None:
+    ms_options_dict = dict(ms_options_dict,
+        initial_seed = rerun['seed'], simulation_time = rerun['simulation_time'])
+
+  if start_structures is None:
+    groups = [(None, num_sims)]
+  else:
+    groups = collections.Counter(tuple(s) for s in start_structures).items()
+  sim_seconds = 0.0
+  packed_groups = []
+  for structures, group_sims in groups:
+    options_dict = ms_options_dict
+    if structures is not None:
+      options_dict = dict(ms_options_dict, start_state = [
+        MSComplex(name = name, strands = strands, structure = structure)
+        for (name, strands), structure
+        in zip(job_spec['start_complexes'], structures)])
+    ms_options = create_ms_options(options_dict, group_sims)
+    sim_start = time.perf_counter()
+    MSSimSystem(ms_options).start()
+    sim_seconds += time.perf_counter() - sim_start
+    ms_options.free_sim_system()
+    packed_groups.append(pack_results(ms_options, job_spec, structures))
+  packed = merge_packed(packed_groups)
+  if rerun is not None:
+    packed['rerun'] = rerun
+  # Timing information for the batch tuner of the job (see record_timing())
+  packed['timing'] = (started_at, sim_seconds, time.time())
+  return packed
+
+def task_cpu_seconds(packed):
+  """
+  Returns the time a worker was busy with the task that produced the packed
+  results (0 if unknown).
+  """
+  if 'timing' not in packed:
+    return 0.0
+  started_at, _, finished_at = packed['timing']
+  return max(0.0, finished_at - started_at)
+
+def pack_results(ms_options, job_spec, start_structures = None):
   """
-  (multijob, num_sims) = job_spec
-  ms_options = multijob.create_ms_options(num_sims)
-  MSSimSystem(ms_options).start()
-  ms_options.free_sim_system()
-  return ms_options
+  Packs the results of a finished Multistrand batch into a compact record of
+  NumPy arrays, so that only this record (rather than the whole MS Options
+  object) needs to be sent back to the main process:
+    'tags':   tag ids, as given by job_spec['tag_ids']
+    'times':  trajectory end times
+    'valid':  1 for trajectories that neither timed out nor failed, else 0
+    'kcoll':  collision rates (only if job_spec['kcoll'] is True)
+    'invalid': extra information on the invalid trajectories, each with its
+              index within the batch and the start_structures it was
+              simulated from, if given (only present if there are any)
+    'transition_lists': transition paths (only if job_spec['transitions'])
+  """
+  results = ms_options.interface.results
+  n = len(results)
+  tag_ids = job_spec['tag_ids']
+
+  tags = np.fromiter((tag_ids[r.tag] for r in results), dtype=np.int64, count=n)
+  times = np.fromiter((r.time for r in results), dtype=np.float64, count=n)
+  valid = ((tags != tag_ids[MS_TIMEOUT]) & (tags != tag_ids[MS_ERROR])).astype(np.int8)
+  packed = {'tags': tags, 'times': times, 'valid': valid}
+  if job_spec['kcoll']:
+    packed['kcoll'] = np.fromiter(
+      (r.collision_rate for r in results), dtype=np.float64, count=n)
+
+  ## Store extra information about invalid simulations
+  invalid = np.flatnonzero(valid == 0)
+  if len(invalid) > 0:
+    packed['invalid'] = [{
+        'batch_index': int(i),
+        'end_time': times[i],
+        'type': 'timeout' if tags[i]==tag_ids[MS_TIMEOUT] else 'error',
+        'seed': results[i].seed,
+        'start_structure': results[i].start_state,
+        'end_state': [list(v) for v in ms_options.interface.end_states[i]]
+      } for i in invalid]
+    if start_structures is not None:
+      for info in packed['invalid']:
+        info['start_structures'] = list(start_structures)
+
+  if job_spec['transitions']:
+    packed['transition_lists'] = ms_options.interface.transition_lists
+  return packed
+
+def merge_packed(packed_list):
+  """
+  Concatenates the packed results of several Multistrand batches (see
+  pack_results()) into the packed results of a single batch.
+  """
+  if len(packed_list) == 1:
+    return packed_list[0]
+  merged = {k: np.concatenate([p[k] for p in packed_list])
+            for k in packed_list[0] if k not in ('invalid', 'transition_lists')}
+  offset = 0
+  for p in packed_list:
+    for info in p.get('invalid', []):
+      merged.setdefault('invalid', []).append(
+        dict(info, batch_index = info['batch_index'] + offset))
+    offset += len(p['tags'])
+  if 'transition_lists' in packed_list[0]:
+    merged['transition_lists'] = [
+      path for p in packed_list for path in p['transition_lists']]
+  return merged
+
+def create_ms_options(ms_options_dict, num_sims: int) -> MSOptions:
+  """
+  Creates a fresh MS Options object for num_sims trajectories using the
+  arguments in ms_options_dict.
+  """
+  rate_model = ms_options_dict.get("rate_model", None)
+  if rate_model is None:
+    opts = MSOptions(**dict(ms_options_dict, num_simulations = num_sims))
+  else:
+    opts_dict = ms_options_dict.copy()
+    for k in ["rate_method", "unimolecular_scaling", "bimolecular_scaling"]:
+      opts_dict.pop(k, None)
+    opts = MSOptions(**dict(opts_dict, num_simulations = num_sims))
+    # choose parameter preset
+    getattr(opts, rate_model)()
+
+  assert opts.unimolecular_scaling > 0
+  assert opts.bimolecular_scaling > 0
+  return opts
 
 # MultistrandJob class definition
 class MultistrandJob:
@@ -41,18 +182,45 @@ class MultistrandJob:
   output mode, different statistics are calculated on the trajectory results.
   This is the parent class to the more useful job classes that compile specific
   information for each job mode type.
+
+  With timeout escalation, trajectories are simulated with the (short)
+  simulation_time of the Multistrand parameters first, and only those that time
+  out are re-run from the same seed with the successively longer limits given by
+  timeout_escalation, until they finish or the last limit (the cap) is reached.
+  Each re-run replaces the result of the timed-out trajectory, so the data is
+  the same as if all trajectories had been simulated with the cap, but jobs
+  whose trajectories finish quickly do not pay for the slowest ones.
+
+  With start_pools (one StartStatePool per element of the start state, see
+  kinda.simulation.startpool), the start structures of the trajectories are
+  taken from the pools rather than Boltzmann-sampled by Multistrand, so that
+  the resting sets shared by many jobs are sampled in bulk and only once.
   """
+  # Per-trajectory values kept in the result store
+  result_columns = ['valid', 'tags', 'times']
+
   def __init__(self, start_state, stop_conditions, sim_mode,
           boltzmann_selectors = None, 
+          start_pools = None,
           multiprocessing = True, 
-          multistrand_params = {}):
+          multistrand_params = {},
+          worker_pool = None,
+          timeout_escalation = None):
     self._multistrand_params = dict(multistrand_params)
+    self._start_pools = start_pools
     self._ms_options_dict = self.setup_ms_params(
       start_state = start_state, stop_conditions = stop_conditions,
-      mode = sim_mode, boltzmann_selectors = boltzmann_selectors)
+      mode = sim_mode, boltzmann_selectors = boltzmann_selectors,
+      start_pools = start_pools)
 
     self.multiprocessing = multiprocessing
-    self._mp_ctx = multiprocess.get_context('spawn')
+    # Worker processes are shared across batches (and across jobs, if the pool
+    # was handed down from a System)
+    self.worker_pool = worker_pool if worker_pool is not None else WorkerPool()
+    # Key under which the job spec is registered with the workers (see job_key)
+    self._job_key = None
+    # Chooses batch and task sizes that are not given explicitly
+    self.batch_tuner = BatchTuner()
     
     self._stats_funcs = {
         'time': (sim_utils.time_mean, sim_utils.time_std, sim_utils.time_error),
@@ -65,21 +233,24 @@ class MultistrandJob:
       MS_ERROR: -3,
       'overall': 0
     }
-    self._ms_results = {
-        'valid': np.array([], dtype=np.int8), 
-        'tags': np.array([], np.int64), 
-        'times': np.array([])
-        }
-    self._ms_results_buff = {
-        'valid': np.array([], dtype=np.int8), 
-        'tags': np.array([], np.int64), 
-        'times': np.array([])
-        }
+    self._ms_store = ResultStore(self.result_columns)
     # extra information about invalid simulations, like timeouts
     self._ms_results_invalid = []
+    # running sufficient statistics of self._ms_store, per tag
+    self._ms_summary = sim_utils.ResultsSummary()
 
     self.total_sims = 0
 
+    # Invalid simulation records of timed-out trajectories to be re-run
+    self._rerun_queue = collections.deque()
+    self.timeout_escalation = timeout_escalation
+
+    # Called with every change of the simulation data (see add_data_listener())
+    self._data_listeners = []
+    # Identifies the results of this job in a ResultCache (see
+    # kinda.simulation.resultcache), if set
+    self.cache_key = None
+
   @property
   def multistrand_params(self):
     return dict(self._multistrand_params)
@@ -87,6 +258,66 @@ class MultistrandJob:
   @property
   def tag_id_dict(self):
     return self._tag_id_dict.copy()
+
+  @property
+  def timeout_escalation(self):
+    """
+    The increasing simulation times with which timed-out trajectories are
+    re-run, after the simulation_time of the Multistrand parameters.
+    """
+    return self._timeout_escalation
+
+  @timeout_escalation.setter
+  def timeout_escalation(self, simulation_times):
+    simulation_times = tuple(sorted(simulation_times or ()))
+    if (simulation_times and
+        self._ms_options_dict['simulation_mode'] == MSLiterals.transition):
+      raise ValueError("Timeout escalation is not supported in transition mode.")
+    self._timeout_escalation = simulation_times
+    self._queue_reruns()
+
+  @property
+  def pending_reruns(self):
+    """ The number of timed-out trajectories waiting to be re-run. """
+    return len(self._rerun_queue)
+
+  @property
+  def processes(self):
+    """ The number of processes simulating for this job. """
+    return self.worker_pool.processes if self.multiprocessing else 1
+
+  @property
+  def job_key(self):
+    """
+    The key under which the job spec, i.e. the (immutable) Multistrand options
+    of this job and the information needed to pack its results (see
+    pack_results()), is registered with self.worker_pool, along with the
+    names and Multistrand strands of the start complexes if the job has start
+    pools (see run_sims_global()). The spec is
+    registered on first access, so that each worker receives it only once per
+    job rather than with every batch of trajectories.
+    """
+    if self._job_key is None:
+      self._job_key = workerpool.new_job_key('ms')
+      self.worker_pool.register_job_spec(self._job_key, {
+        'ms_options': self._ms_options_dict,
+        'tag_ids': self.tag_id_dict,
+        'kcoll': 'kcoll' in self._ms_store,
+        'transitions':
+          self._ms_options_dict['simulation_mode'] == MSLiterals.transition,
+        'start_complexes': self._start_complexes})
+    return self._job_key
+
+  def simulation_task(self, num_sims):
+    """
+    Returns a task for run_sims_global() that simulates num_sims new
+    trajectories, with start structures taken from the start pools if the job
+    has any.
+    """
+    if self._start_pools is None:
+      return (self.job_key, num_sims)
+    return (self.job_key, num_sims, None,
+            list(zip(*[pool.take(num_sims) for pool in self._start_pools])))
                                                 
   def setup_ms_params(self, *args, **kargs):
     ## Extract keyword arguments
@@ -95,7 +326,7 @@ class MultistrandJob:
     resting_sets = [x for x in start_state if isinstance(x, RestingSet)]
     complexes = [x for x in start_state if isinstance(x, Complex)]
 
-    if kargs['boltzmann_selectors'] is None:
+    if kargs['boltzmann_selectors'] is None or kargs['start_pools'] is not None:
       boltzmann = False
       boltzmann_selectors = [None]*len(start_state)
     else:
@@ -122,6 +353,14 @@ class MultistrandJob:
     ]
     ms_stop_conditions = list(it.chain(*[macrostates_dict[m] for m in stop_conditions]))
 
+    ## Names and strands of the start complexes, which are given the start
+    ## structures from the start pools (see run_sims_global())
+    start_complexes = [
+      elem if isinstance(elem, Complex) else next(iter(elem.complexes))
+      for elem in start_state]
+    self._start_complexes = [(c.name, [strands_dict[s] for s in c.strands])
+                             for c in start_complexes]
+
     ## Set boltzmann sampling status for all Multistrand start_state complexes
     for elem,boltzmann_func in zip(ms_start_state, boltzmann_selectors):
       elem.boltzmann_sample = boltzmann
@@ -139,59 +378,92 @@ class MultistrandJob:
     return options_dict
     
   def get_statistic(self, reaction, stat = 'rate'):
-    return self._stats_funcs[stat][0](self._tag_id_dict[reaction], self._ms_results)
+    return self._stats_funcs[stat][0](self._tag_id_dict[reaction], self._ms_summary)
 
   def get_statistic_error(self, reaction, stat = 'rate'):
-    return self._stats_funcs[stat][2](self._tag_id_dict[reaction], self._ms_results)
+    return self._stats_funcs[stat][2](self._tag_id_dict[reaction], self._ms_summary)
 
   def get_simulation_data(self):
-    return self._ms_results
+    """
+    Returns a dict with an array of per-trajectory values for each result
+    column. The arrays are views into the result store and should not be kept
+    across further simulations.
+    """
+    return self._ms_store.data()
+
+  def get_simulation_summary(self):
+    return self._ms_summary
 
   def set_simulation_data(self, ms_results):
-    # copy data from ms_results to self._ms_results_buff, while preserving data
-    # types of numpy arrays in self._ms_results_buff
-    for k,v in ms_results.items():
-      self._ms_results_buff[k].resize(len(v), refcheck=False)
-      self._ms_results[k] = self._ms_results_buff[k]
-      if len(v) > 0:
-        np.copyto(self._ms_results_buff[k], v)
-    self.total_sims = len(self._ms_results['tags'])
+    # store the data from ms_results, converting to the data types of the
+    # result store's columns (arrays with these types are not copied)
+    self._ms_store.set(ms_results)
+    self.total_sims = len(self._ms_store)
+    self._ms_summary = sim_utils.ResultsSummary.from_results(
+      self._ms_store.data())
+
+  def set_lazy_simulation_data(self, loader, num_sims, summary):
+    """
+    Sets the simulation data to the num_sims results returned by loader(),
+    which is only called when the data is first needed. The statistics are
+    computed from summary (a ResultsSummary of the results) until then.
+    """
+    self._ms_store.set_lazy(loader, num_sims)
+    self.total_sims = num_sims
+    self._ms_summary = summary
 
   def add_simulation_data(self, ms_results):
-    # copy data from ms_results to self._ms_results_buff, while preserving data
-    # types of numpy arrays in self._ms_results_buff
-    dim = len(ms_results['tags'])
+    self.total_sims += self._append_results(ms_results)
 
-    for k,v in ms_results.items():
-      self._ms_results_buff[k] = np.append(self._ms_results_buff[k], v)
-      self._ms_results[k] = self._ms_results_buff[k]
-    self.total_sims = len(self._ms_results['tags'])
+  def add_data_listener(self, listener):
+    """
+    Registers listener(job, change) to be called whenever simulation data is
+    added or replaced, e.g. to write the new data to a checkpoint log. The
+    change is a dict with any of the keys
+      'start', 'rows':    the given rows were written to the result store,
+                          starting at row start (appended if start is the
+                          previous number of rows)
+      'invalid':          these invalid simulation records were added or
+                          updated (identified by their 'simulation_index')
+      'invalid_removed':  the records of these simulation indices were removed
+    Changes are idempotent, so that they can safely be replayed more than once.
+    Data set with set_simulation_data() is not reported.
+    """
+    self._data_listeners.append(listener)
+
+  def remove_data_listener(self, listener):
+    self._data_listeners.remove(listener)
+
+  def _notify_data_listeners(self, **change):
+    for listener in self._data_listeners:
+      listener(self, change)
+
+  def _append_results(self, ms_results):
+    # Appends rows to the result store and updates the summary with the values
+    # as stored (e.g. with kcoll in single precision), so that it agrees with
+    # a summary recomputed from the stored data. Returns the number of rows.
+    start = len(self._ms_store)
+    self._ms_store.append(ms_results)
+    new_rows = {k: v[start:] for k,v in self._ms_store.data().items()}
+    self._ms_summary.add(new_rows['tags'], new_rows['times'],
+                         new_rows['valid'], new_rows.get('kcoll'))
+    if self._data_listeners:
+      self._notify_data_listeners(start = start, rows = new_rows)
+    return len(self._ms_store) - start
 
   def get_invalid_simulation_data(self):
     return self._ms_results_invalid
 
   def set_invalid_simulation_data(self, invalid_sim_data):
     self._ms_results_invalid = invalid_sim_data[:]
+    self._queue_reruns()
   
   def create_ms_options(self, num_sims: int) -> MSOptions:
     """
     Creates a fresh MS Options object using the arguments in
     self._ms_options_dict.
     """
-    rate_model = self._ms_options_dict.get("rate_model", None)
-    if rate_model is None:
-      opts = MSOptions(**dict(self._ms_options_dict, num_simulations = num_sims))
-    else:
-      opts_dict = self._ms_options_dict.copy()
-      for k in ["rate_method", "unimolecular_scaling", "bimolecular_scaling"]:
-        opts_dict.pop(k, None)
-      opts = MSOptions(**dict(opts_dict, num_simulations = num_sims))
-      # choose parameter preset
-      getattr(opts, rate_model)()
-
-    assert opts.unimolecular_scaling > 0
-    assert opts.bimolecular_scaling > 0
-    return opts
+    return create_ms_options(self._ms_options_dict, num_sims)
 
   def run_simulations(self, num_sims, sims_per_update=1, sims_per_worker=1,
                       status_func=None):
@@ -200,55 +472,41 @@ class MultistrandJob:
       self.run_sims_multiprocessing(num_sims, sims_per_update, sims_per_worker, status_func)
     else:
       self.run_sims_singleprocessing(num_sims, sims_per_update, status_func)
+    self.escalate_timeouts()
 
   def run_sims_multiprocessing(self, num_sims, sims_per_update=1,
                                sims_per_worker=1, status_func=None):
     """
-    Sets up a multiprocessing.Pool object to run simulations concurrently over
-    multiple subprocesses.
-
-    The Pool object has number of worker processes equal to the number of cpus,
-    as given by `multiprocessing.cpu_count()`.`
-    Due to a Python bug, SIGINT events (e.g. produced by Ctrl-C) do not cause
-    the worker processes to terminate gracefully, causing the result-handling
-    loop to hang indefinitely and forcing the main process to be halted
-    externally. This is resolved by removing the SIGINT handler before creating
-    the worker processes, so that all workers ignore SIGINT, allowing the main
-    process to handle SIGINT and terminate them without hanging. The original
-    SIGINT handler is restored immediately after creating the worker processes
-    (otherwise the main process would ignore SIGINT as well). Note that this
-    workaround produces a short time interval in which all SIGINT signals are
-    ignored.
-    """
-    # Temporarily remove the SIGINT event handler
-    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-    # Create Pool instance and worker processes
-    k = min(self._mp_ctx.cpu_count(), num_sims)
-    p = self._mp_ctx.Pool(processes=k)
-
-    # Restore original SIGINT event handler
-    if sigint_handler is None:  sigint_handler = signal.SIG_DFL
-    signal.signal(signal.SIGINT, sigint_handler)
+    Runs simulations concurrently on the worker processes of self.worker_pool.
 
+    The pool is started on first use and kept alive between batches, so that
+    Multistrand is imported only once per worker and session. SIGINT events
+    (e.g. produced by Ctrl-C) are ignored by the workers (see
+    WorkerPool.start()), so the main process handles them by terminating the
+    worker processes and re-raising the KeyboardInterrupt.
+    """
+    # Draw the start structures of the whole batch at once
+    for pool in self._start_pools or []:
+      if len(pool) < num_sims:
+        pool.top_up(num_sims - len(pool))
     # Setup args for each process
-    args = [(self, sims_per_worker)] * (num_sims // sims_per_worker)
-    if num_sims%sims_per_worker > 0: args += [(self, num_sims%sims_per_worker)]
-    it = p.imap_unordered(run_sims_global, args)
-    p.close()
+    args = [self.simulation_task(sims_per_worker)
+            for _ in range(num_sims // sims_per_worker)]
+    if num_sims%sims_per_worker > 0:
+      args.append(self.simulation_task(num_sims%sims_per_worker))
+    it = self.worker_pool.imap_unordered(run_sims_global, args)
     try:
       sims_completed = 0
       for res in it:
         self.process_results(res)
-        sims_completed += len(res.interface.results)
+        sims_completed += len(res['tags'])
         if status_func is not None and sims_completed % sims_per_update == 0:
           status_func(sims_completed)
     except KeyboardInterrupt:
       # (More) gracefully handle SIGINT by terminating worker processes properly
       # and then allowing SIGINT to be handled normally
       print("\nSIGINT: Terminating Multistrand processes prematurely...")
-      p.terminate()
-      p.join()
+      self.worker_pool.terminate()
       raise KeyboardInterrupt
 
   def run_sims_singleprocessing(self, num_sims, sims_per_update=1, status_func=None):
@@ -256,7 +514,7 @@ class MultistrandJob:
     while sims_completed < num_sims:
       sims_to_run = min(sims_per_update, num_sims - sims_completed)
 
-      results = run_sims_global((self, sims_to_run))
+      results = run_sims_global(self.simulation_task(sims_to_run))
       self.process_results(results)
 
       sims_completed += sims_to_run
@@ -264,52 +522,184 @@ class MultistrandJob:
         status_func(sims_completed)
 
   def preallocate_batch(self, batch_size):
-    self._ms_results_buff['valid'].resize(self.total_sims + batch_size, refcheck=False)
-    self._ms_results_buff['tags'].resize(self.total_sims + batch_size, refcheck=False)
-    self._ms_results_buff['times'].resize(self.total_sims + batch_size, refcheck=False)
-    self._ms_results['valid'] = self._ms_results_buff['valid'][:self.total_sims]
-    self._ms_results['tags'] = self._ms_results_buff['tags'][:self.total_sims]
-    self._ms_results['times'] = self._ms_results_buff['times'][:self.total_sims]
-
-  def process_results(self, ms_options):
-    results = ms_options.interface.results
-    n = len(results)
-
-    times = [r.time for r in results]
-    tags  = [self._tag_id_dict[r.tag] for r in results]
-    valid = [t!=self._tag_id_dict[MS_TIMEOUT]
-             and t!=self._tag_id_dict[MS_ERROR] for t in tags]
-
-    self._ms_results_buff['valid'][self.total_sims:self.total_sims+n] = valid
-    self._ms_results_buff['tags'][self.total_sims:self.total_sims+n] = tags
-    self._ms_results_buff['times'][self.total_sims:self.total_sims+n] = times
+    """ Reserves room for batch_size more trajectories in the result store. """
+    self._ms_store.reserve(len(self._ms_store) + batch_size)
 
+  def process_results(self, packed):
+    """
+    Stores a batch of results, as packed by pack_results() in a worker.
+    """
     ## Store extra information about invalid simulations
-    for i in range(n):
-      if not valid[i]:
-        self._ms_results_invalid.append({
-            'simulation_index': i+self.total_sims,
-            'end_time': times[i],
-            'type': 'timeout' if tags[i]==self._tag_id_dict[MS_TIMEOUT] else 'error',
-            'seed': results[i].seed,
-            'start_structure': results[i].start_state,
-            'end_state': [list(v) for v in ms_options.interface.end_states[i]]
-        })
-
-    self.total_sims = self.total_sims + n
-    for k in self._ms_results:
-      self._ms_results[k] = self._ms_results_buff[k][:self.total_sims]
+    new_infos = self.add_invalid_results(packed)
+
+    self.total_sims += self._append_results(packed)
+    self._rerun_queue.extend(info for info in new_infos if self._needs_rerun(info))
+    self.record_timing(packed)
+
+  def record_timing(self, packed):
+    """
+    Passes the simulation time and overhead of a returned task to the batch
+    tuner. The overhead comprises everything the task spent outside of the
+    simulation, from being picked up by a worker until its results have been
+    processed in the main process.
+    """
+    if 'timing' not in packed:
+      return
+    started_at, sim_seconds, finished_at = packed['timing']
+    overhead = (finished_at - started_at - sim_seconds) + (time.time() - finished_at)
+    self.batch_tuner.record_task(len(packed['tags']), sim_seconds, overhead)
+
+  def batch_params(self, sims_per_worker = None, init_batch_size = None,
+      min_batch_size = None, max_batch_size = None):
+    """
+    Returns (sims_per_worker, init_batch_size, min_batch_size, max_batch_size),
+    where any argument that is None is replaced by the current choice of the
+    batch tuner.
+    """
+    if sims_per_worker is None:
+      sims_per_worker = self.batch_tuner.sims_per_worker()
+    auto_sizes = self.batch_tuner.batch_sizes(self.processes, sims_per_worker)
+    return (sims_per_worker,) + tuple(auto if size is None else size
+        for size, auto in zip(
+          [init_batch_size, min_batch_size, max_batch_size], auto_sizes))
+
+  def add_invalid_results(self, packed):
+    """
+    Stores the extra information about the invalid simulations of a batch that
+    is about to be appended, and returns the new records.
+    """
+    new_infos = []
+    for info in packed.get('invalid', []):
+      info = dict(info)
+      info['simulation_index'] = info.pop('batch_index') + self.total_sims
+      info['simulation_time'] = self._ms_options_dict.get('simulation_time')
+      new_infos.append(info)
+    self._ms_results_invalid.extend(new_infos)
+    if new_infos and self._data_listeners:
+      self._notify_data_listeners(invalid = new_infos)
+    return new_infos
+
+  def _next_simulation_time(self, info):
+    # The next longer time limit for an invalid simulation record, or None
+    simulation_time = info.get('simulation_time',
+                               self._ms_options_dict.get('simulation_time'))
+    longer = [t for t in self._timeout_escalation
+              if simulation_time is None or t > simulation_time]
+    return longer[0] if longer else None
+
+  def _needs_rerun(self, info):
+    # The stored tag is only checked once the results are loaded, so that a
+    # lazily restored job is not loaded just to queue its re-runs; the check
+    # is repeated in rerun_tasks()
+    if not self._timeout_escalation:
+      return False
+    index = info.get('simulation_index')
+    if (info.get('type') != 'timeout' or 'seed' not in info
+        or index is None or index >= len(self._ms_store)
+        or self._next_simulation_time(info) is None):
+      return False
+    return not self._ms_store.loaded or self._timed_out(index)
+
+  def _timed_out(self, index):
+    return self._ms_store.data()['tags'][index] == self._tag_id_dict[MS_TIMEOUT]
+
+  def _queue_reruns(self):
+    self._rerun_queue = collections.deque(
+      info for info in self._ms_results_invalid if self._needs_rerun(info))
+
+  def rerun_tasks(self, max_tasks = None):
+    """
+    Removes up to max_tasks timed-out trajectories from the re-run queue and
+    returns a task for each, which re-runs the trajectory from its seed with
+    the next longer time limit (see run_sims_global()). The results of these
+    tasks must be passed to process_rerun().
+    """
+    tasks = []
+    while self._rerun_queue and (max_tasks is None or len(tasks) < max_tasks):
+      info = self._rerun_queue.popleft()
+      if not self._timed_out(info['simulation_index']):
+        continue
+      task = (self.job_key, 1, {
+        'simulation_index': info['simulation_index'],
+        'seed': info['seed'],
+        'simulation_time': self._next_simulation_time(info)})
+      if 'start_structures' in info:
+        # Re-run from the same start structures as well
+        task += ([tuple(info['start_structures'])],)
+      tasks.append(task)
+    return tasks
+
+  def process_rerun(self, packed):
+    """
+    Replaces the result of a timed-out trajectory by the result of its re-run
+    with a longer time limit. If it timed out again and the cap has not been
+    reached yet, it is queued for another re-run.
+    """
+    rerun = packed['rerun']
+    index = rerun['simulation_index']
+    data = self._ms_store.data()
+    self._ms_summary.remove(data['tags'][index], data['times'][index],
+        data['valid'][index], data['kcoll'][index] if 'kcoll' in data else None)
+    self._ms_store.put([index], packed)
+    data = self._ms_store.data()
+    row = {k: v[index:index+1] for k,v in data.items()}
+    self._ms_summary.add(row['tags'], row['times'], row['valid'], row.get('kcoll'))
+
+    info = next(info for info in self._ms_results_invalid
+                if info.get('simulation_index') == index)
+    if packed['valid'][0]:
+      self._ms_results_invalid.remove(info)
+      change = {'invalid_removed': [index]}
+    else:
+      new_info = dict(packed['invalid'][0])
+      new_info.pop('batch_index')
+      info.update(new_info, simulation_time = rerun['simulation_time'])
+      if self._needs_rerun(info):
+        self._rerun_queue.append(info)
+      change = {'invalid': [info]}
+    if self._data_listeners:
+      self._notify_data_listeners(start = index, rows = row, **change)
+    self.record_timing(packed)
+
+  def escalate_timeouts(self):
+    """
+    Re-runs timed-out trajectories with successively longer time limits until
+    all of them have finished or reached the cap.
+    """
+    while self._rerun_queue:
+      tasks = self.rerun_tasks()
+      if not self.multiprocessing:
+        for task in tasks:
+          self.process_rerun(run_sims_global(task))
+        continue
+      try:
+        for res in self.worker_pool.imap_unordered(run_sims_global, tasks):
+          self.process_rerun(res)
+      except KeyboardInterrupt:
+        print("\nSIGINT: Terminating Multistrand processes prematurely...")
+        self.worker_pool.terminate()
+        raise KeyboardInterrupt
 
   def reduce_error_to(self, rel_goal, max_sims,
       reaction = 'overall',
       stat = 'rate',
-      init_batch_size = 100,
-      min_batch_size = 50,
-      max_batch_size = 1000,
+      init_batch_size = None,
+      min_batch_size = None,
+      max_batch_size = None,
       sims_per_update = 1,
-      sims_per_worker = 1,
+      sims_per_worker = None,
+      streaming = False,
+      budget = None,
       verbose = 0):
     """Stochastic simulations to reduce the error to rel_goal*mean or until max_sims is reached.
+
+    By default, simulations are run in batches: the size of the next batch is
+    estimated from the current error, and the error is only re-evaluated once
+    the whole batch has finished. In streaming mode, simulations are instead
+    submitted continuously (see scheduler.SimulationScheduler) and the stopping
+    rule is checked whenever results arrive. Once the goal is met, no further
+    simulations are submitted; those still running are awaited and included,
+    so that the early-finishing (fast) trajectories do not bias the estimate.
     
     Args:
       rel_goal (float): The realtive error goal.
@@ -322,6 +712,14 @@ class MultistrandJob:
         new error-bars are calculated.  
       max_batch_size (int, optional): Maximum batch size for sampling before 
         new error-bars are calculated.
+      sims_per_worker (int, optional): Number of simulations per task sent to
+        a worker process.
+      streaming (bool, optional): Check the stopping rule as results arrive
+        instead of after each batch. Defaults to False.
+      budget (sim_utils.Budget, optional): A wall-clock and/or CPU time budget.
+        No simulations are submitted once it is used up, and batches are
+        sized to fit into what remains of it. The budget may be shared with
+        other jobs.
       verbose (int, optional): Print a progress table. 0: silent mode,
         1: print the rows of a table. 2: print header and rows of a table,
         3: start a new row for every new batch. 4: start a new row whenever
@@ -333,8 +731,8 @@ class MultistrandJob:
       # toward fast reactions at runtime ...
       if verbose > 3: inline = False
       total_sims = self.total_sims
-      total_success = (self._ms_results['tags']==self._tag_id_dict[reaction]).sum()
-      total_timeout = total_sims - int((self._ms_results['valid']).sum())
+      total_success = self._ms_summary.count(self._tag_id_dict[reaction])
+      total_timeout = total_sims - self._ms_summary.n_valid
       total_failure = total_sims - total_success - total_timeout
 
       if exp_add_sims is None:
@@ -352,20 +750,24 @@ class MultistrandJob:
             total_sims / (total_sims+max(0, exp_add_sims-batch_sims_done)))], inline)
 
     def calc_mean():
-      return self._stats_funcs[stat][0](self._tag_id_dict[reaction], self._ms_results)
+      return self._stats_funcs[stat][0](self._tag_id_dict[reaction], self._ms_summary)
 
     def calc_error():
-      return self._stats_funcs[stat][2](self._tag_id_dict[reaction], self._ms_results)
+      return self._stats_funcs[stat][2](self._tag_id_dict[reaction], self._ms_summary)
 
     num_sims = 0
     error = calc_error()
     mean = calc_mean()
     goal = rel_goal * mean
+    if budget is not None:
+      budget.start()
+    auto_batch_sizes = (init_batch_size is None and min_batch_size is None
+                        and max_batch_size is None)
 
     if verbose:
       if verbose > 1:
         if self.multiprocessing:
-          print(f'#    [MULTIPROCESSING ON] (over {self._mp_ctx.cpu_count()} cores)')
+          print(f'#    [MULTIPROCESSING ON] (over {self.worker_pool.processes} cores)')
         else:
           print('#    [MULTIPROCESSING OFF]')
 
@@ -377,32 +779,79 @@ class MultistrandJob:
       table_update_func([mean, error, goal, " |"
         "--/--", "--/--", "--/--/--", "--"])
 
+    def streaming_status_func(sims_done):
+      # Unlike in batch mode, the estimates are updated with every result
+      nonlocal mean, error, goal, exp_add_sims
+      mean, error = calc_mean(), calc_error()
+      goal = rel_goal * mean
+      if self.total_sims == 0 or error == float('inf') or goal == 0.0:
+        exp_add_sims = None
+      else:
+        exp_add_sims = sims_done + max(0, int(self.total_sims * ((error/goal)**2 - 1) + 1))
+      status_func(sims_done)
+
     # Run simulations
-    while (
+    if streaming:
+      num_trials, exp_add_sims = max_sims, None
+      streamer = scheduler.SimulationScheduler(sims_per_worker = sims_per_worker)
+      streamer.add_job(self, [(reaction, stat, rel_goal)], max_sims,
+          init_batch_size = init_batch_size,
+          min_batch_size = min_batch_size,
+          max_batch_size = max_batch_size,
+          budget = budget,
+          status_func = streaming_status_func if verbose else None)
+      total_sims_before = self.total_sims
+      streamer.run()
+      num_sims = self.total_sims - total_sims_before
+      error = calc_error()
+      mean = calc_mean()
+      goal = rel_goal * mean
+
+    while not streaming and (budget is None or not budget.expired) and (
         # await convergence criterion
         (error > goal and num_sims < max_sims)
         # force evaluation of first batch (e.g., even if `error-goal` is too high),
         # except when `max_sims == 0` (e.g., during `export_data()`)
         or (num_sims == 0 and max_sims > 0)):
 
+      # Batch and task sizes that are not given explicitly are re-tuned for
+      # every batch, based on the measured throughput and overhead
+      spw, init_bs, min_bs, max_bs = self.batch_params(sims_per_worker,
+          init_batch_size, min_batch_size, max_batch_size)
+
       # Estimate additional trials based on inverse square root relationship
       # between error and number of trials
       if self.total_sims == 0 :
-        num_trials = min(max_sims-num_sims, init_batch_size)
+        num_trials = min(max_sims-num_sims, init_bs)
         exp_add_sims = None
       elif error == float('inf') or goal == 0.0:
-        num_trials = min(max_sims-num_sims, max_batch_size)
+        num_trials = min(max_sims-num_sims, max_bs)
         exp_add_sims = None
       else:
         exp_add_sims = int(self.total_sims * ((error / goal)**2 - 1) + 1)
-        num_trials = max(min(max_batch_size, exp_add_sims, self.total_sims + 1), min_batch_size)
+        num_trials = max(min(max_bs, exp_add_sims, self.total_sims + 1), min_bs)
+      if auto_batch_sizes:
+        # Let every worker finish at about the same time
+        num_trials = self.batch_tuner.round_batch(num_trials, self.processes, spw)
       num_trials = min(num_trials, max_sims - num_sims)
+      if budget is not None:
+        # Stop at the deadline rather than beyond it
+        affordable = budget.affordable_sims(
+            self.batch_tuner.effective_seconds_per_sim(spw), self.processes)
+        if affordable is not None:
+          if affordable < 1:
+            break
+          num_trials = min(num_trials, affordable)
         
       self.preallocate_batch(num_trials)
+      batch_start = time.perf_counter()
       self.run_simulations(num_trials, 
           sims_per_update = sims_per_update, 
-          sims_per_worker = sims_per_worker, 
+          sims_per_worker = spw, 
           status_func = status_func if verbose else None)
+      if budget is not None:
+        # All processes are busy with this job until the batch has finished
+        budget.charge((time.perf_counter() - batch_start) * self.processes)
       if verbose:
         status_func(num_trials, inline=(verbose <= 2))
 
@@ -412,8 +861,8 @@ class MultistrandJob:
       goal = rel_goal * mean
 
     total_sims = self.total_sims
-    total_success = (self._ms_results['tags']==self._tag_id_dict[reaction]).sum()
-    total_timeout = total_sims - int((self._ms_results['valid']).sum())
+    total_success = self._ms_summary.count(self._tag_id_dict[reaction])
+    total_timeout = total_sims - self._ms_summary.n_valid
     total_failure = total_sims - total_success - total_timeout
 
     if error == float('inf') or goal == 0.0:
@@ -435,6 +884,11 @@ class MultistrandJob:
           "{:d}/{:d}/{:d}".format(total_success, total_failure, total_timeout),
           "{:.1%}".format(total_sims / (total_sims+exp_add_sims))], inline=False)
 
+      # Neither the goal nor max_sims stopped the simulations
+      if budget is not None and error > goal and num_sims < max_sims:
+        print(sim_utils.budget_gap_message(
+          "{} of {}".format(stat, reaction), error, goal, exp_add_sims))
+
 
 class FirstPassageTimeModeJob(MultistrandJob):
   
@@ -456,37 +910,7 @@ class FirstPassageTimeModeJob(MultistrandJob):
     self._stats_funcs['k2'] = (
       sim_utils.uni_k2_mean, sim_utils.uni_k2_std, sim_utils.uni_k2_error)
 
-  def process_results(self, ms_options):
-    results = ms_options.interface.results
-    n = len(results)
-    
-    tags = [self._tag_id_dict[r.tag] for r in results]
-    valid = [t!=self._tag_id_dict[MS_TIMEOUT]
-             and t!=self._tag_id_dict[MS_ERROR] for t in tags]
-    times = [r.time for r in results]
 
-    start_ind, end_ind = self.total_sims, self.total_sims+n
-    self._ms_results_buff['valid'][start_ind:end_ind] = valid
-    self._ms_results_buff['tags'][start_ind:end_ind] = tags
-    self._ms_results_buff['times'][start_ind:end_ind] = times
-
-    ## Store extra information about invalid simulations
-    for i in range(n):
-      if not valid[i]:
-        self._ms_results_invalid.append({
-            'simulation_index': i+self.total_sims,
-            'end_time': times[i],
-            'type': 'timeout' if tags[i]==self._tag_id_dict[MS_TIMEOUT] else 'error',
-            'seed': results[i].seed,
-            'start_structure': results[i].start_state,
-            'end_state': [list(v) for v in ms_options.interface.end_states[i]]
-        })
-
-    self.total_sims = self.total_sims + n
-    for k in self._ms_results:
-      self._ms_results[k] = self._ms_results_buff[k][:self.total_sims]
-      
-      
 class TransitionModeJob(MultistrandJob):
   ## Warning: this class is largely untested  
   def __init__(self, start_state, macrostates, stop_states, **kargs):
@@ -505,33 +929,22 @@ class TransitionModeJob(MultistrandJob):
   
   def get_statistic(self, start_states, end_states, stat = 'rate'):
     tag = self.get_tag(start_states, end_states)
-    return self._stats_funcs[stat][0](self._tag_id_dict[tag], self._ms_results)
+    return self._stats_funcs[stat][0](self._tag_id_dict[tag], self._ms_summary)
 
   def get_statistic_error(self, start_states, end_states, stat = 'rate'):
     tag = self.get_tag(start_states, end_states)
-    return self._stats_funcs[stat][2](self._tag_id_dict[tag], self._ms_results)
+    return self._stats_funcs[stat][2](self._tag_id_dict[tag], self._ms_summary)
   
-  def process_results(self, ms_options):
-    results = ms_options.interface.results
-    n = len(results)
-    transition_paths = ms_options.interface.transition_lists
+  def process_results(self, packed):
+    n = len(packed['tags'])
+    transition_paths = packed['transition_lists']
     
-    tags = [self._tag_id_dict[r.tag] for r in results]
-    valid = [t!=self._tag_id_dict[MS_TIMEOUT]
-             and t!=self._tag_id_dict[MS_ERROR] for t in tags]
-    times = [r.time for r in results]
+    tags = list(packed['tags'])
+    valid = list(packed['valid'])
+    times = list(packed['times'])
 
     ## Store extra information about invalid simulations
-    for i in range(n):
-      if not valid[i]:
-        self._ms_results_invalid.append({
-            'simulation_index': i+self.total_sims,
-            'end_time': times[i],
-            'type': 'timeout' if tags[i]==self._tag_id_dict[MS_TIMEOUT] else 'error',
-            'seed': results[i].seed,
-            'start_structure': results[i].start_state,
-            'end_state': [list(v) for v in ms_options.interface.end_states[i]]
-        })
+    self.add_invalid_results(packed)
  
     for path in transition_paths:
       collapsed_path = collapse_transition_path(path)
@@ -546,16 +959,11 @@ class TransitionModeJob(MultistrandJob):
         times.append(time_diff)
         valid.append(True)
 
-    # Make sure there's enough space
-    self.preallocate_batch(self.total_sims+len(tags) - len(self._ms_results_buff['tags']))
-
-    self._ms_results_buff['valid'][self.total_sims:self.total_sims+len(tags)] = valid
-    self._ms_results_buff['tags'][self.total_sims:self.total_sims+len(tags)] = tags
-    self._ms_results_buff['times'][self.total_sims:self.total_sims+len(times)] = times
-
-    self.total_sims += len(results)
-    for k in self._ms_results:
-      self._ms_results[k] = self._ms_results_buff[k][:self.total_sims]
+    # Transitions are stored as additional rows, but only the simulated
+    # trajectories count towards total_sims
+    self._append_results({'valid': valid, 'tags': tags, 'times': times})
+    self.total_sims += n
+    self.record_timing(packed)
     
   def collapse_transition_path(transition_path):
     """transition path is a list of the form
@@ -579,6 +987,8 @@ class TransitionModeJob(MultistrandJob):
 
 
 class FirstStepModeJob(MultistrandJob):
+  result_columns = MultistrandJob.result_columns + ['kcoll']
+
   def __init__(self, start_state, stop_conditions, **kargs):
     super().__init__(start_state, stop_conditions, MSLiterals.first_step, **kargs)
     self._tag_id_dict.pop('overall')
@@ -595,48 +1005,3 @@ class FirstStepModeJob(MultistrandJob):
       sim_utils.k1_mean, sim_utils.k1_std, sim_utils.k1_error)
     self._stats_funcs['k2'] = (
       sim_utils.k2_mean, sim_utils.k2_std, sim_utils.k2_error)
-
-    self._ms_results['kcoll'] = np.array([])
-    self._ms_results_buff['kcoll'] = np.array([])
-
-  def preallocate_batch(self, batch_size):
-    self._ms_results_buff['valid'].resize(self.total_sims+batch_size, refcheck=False)
-    self._ms_results_buff['tags'].resize(self.total_sims+batch_size, refcheck=False)
-    self._ms_results_buff['times'].resize(self.total_sims+batch_size, refcheck=False)
-    self._ms_results_buff['kcoll'].resize(self.total_sims+batch_size, refcheck=False)
-    self._ms_results['valid'] = self._ms_results_buff['valid'][:self.total_sims]
-    self._ms_results['tags'] = self._ms_results_buff['tags'][:self.total_sims]
-    self._ms_results['times'] = self._ms_results_buff['times'][:self.total_sims]
-    self._ms_results['kcoll'] = self._ms_results_buff['kcoll'][:self.total_sims]
-
-  def process_results(self, ms_options):
-    results = ms_options.interface.results
-    n = len(results)
-
-    tags = [self._tag_id_dict[r.tag] for r in results]
-    valid = [t!=self._tag_id_dict[MS_TIMEOUT]
-             and t!=self._tag_id_dict[MS_ERROR] for t in tags]
-    times = [r.time for r in results]
-    kcolls = [r.collision_rate for r in results]
-    
-    assert len(self._ms_results_buff['tags']) >= self.total_sims+n
-    self._ms_results_buff['valid'][self.total_sims:self.total_sims+n] = valid
-    self._ms_results_buff['tags'][self.total_sims:self.total_sims+n] = tags
-    self._ms_results_buff['times'][self.total_sims:self.total_sims+n] = times
-    self._ms_results_buff['kcoll'][self.total_sims:self.total_sims+n] = kcolls
-
-    ## Store extra information about invalid simulations
-    for i in range(n):
-      if not valid[i]:
-        self._ms_results_invalid.append({
-            'simulation_index': i+self.total_sims,
-            'end_time': times[i],
-            'type': 'timeout' if tags[i]==self._tag_id_dict[MS_TIMEOUT] else 'error',
-            'seed': results[i].seed,
-            'start_structure': results[i].start_state,
-            'end_state': [list(v) for v in ms_options.interface.end_states[i]]
-        })
-
-    self.total_sims += n
-    for k in self._ms_results:
-      self._ms_results[k] = self._ms_results_buff[k][:self.total_sims]
@@ -6,34 +6,85 @@
 
 
 import math
-import signal
-from typing import List, Tuple, Optional
+import time
+import collections
+from typing import List, Tuple
 
 import numpy as np
-import multiprocess
 
 import multistrand.utils.thermo as nupack
 
 from .. import options
-from ..objects import utils, Complex
-from .sim_utils import print_progress_table
+from ..objects import utils
+from ..objects.structure import dotparen_pair_table
+from .sim_utils import print_progress_table, budget_gap_message
+from . import workerpool
+from .workerpool import WorkerPool
+from .batchtuner import BatchTuner
 
 
+# Similarities of the structures classified by this process, for each job key
+_classified = {}
+# Sampled structures of each job key that this process has not returned yet
+_reservoirs = {}
+
+def classify_structures(complexes, structures):
+  """
+  Returns the similarity (1 minus the maximum fractional domain defect) of
+  each of the nucleotide-level dot-paren structures to each of the complexes,
+  as an array with one row per complex.
+  """
+  pair_tables = np.array([dotparen_pair_table(s) for s in structures])
+  return np.array([1 - utils.max_domain_defects(pair_tables, c.structure)
+                   for c in complexes]).reshape(len(complexes), len(structures))
+
 # NUPACK interface
-def sample_global(job_spec):
+def sample_global(task):
   """
-  Global function for calling NUPACK, used for multiprocessing.
+  Global function for calling NUPACK, used for multiprocessing. The task
+  consists of the key of a registered job spec (see NupackSampleJob.job_key)
+  and the number of secondary structures to sample.
+
+  The samples are classified here, so that the classification runs in
+  parallel: the result is a tuple of arrays (structures, multiplicities,
+  similarities) with the distinct sampled structures (dot-paren strings), the
+  number of samples of each, and the similarity of each structure to each
+  complex of the job spec (one row per complex).
+
+  NUPACK computes the partition function of the strands for every call, so
+  that structures are drawn in bulk (at least the sample_bulk_size of the job
+  spec) and kept in a per-process reservoir from which later tasks of the job
+  are served. The samples are independent, so any of them can be returned.
   """
-  (self, num_samples) = job_spec
-  strands = next(iter(self.restingset.complexes)).strands
-  strand_seqs = [strand.sequence for strand in strands]
+  (job_key, num_samples) = task
+  job_spec = workerpool.get_job_spec(job_key)
+  complexes = job_spec['complexes']
+  strand_seqs = [strand.sequence for strand in job_spec['strands']]
 
   # Call Multistrand's Nupack wrapper
-  structs = nupack.sample(strand_seqs, num_samples, **self._nupack_params)
-
-  # Convert each Nupack sampled structure (a dot-paren string) into a
-  # DNAObjects Complex object and process.
-  return [Complex(strands=strands, structure=s.dp()) for s in structs]
+  reservoir = _reservoirs.setdefault(job_key, [])
+  if len(reservoir) < num_samples:
+    bulk_size = max(num_samples - len(reservoir), job_spec['sample_bulk_size'])
+    structs = nupack.sample(strand_seqs, bulk_size, **job_spec['nupack_params'])
+    reservoir.extend(s.dp() for s in structs)
+  sampled = reservoir[:num_samples]
+  del reservoir[:num_samples]
+
+  # Boltzmann samples are dominated by few structures, which are classified
+  # only once per process
+  counts = collections.Counter(sampled)
+  classified = _classified.setdefault(job_key, {})
+  new = [structure for structure in counts if structure not in classified]
+  if new:
+    for structure, similarities in zip(new, classify_structures(complexes, new).T):
+      classified[structure] = similarities
+  structures = list(counts)
+  similarities = np.zeros((len(complexes), len(structures)))
+  for i, structure in enumerate(structures):
+    similarities[:, i] = classified[structure]
+  return (np.array(structures, dtype = str),
+          np.array([counts[s] for s in structures], dtype = np.int64),
+          similarities)
 
 
 class NupackSampleJob:
@@ -47,23 +98,39 @@ class NupackSampleJob:
     multiprocessing (bool, optional): Distribute computation to all available
         cores. Defaults to True.
     nupack_params (dict): A dictionary with parameter for NUPACK.
+    worker_pool (WorkerPool, optional): Worker processes used for
+        multiprocessing. A private pool is created if none is given.
+    sample_bulk_size (int, optional): Minimum number of structures drawn from
+        NUPACK at once by each process (see sample_global()). Defaults to the
+        nupack_sample_bulk_size parameter.
 
   Use sample() to request a certain number of secondary structures from the
   Boltzmann distribution (using Nupack). Use get_complex_prob() to request the
   probability estimate for a particular complex. To update results for a new
   similarity threshold use set_similarity_threshold().
+
+  Samples are stored as the distinct sampled structures with their
+  multiplicities (see get_sample_data()), and the similarity of a structure to
+  each complex is computed only once.
   """
   verbose = 1
 
   def __init__(self, restingset, similarity_threshold = None, 
-               multiprocessing = True, nupack_params = {}):
+               multiprocessing = True, nupack_params = {}, worker_pool = None,
+               sample_bulk_size = None):
 
     # Store options
     self.multiprocessing = multiprocessing
-    self._mp_ctx = multiprocess.get_context('spawn')
+    self.worker_pool = worker_pool if worker_pool is not None else WorkerPool()
+    self._job_key = None
+    # Chooses batch sizes that are not given explicitly
+    self.batch_tuner = BatchTuner()
 
     # Store nupack params
     self._nupack_params = dict(nupack_params)
+    if sample_bulk_size is None:
+      sample_bulk_size = options.kinda_params['nupack_sample_bulk_size']
+    self._sample_bulk_size = sample_bulk_size
 
     # Store resting set and relevant complex information
     self._restingset = restingset
@@ -71,9 +138,22 @@ class NupackSampleJob:
       [c.name for c in restingset.complexes] + [None])}
     self._complex_counts = [0] * len(self._complex_tags)
     
-    # Data structure for storing raw sampling data
-    self._data = {tag: np.array([]) for tag in self._complex_tags if tag is not None}
+    # Data structure for storing raw sampling data: the distinct structures
+    # (dot-paren strings, or None if unknown), the number of samples of each
+    # structure, and its similarity to each complex
+    self._structures = []
+    self._multiplicities = np.zeros(0, dtype = np.int64)
+    self._data = {tag: np.zeros(0) for tag in self._complex_tags if tag is not None}
+    # Row of each structure (see _sample_key())
+    self._structure_rows = {}
     self.total_sims = 0
+    # Loads the data when first needed (see set_lazy_sample_data())
+    self._data_loader = None
+    # Called with every batch of new sampling data (see add_data_listener())
+    self._data_listeners = []
+    # Identifies the samples of this job in a ResultCache (see
+    # kinda.simulation.resultcache), if set
+    self.cache_key = None
 
     # Set similarity threshold, using default value in options.py if none specified
     if similarity_threshold is None:
@@ -84,6 +164,28 @@ class NupackSampleJob:
   def restingset(self):
     return self._restingset
 
+  @property
+  def processes(self):
+    """ The number of processes sampling for this job. """
+    return self.worker_pool.processes if self.multiprocessing else 1
+
+  @property
+  def job_key(self):
+    """
+    The key under which the job spec (strands, complexes in the order of
+    complex_names, NUPACK parameters and bulk size) is registered with
+    self.worker_pool. Registered on first access.
+    """
+    if self._job_key is None:
+      complexes = {c.name: c for c in self.restingset.complexes}
+      self._job_key = workerpool.new_job_key('nupack')
+      self.worker_pool.register_job_spec(self._job_key, {
+        'strands': next(iter(self.restingset.complexes)).strands,
+        'complexes': [complexes[name] for name in self.complex_names],
+        'nupack_params': self._nupack_params,
+        'sample_bulk_size': self._sample_bulk_size})
+    return self._job_key
+
   @property
   def complex_names(self):
     return sorted([c.name for c in self.restingset.complexes], key = lambda k: self._complex_tags[k])
@@ -128,19 +230,112 @@ class NupackSampleJob:
 
   def get_complex_prob_data(self, complex_name = None):
     """
-    Returns raw sampling data for the given complex_name. Data is returned as a
-    list consisting of float values, where each float value is 1 minus the
-    maximum fractional defect for any domain in that sampled secondary
-    structure.
+    Returns raw sampling data for the given complex_name. Data is returned as
+    an array with one float value per sample, where each float value is 1
+    minus the maximum fractional defect for any domain in that sampled
+    secondary structure. Samples of the same structure are adjacent.
+    """
+    self._load_data()
+    return np.repeat(self._data[complex_name], self._multiplicities)
+
+  def get_sample_data(self):
+    """
+    Returns the raw sampling data as a tuple (structures, multiplicities,
+    similarities): the list of distinct sampled structures (dot-paren strings,
+    or None for samples restored without their structure), the number of
+    samples of each structure, and a dict with the similarity of each
+    structure to each complex name (see get_complex_prob_data()).
+    """
+    self._load_data()
+    return (list(self._structures), self._multiplicities,
+            {name: self._data[name] for name in self.complex_names})
+
+  def get_new_sample_data(self, multiplicities):
+    """
+    Returns the samples added since get_sample_data() returned multiplicities,
+    in the format of get_sample_data().
+    """
+    self._load_data()
+    added = self._multiplicities.copy()
+    added[:len(multiplicities)] -= multiplicities
+    rows = np.flatnonzero(added)
+    return ([self._structures[i] for i in rows], added[rows],
+            {name: self._data[name][rows] for name in self.complex_names})
+
+  def set_sample_data(self, structures, multiplicities, similarities):
     """
-    return self._data[complex_name]
+    Sets the raw sampling data, given in the format of get_sample_data().
+    Should be used only when importing an old KinDA session to restore state.
+    """
+    self._data_loader = None
+    self._clear_data()
+    self._add_rows(structures, multiplicities, similarities)
+    self.total_sims = int(np.sum(self._multiplicities))
+    self.recompute_complex_counts()
 
-  def set_complex_prob_data(self, complex_name, data):
+  def set_lazy_sample_data(self, loader, total_sims, complex_counts):
+    """
+    Sets the raw sampling data to the tuple returned by loader() (in the
+    format of get_sample_data()), which is only called when the data is first
+    needed. Until then, the probabilities are estimated from total_sims and
+    complex_counts, which must be the counts of the data for the current
+    similarity threshold (as in complex_counts). Should be used only when
+    importing an old KinDA session to restore state.
     """
-    Set the raw sampling data for the given complex_name. Should be used only
-    when importing an old KinDA session to restore state.
+    self._data_loader = loader
+    self.total_sims = total_sims
+    self._complex_counts = list(complex_counts)
+
+  def _load_data(self):
+    if self._data_loader is None:
+      return
+    loader, self._data_loader = self._data_loader, None
+    self._clear_data()
+    self._add_rows(*loader())
+
+  def _clear_data(self):
+    self._structures = []
+    self._multiplicities = np.zeros(0, dtype = np.int64)
+    self._data = {name: np.zeros(0) for name in self._data}
+    self._structure_rows = {}
+
+  def _sample_key(self, structure, similarities, i):
+    # Samples are merged by structure, or by their similarities if the
+    # structure is unknown (e.g. in databases of older versions)
+    if structure is not None:
+      return structure
+    return tuple(float(similarities[name][i]) for name in self.complex_names)
+
+  def _add_rows(self, structures, multiplicities, similarities):
     """
-    self._data[complex_name] = np.array(data)
+    Adds samples in the format of get_sample_data() to the stored data,
+    merging them with the stored samples of the same structure. Returns the
+    change as reported to the data listeners (see add_data_listener()).
+    """
+    similarities = {name: np.asarray(similarities[name], dtype = float)
+                    for name in self.complex_names}
+    start = len(self._structures)
+    indices = np.empty(len(structures), dtype = np.int64)
+    new = []
+    for i, structure in enumerate(structures):
+      key = self._sample_key(structure, similarities, i)
+      row = self._structure_rows.get(key)
+      if row is None:
+        row = self._structure_rows[key] = start + len(new)
+        new.append(i)
+      indices[i] = row
+
+    new_structures = [structures[i] for i in new]
+    new_similarities = {name: similarities[name][new] for name in self.complex_names}
+    self._structures.extend(new_structures)
+    for name in self.complex_names:
+      self._data[name] = np.concatenate((self._data[name], new_similarities[name]))
+    self._multiplicities = np.concatenate(
+      (self._multiplicities, np.zeros(len(new), dtype = np.int64)))
+    counts = np.asarray(multiplicities, dtype = np.int64)
+    np.add.at(self._multiplicities, indices, counts)
+    return {'start': start, 'structures': new_structures,
+            'similarities': new_similarities, 'indices': indices, 'counts': counts}
 
   def get_num_sims(self):
     """
@@ -148,6 +343,20 @@ class NupackSampleJob:
     """
     return self.total_sims
 
+  def add_data_listener(self, listener):
+    """
+    Registers listener(job, change) to be called with every batch of new
+    sampling data, e.g. to write it to a checkpoint log. The change is a dict
+    with the index 'start' of the first new structure, the new 'structures'
+    and their 'similarities' to each complex name, and the 'counts' of new
+    samples of the structures at 'indices' (see get_sample_data()). Data set
+    with set_sample_data() is not reported.
+    """
+    self._data_listeners.append(listener)
+
+  def remove_data_listener(self, listener):
+    self._data_listeners.remove(listener)
+
   def get_complex_count(self, complex_name = None):
     # TODO: fix me, why is the int necessary here if complex_name = None???
     return int(self._complex_counts[self.get_complex_index(complex_name)])
@@ -169,45 +378,39 @@ class NupackSampleJob:
   def sample(self, num_samples, status_func=None):
     """
     Calls sample_multiprocessing or sample_singleprocessing depending on the
-    value of self.multiprocessing.
+    value of self.multiprocessing. The throughput is recorded by the batch
+    tuner.
     """
+    start = time.perf_counter()
     if self.multiprocessing:
       self.sample_multiprocessing(num_samples, status_func=status_func)
     else:
       self.sample_singleprocessing(num_samples, status_func=status_func)
+    self.batch_tuner.record_batch(
+      num_samples, time.perf_counter() - start, self.processes)
 
   def sample_multiprocessing(self, num_samples, status_func=None):
     """
-    Runs sample() in multiple processes.
+    Runs sample() in multiple processes, using the worker processes of
+    self.worker_pool.
     """
-    # Temporarily remove SIGINT event handler from current process
-    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-    # Create Pool instance and worker processes
-    k = min(self._mp_ctx.cpu_count(), num_samples)
-    p = self._mp_ctx.Pool(processes=k)
-
-    # Restore original SIGINT event handler (if possible)
-    if sigint_handler is None: sigint_handler = signal.SIG_DFL
-    signal.signal(signal.SIGINT, sigint_handler)
-
     # Setup args for each process
+    job_key = self.job_key
+    k = min(self.worker_pool.processes, num_samples)
     samples_per_worker = int(num_samples / k)
-    args = [(self, samples_per_worker+1)] * (num_samples % k)
-    args += [(self, samples_per_worker)] * (k - (num_samples % k))
-    it = p.imap_unordered(sample_global, args)
-    p.close()
+    args = [(job_key, samples_per_worker+1)] * (num_samples % k)
+    args += [(job_key, samples_per_worker)] * (k - (num_samples % k))
+    it = self.worker_pool.imap_unordered(sample_global, args)
     try:
       sims_completed = 0
-      for cplx in it:
-        self.add_sampled_complexes(cplx)
-        sims_completed += len(cplx)
+      for sampled in it:
+        self.add_sampled_structures(sampled)
+        sims_completed += int(np.sum(sampled[1]))
         if status_func is not None:
           status_func(sims_completed)
     except KeyboardInterrupt:
       print("\nSIGINT: Ending NUPACK sampling prematurely...")
-      p.terminate()
-      p.join()
+      self.worker_pool.terminate()
       raise KeyboardInterrupt
 
   def sample_singleprocessing(self, num_samples, status_func=None):
@@ -219,60 +422,71 @@ class NupackSampleJob:
     given to this job during initialization is passed along to the Nupack Python
     interface.
     """
-    results = sample_global((self, num_samples))
-    self.add_sampled_complexes(results)
+    results = sample_global((self.job_key, num_samples))
+    self.add_sampled_structures(results)
     if status_func is not None:
-      status_func(len(results))
+      status_func(int(np.sum(results[1])))
 
-  def add_sampled_complexes(self, sampled):
+  def add_sampled_structures(self, sampled):
     """
-    Processes a list of sampled Complex objects, computing the similarity to
-    each of the resting set conformations and updating the estimates for each
-    conformation probability.
+    Processes classified samples as returned by sample_global(), updating the
+    estimates for each conformation probability.
     """
-    self.update_complex_counts(len(sampled), sampled)
-    self.total_sims += len(sampled)
+    structures, multiplicities, similarities = sampled
+    self.add_sample_data([str(s) for s in structures], multiplicities,
+      dict(zip(self.complex_names, similarities)))
+
+  def add_sample_data(self, structures, multiplicities, similarities):
+    """
+    Adds samples given in the format of get_sample_data() and updates the
+    estimates for each conformation probability. Samples of a structure that
+    is already stored only increase its multiplicity.
+    """
+    self._load_data()
+    change = self._add_rows(structures, multiplicities, similarities)
+    self.update_complex_counts(change['counts'],
+      {name: similarities[name] for name in self.complex_names})
+    self.total_sims += int(np.sum(change['counts']))
+    for listener in self._data_listeners:
+      listener(self, change)
 
   def recompute_complex_counts(self):
     """
     Recalculate complex counts.
     """
+    self._load_data()
     self._complex_counts = [0] * len(self._complex_tags)
-    self.update_complex_counts(self.total_sims, None)
+    self.update_complex_counts(self._multiplicities, self._data)
 
-  def update_complex_counts(self, num_samples: int, new_data: Optional[List]):
+  def update_complex_counts(self, multiplicities, similarities):
     """
     For each complex in the resting set and for the spurious macrostate, add the
     number of sampled secondary structures that satisfy the similarity threshold
-    to the running complex count.
+    to the running complex count. The samples are given as the multiplicities
+    of structures and the similarities of each structure to each complex.
 
     A conformation is considered spurious if it does not satisfy the similarity
     threshold for any of the predicted conformations in the resting set.
     """
-    spurious_similarities = np.full(num_samples, True)
+    multiplicities = np.asarray(multiplicities, dtype = np.int64)
+    spurious_mask = np.full(len(multiplicities), True)
 
     # update resting set complexes
     for c in self.restingset.complexes:
-      if new_data is None:
-        similarities = self._data[c.name]
-      else:
-        similarities = np.array([1-utils.max_domain_defect(s, c.structure)
-                                 for s in new_data])
-        self._data[c.name] = np.concatenate((self._data[c.name], similarities))
-
-      similar_mask = similarities >= self.similarity_threshold
-      num_similar = np.sum(similar_mask)
-      spurious_similarities *= ~similar_mask
-      self._complex_counts[self.get_complex_index(c.name)] += num_similar
+      similar_mask = np.asarray(similarities[c.name]) >= self.similarity_threshold
+      spurious_mask &= ~similar_mask
+      self._complex_counts[self.get_complex_index(c.name)] += int(
+        np.sum(multiplicities[similar_mask]))
 
     # update spurious complexes
     spurious_idx = self.get_complex_index(None)
-    self._complex_counts[spurious_idx] += np.sum(spurious_similarities)
+    self._complex_counts[spurious_idx] += int(np.sum(multiplicities[spurious_mask]))
 
   def reduce_error_to(self, rel_goal, max_sims, complex_name = None,
-      init_batch_size = 100,
-      min_batch_size = 100,
-      max_batch_size = 1000,
+      init_batch_size = None,
+      min_batch_size = None,
+      max_batch_size = None,
+      budget = None,
       verbose = 0):
     """Stochastic sampling of secondary structures until the error-bars are satisified.
 
@@ -293,10 +507,16 @@ class NupackSampleJob:
         new error-bars are calculated.  
       max_batch_size (int, optional): Maximum batch size for sampling before 
         new error-bars are calculated.
+      budget (sim_utils.Budget, optional): A wall-clock and/or CPU time budget.
+        Sampling stops once it is used up, and batches are sized to fit into
+        what remains of it.
       verbose (int, optional): Print a progress table. 0: silent mode,
         1: print the rows of a table. 2: print header and rows of a table,
         3: start a new row for every new batch. 4: start a new row whenever
         there is new data available. Defaults to 0.
+
+    Batch sizes that are not given are chosen by self.batch_tuner, based on
+    the number of worker processes and the measured sampling throughput.
     """
     def status_func(batch_sims_done, inline=True):
       # Update only the right part of the separator. We don't want to bias the
@@ -323,14 +543,18 @@ class NupackSampleJob:
  
     # Get initial values
     num_sims = 0 # The number of finished simulations.
+    auto_batch_sizes = (init_batch_size is None and min_batch_size is None
+                        and max_batch_size is None)
     prob = self.get_complex_prob(complex_name)
     error = self.get_complex_prob_error(complex_name)
     goal = rel_goal * prob
+    if budget is not None:
+      budget.start()
 
     if verbose:
       if verbose > 1:
         if self.multiprocessing:
-          print(f'#    [MULTIPROCESSING ON] (over {self._mp_ctx.cpu_count()} cores)')
+          print(f'#    [MULTIPROCESSING ON] (over {self.worker_pool.processes} cores)')
         else:
           print('#    [MULTIPROCESSING OFF]')
 
@@ -343,28 +567,50 @@ class NupackSampleJob:
       update_func([complex_name, prob, error, goal, " |", "--/--", "--/--", "--/--", "--"])
 
     # Run simulations
-    while (
+    while (budget is None or not budget.expired) and (
         # await convergence criterion
         (error > goal and num_sims < max_sims)
         # force evaluation of first batch (e.g., even if `error-goal` is too high),
         # except when `max_sims == 0` (e.g., during `export_data()`)
         or (num_sims == 0 and max_sims > 0)):
 
+      # Batch sizes that are not given explicitly are re-tuned for every
+      # batch, based on the measured throughput
+      auto_sizes = self.batch_tuner.batch_sizes(self.processes)
+      init_bs, min_bs, max_bs = [auto if size is None else size
+          for size, auto in zip(
+            [init_batch_size, min_batch_size, max_batch_size], auto_sizes)]
+
       # Estimate additional trials based on inverse square root relationship
       # between error and number of trials
       if self.total_sims == 0:
-        num_trials = init_batch_size
+        num_trials = init_bs
         exp_add_sims = None
       else:
         exp_add_sims = max(0, int(self.total_sims * ((error/goal)**2 - 1) + 1))
         num_trials = max(
-            min(max_batch_size, exp_add_sims, max_sims - num_sims, self.total_sims + 1), 
-            min_batch_size)
+            min(max_bs, exp_add_sims, max_sims - num_sims, self.total_sims + 1), 
+            min_bs)
+      if auto_batch_sizes:
+        # Give every worker the same number of samples
+        num_trials = self.batch_tuner.round_batch(num_trials, self.processes)
+      if budget is not None:
+        # Stop at the deadline rather than beyond it
+        affordable = budget.affordable_sims(
+            self.batch_tuner.effective_seconds_per_sim(
+              max(1, num_trials // self.processes)), self.processes)
+        if affordable is not None:
+          if affordable < 1:
+            break
+          num_trials = min(num_trials, affordable)
         
       # Query Nupack
       if verbose:
         status_func(0) 
+      batch_start = time.perf_counter()
       self.sample(num_trials, status_func=status_func if verbose else None)
+      if budget is not None:
+        budget.charge((time.perf_counter() - batch_start) * self.processes)
       if verbose:
         status_func(num_trials, inline=(verbose <= 2))
 
@@ -385,6 +631,11 @@ class NupackSampleJob:
         "{:d}/{:d}".format(tot_sims, exp_add_sims), 
         "{:d}/{:d}".format(total_success, total_failure), 
         "{:.1%}".format(tot_sims / max([0,tot_sims+exp_add_sims]))], inline=False)
+
+      # Neither the goal nor max_sims stopped the sampling
+      if budget is not None and error > goal and num_sims < max_sims:
+        print(budget_gap_message(
+          "complex {}".format(complex_name), error, goal, exp_add_sims))
     return num_sims
 
   def get_top_MFE_structs(self, num) -> List[Tuple[str, float]]:
@@ -0,0 +1,239 @@
+# resultcache.py
+#
+# Defines the ResultCache class, a persistent cache of Multistrand trajectories
+# and NUPACK samples that is shared by all Systems containing the same
+# reactions and resting sets, and the content-based keys of the cached jobs.
+
+import json
+import uuid
+import hashlib
+import collections
+
+import numpy as np
+
+from ..objects import Macrostate
+from ..objects import io_SQLite
+
+
+# Identifies the cached results of a job: digest is a hash of everything the
+# results depend on, and labels maps the job's tags (or, for NUPACK jobs, its
+# complex names) to labels that do not depend on names given in a System.
+CacheKey = collections.namedtuple('CacheKey', ['digest', 'labels'])
+
+# Multistrand parameters that do not change the simulated trajectories
+_IGNORED_MULTISTRAND_PARAMS = {'verbosity', 'output_interval'}
+
+
+def complex_key(cpx):
+  """
+  Returns a description of a complex that does not depend on object names:
+  the sequence and domain lengths of each strand and the structure, in the
+  complex's canonical form (see Complex.canonical_form). Raises a ValueError
+  for pseudoknotted complexes, which have no dot-paren structure.
+  """
+  if cpx.structure.pseudoknotted:
+    raise ValueError("Cannot describe pseudoknotted complex {}.".format(cpx))
+  strands, structure = cpx.canonical_form
+  return [[str(s.sequence) for s in strands],
+          [[d.length for d in s.base_domains()] for s in strands],
+          structure.to_dotparen()]
+
+def restingset_key(restingset):
+  return sorted(complex_key(c) for c in restingset.complexes)
+
+def macrostate_key(macrostate):
+  """ Returns a description of a Macrostate that does not depend on names. """
+  type_name = next(name for name, t in Macrostate.types.items()
+                   if t == macrostate.type)
+  if type_name in ('conjunction', 'disjunction'):
+    return [type_name, sorted(macrostate_key(m) for m in macrostate.macrostates)]
+  elif type_name in ('count', 'loose'):
+    return [type_name, complex_key(macrostate.complex), macrostate.cutoff]
+  return [type_name, complex_key(macrostate.complex)]
+
+def _digest(description):
+  text = json.dumps(description, sort_keys = True, default = str)
+  return hashlib.sha256(text.encode()).hexdigest()
+
+
+def multistrand_cache_key(job, reactants, stop_conditions, kinda_params):
+  """
+  Returns the CacheKey of a Multistrand job simulating the given reactants
+  (resting sets) until one of the stop_conditions (Macrostates named after
+  the job's tags), or None if the stop conditions cannot be told apart by
+  their content or a complex cannot be described (see complex_key()).
+
+  The key covers the job's simulation mode, the canonical forms of the
+  reactants and stop conditions, the parameters used to select start states,
+  and the Multistrand parameters. Re-runs of timed-out trajectories (see
+  MultistrandJob.timeout_escalation) are not part of the key.
+  """
+  try:
+    stop_keys = [macrostate_key(sc) for sc in stop_conditions]
+    reactant_keys = sorted(restingset_key(rs) for rs in reactants)
+  except ValueError:
+    return None
+  order = sorted(range(len(stop_keys)), key = lambda i: json.dumps(stop_keys[i]))
+  if len(set(json.dumps(k) for k in stop_keys)) != len(stop_keys):
+    return None
+  labels = {stop_conditions[i].name: 'stop{}'.format(rank)
+            for rank, i in enumerate(order)}
+
+  start_mode = kinda_params.get('start_macrostate_mode', 'ordered-complex')
+  description = {
+    'job': type(job).__name__,
+    'reactants': reactant_keys,
+    'stop_conditions': [stop_keys[i] for i in order],
+    'start_macrostate_mode': start_mode,
+    'multistrand_similarity_threshold':
+      None if start_mode == 'ordered-complex'
+      else kinda_params['multistrand_similarity_threshold'],
+    'multistrand_params': {k: v for k,v in job.multistrand_params.items()
+                           if k not in _IGNORED_MULTISTRAND_PARAMS}
+  }
+  return CacheKey(_digest(description), labels)
+
+def nupack_cache_key(job, nupack_params):
+  """
+  Returns the CacheKey of a NUPACK sampling job for its resting set, which
+  covers the canonical forms of the resting set's complexes and the NUPACK
+  parameters, or None if a complex cannot be described (see complex_key()).
+  """
+  try:
+    keys = {c.name: json.dumps(complex_key(c)) for c in job.restingset.complexes}
+  except ValueError:
+    return None
+  ranks = {k: rank for rank, k in enumerate(sorted(set(keys.values())))}
+  labels = {name: 'complex{}'.format(ranks[k]) for name, k in keys.items()}
+  description = {
+    'job': type(job).__name__,
+    'restingset': sorted(keys.values()),
+    'nupack_params': dict(nupack_params)
+  }
+  return CacheKey(_digest(description), labels)
+
+
+class ResultCache:
+  """
+  A persistent cache of the Multistrand trajectories and NUPACK samples of
+  jobs, addressed by content (see CacheKey) rather than by System, so that
+  e.g. the reporter reactions shared by many designs are only simulated once.
+
+  attach() fills every job of a System that has a cache key but no data yet
+  with the cached data of its key; sync() adds the data that the jobs gained
+  since to the cache. The cache is an SQLite database (see io_SQLite), so
+  several KinDA processes may use it at the same time.
+
+  Tags are stored by label (see multistrand_cache_key()), as the tag ids of a
+  job depend on the names of its reactions. Re-runs of cached trajectories
+  replace them only in the job, not in the cache.
+
+  Args:
+    path (str): Path of the cache database.
+    timeout (float, optional): Seconds to wait for other writers.
+  """
+  def __init__(self, path, timeout = 60.0):
+    self.path = path
+    self.writer_id = uuid.uuid4().hex
+    self._con = io_SQLite.connect(path, timeout)
+    # Number of trajectories of each attached Multistrand job that are in the
+    # cache, or multiplicities of the cached samples of each NUPACK job (see
+    # NupackSampleJob.get_new_sample_data())
+    self._stored = {}
+
+  def attach(self, sstats, verbose = 0):
+    """
+    Loads cached data into the jobs of sstats that have no data yet, and
+    tracks all jobs with a cache key for sync(). Returns the number of jobs
+    that were loaded from the cache.
+    """
+    jobs = set(sstats.get_stats(rxn).get_multistrandjob()
+               for rxn in sstats._condensed_reactions)
+    jobs |= set(sstats.get_stats(rs).get_nupackjob() for rs in sstats._restingsets)
+    loaded = 0
+    for job in jobs:
+      if job.cache_key is None or job in self._stored:
+        continue
+      if job.total_sims == 0 and self._load(job):
+        loaded += 1
+        if verbose:
+          print("# Loaded {} cached results for {}.".format(job.total_sims, job))
+      if self._is_multistrand_job(job):
+        self._stored[job] = job.total_sims
+      else:
+        self._stored[job] = job.get_sample_data()[1].copy()
+    return loaded
+
+  @staticmethod
+  def _is_multistrand_job(job):
+    # NUPACK jobs have no simulation data (but sampling data of complexes)
+    return hasattr(job, 'get_simulation_data')
+
+  def _load(self, job):
+    if self._is_multistrand_job(job):
+      batches, invalid, _ = io_SQLite.read_trajectory_batches(
+        self._con, job.cache_key.digest)
+      if not batches:
+        return False
+      data = io_SQLite.load_trajectories(self.path, [i for i, _ in batches])
+      data['tags'] = self._map_tags(job, data['tags'], to_cache = False)
+      job.set_simulation_data(data)
+      job.set_invalid_simulation_data(invalid)
+    else:
+      labels = job.cache_key.labels
+      batches, (structures, multiplicities, similarities) = \
+        io_SQLite.read_sample_batches(
+          self._con, job.cache_key.digest, set(labels.values()))
+      if not batches:
+        return False
+      job.set_sample_data(structures, multiplicities,
+        {name: similarities[labels[name]] for name in job.complex_names})
+    return True
+
+  def _map_tags(self, job, tags, to_cache):
+    # Tag ids of the job <-> ids of the labels in the cache (the rank of the
+    # label); ids of invalid simulations (< 0) are the same in both
+    labels = job.cache_key.labels
+    ranks = {label: rank for rank, label in enumerate(sorted(labels.values()))}
+    pairs = [(tag_id, ranks[labels[tag]])
+             for tag, tag_id in job.tag_id_dict.items() if tag_id >= 0]
+    if not to_cache:
+      pairs = [(b, a) for a, b in pairs]
+    tags = np.asarray(tags)
+    if len(tags) == 0:
+      return tags
+    lo = min(int(tags.min()), 0)
+    lookup = np.arange(lo, max(int(tags.max()), len(pairs)) + 1)
+    for a, b in pairs:
+      lookup[a - lo] = b
+    return lookup[tags - lo].astype(tags.dtype)
+
+  def sync(self):
+    """ Adds the data gained by the attached jobs since the last sync(). """
+    with io_SQLite.transaction(self._con) as con:
+      for job, stored in self._stored.items():
+        if self._is_multistrand_job(job):
+          if job.total_sims <= stored:
+            continue
+          data = {k: v[stored:job.total_sims]
+                  for k,v in job.get_simulation_data().items()}
+          data['tags'] = self._map_tags(job, data['tags'], to_cache = True)
+          invalid = [dict(info, simulation_index = info['simulation_index'] - stored)
+                     for info in job.get_invalid_simulation_data()
+                     if info['simulation_index'] >= stored]
+          io_SQLite.insert_trajectories(con, job.cache_key.digest, self.writer_id,
+            data, invalid, 0, len(data['tags']))
+          self._stored[job] = job.total_sims
+        else:
+          if job.total_sims <= np.sum(stored):
+            continue
+          labels = job.cache_key.labels
+          structures, multiplicities, similarities = job.get_new_sample_data(stored)
+          io_SQLite.insert_samples(con, job.cache_key.digest, self.writer_id,
+            [labels[name] for name in job.complex_names], structures,
+            multiplicities, [similarities[name] for name in job.complex_names])
+          self._stored[job] = job.get_sample_data()[1].copy()
+
+  def close(self):
+    self.sync()
+    self._con.close()
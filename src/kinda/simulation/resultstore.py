@@ -0,0 +1,170 @@
+# resultstore.py
+#
+# Defines the ResultStore class, a growable columnar store for the per-
+# trajectory results of a MultistrandJob.
+
+import numpy as np
+
+
+class ResultStore:
+  """
+  Stores one value per simulated trajectory in each of a fixed set of columns
+  (e.g. 'valid', 'tags', 'times' and, in first step mode, 'kcoll'), each in
+  its own NumPy array.
+
+  Appending is O(1) amortised: the capacity of all columns is doubled whenever
+  it is exhausted, so that the existing data is copied only O(log n) times in
+  total. Columns use compact dtypes (see COLUMN_DTYPES); the 'tags' column is
+  upcast automatically if a tag id does not fit into its current dtype.
+
+  data() returns views of the filled part of each column. These views remain
+  valid until the next append() that has to grow the store.
+
+  The contents can also be given by a function that is only called once they
+  are first accessed (see set_lazy()), so that restoring a database does not
+  need to read the results of every job.
+
+  Args:
+    columns (list(str)): The names of the columns.
+  """
+  COLUMN_DTYPES = {
+    'valid': np.int8,
+    'tags':  np.int16,
+    'times': np.float64,
+    # Collision rates are only known to a few significant digits; single
+    # precision halves their memory footprint.
+    'kcoll': np.float32
+  }
+
+  def __init__(self, columns):
+    self._size = 0
+    self._columns = {k: np.empty(0, dtype = self.COLUMN_DTYPES[k])
+                     for k in columns}
+    self._loader = None
+
+  def __len__(self):
+    return self._size
+
+  def __contains__(self, column):
+    return column in self._columns
+
+  @property
+  def capacity(self):
+    self._load()
+    return len(self._columns['tags'])
+
+  @property
+  def nbytes(self):
+    """ Memory used by the filled part of the store. """
+    self._load()
+    return sum(col.itemsize * self._size for col in self._columns.values())
+
+  @property
+  def loaded(self):
+    """ False while the contents given to set_lazy() have not been loaded. """
+    return self._loader is None
+
+  def columns(self):
+    return list(self._columns)
+
+  def cast(self, column, values):
+    """ Converts values to the dtype that column uses for storage. """
+    return np.asarray(values).astype(self.COLUMN_DTYPES[column], copy = False)
+
+  def data(self):
+    """ Returns a dict with a view of the filled part of each column. """
+    self._load()
+    return {k: col[:self._size] for k,col in self._columns.items()}
+
+  def reserve(self, capacity):
+    """ Ensures that at least capacity rows fit without further growth. """
+    self._load()
+    if capacity <= self.capacity:
+      return
+    capacity = max(capacity, 2 * self.capacity)
+    for k,col in self._columns.items():
+      new_col = np.empty(capacity, dtype = col.dtype)
+      new_col[:self._size] = col[:self._size]
+      self._columns[k] = new_col
+
+  def _fit_tags(self, tags):
+    # Upcast the tags column if the new tag ids do not fit into its dtype
+    if len(tags) == 0:
+      return
+    col = self._columns['tags']
+    info = np.iinfo(col.dtype)
+    lo, hi = int(np.min(tags)), int(np.max(tags))
+    if lo < info.min or hi > info.max:
+      dtype = np.promote_types(np.min_scalar_type(lo), np.min_scalar_type(hi))
+      self._columns['tags'] = col.astype(np.promote_types(col.dtype, dtype))
+
+  def append(self, data):
+    """
+    Appends the rows given by data, a dict mapping each column name to an
+    array-like of the same length. Keys that are not columns are ignored.
+    """
+    n = len(data['tags'])
+    if n == 0:
+      return
+    self._load()
+    self._fit_tags(data['tags'])
+    self.reserve(self._size + n)
+    for k,col in self._columns.items():
+      col[self._size:self._size+n] = data[k]
+    self._size += n
+
+  def put(self, indices, data):
+    """
+    Overwrites the rows at the given indices (all smaller than len(self)) with
+    the rows given by data, as in append().
+    """
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+      return
+    assert indices.max() < self._size
+    self._load()
+    self._fit_tags(data['tags'])
+    for k,col in self._columns.items():
+      col[indices] = data[k]
+
+  def clear(self):
+    self._loader = None
+    self._size = 0
+
+  def set(self, data):
+    """
+    Replaces the contents of the store with the rows given by data. Arrays
+    that already have the dtypes of the columns are used without copying them
+    (until the store grows), so that memory-mapped columns of a database are
+    only read as far as they are used.
+    """
+    self._loader = None
+    self._columns = {k: np.empty(0, dtype = self.COLUMN_DTYPES[k])
+                     for k in self._columns}
+    self._size = 0
+    self._fit_tags(data['tags'])
+    arrays = {k: np.asarray(data[k]) for k in self._columns}
+    if all(arrays[k].dtype == col.dtype for k,col in self._columns.items()):
+      self._columns = arrays
+      self._size = len(arrays['tags'])
+    else:
+      self.append(data)
+
+  def set_lazy(self, loader, size):
+    """
+    Replaces the contents of the store with the size rows returned by
+    loader(), as in set(), but calls loader() only when the contents are first
+    accessed. len() is available without loading.
+    """
+    self.clear()
+    self._loader = loader
+    self._size = size
+
+  def _load(self):
+    if self._loader is None:
+      return
+    loader, size = self._loader, self._size
+    self._loader = None
+    self.set(loader())
+    assert self._size == size, \
+      "Expected {} rows in the lazily loaded results, got {}.".format(size, self._size)
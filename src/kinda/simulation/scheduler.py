@@ -0,0 +1,290 @@
+# scheduler.py
+#
+# Defines the SimulationScheduler class, which runs the Multistrand simulations
+# of many jobs concurrently on their worker pool, so that the cores are kept
+# busy until every job has reached its error goal.
+
+import queue
+
+from . import multistrandjob
+
+
+class ScheduledJob:
+  """
+  Bookkeeping for one MultistrandJob inside a SimulationScheduler.
+
+  A target is a tuple (reaction, stat, rel_goal), which is met once the
+  standard error of the statistic is at most rel_goal times its mean. Batch
+  sizes are chosen as in MultistrandJob.reduce_error_to(), based on the
+  estimated number of additional simulations needed to meet all targets, and
+  limited to what fits into the job's time budget.
+  """
+  def __init__(self, job, targets, max_sims, init_batch_size, min_batch_size,
+      max_batch_size, on_done, status_func, budget = None):
+    self.job = job
+    self.targets = list(targets)
+    self.max_sims = max_sims
+    self.init_batch_size = init_batch_size
+    self.min_batch_size = min_batch_size
+    self.max_batch_size = max_batch_size
+    self.on_done = on_done
+    self.status_func = status_func
+    self.budget = budget
+    if budget is not None:
+      budget.start()
+
+    self.sims_done = 0
+    self.sims_in_flight = 0
+    # Re-runs of timed-out trajectories (see MultistrandJob.rerun_tasks())
+    self.reruns_in_flight = 0
+    self.finished = False
+
+    self._unmet = None
+    self.update()
+    # As in reduce_error_to(), at least one batch is simulated if max_sims > 0
+    self._forced_sims = self.batch_size()
+
+  def update(self):
+    """ Re-evaluates the targets after new results were added to the job. """
+    self._unmet = []
+    for reaction, stat, rel_goal in self.targets:
+      error = self.job.get_statistic_error(reaction, stat)
+      goal = rel_goal * self.job.get_statistic(reaction, stat)
+      if error > goal:
+        self._unmet.append((error, goal))
+
+  def add_results(self, res):
+    if self.budget is not None:
+      self.budget.charge(multistrandjob.task_cpu_seconds(res))
+    if 'rerun' in res:
+      self.job.process_rerun(res)
+      self.reruns_in_flight -= 1
+    else:
+      num_sims = len(res['tags'])
+      self.job.preallocate_batch(num_sims)
+      self.job.process_results(res)
+      self.sims_in_flight -= num_sims
+      self.sims_done += num_sims
+    self.update()
+    if self.status_func is not None:
+      self.status_func(self.sims_done)
+
+  def unmet_targets(self):
+    """ Returns [(error, goal)] for all targets that are not met yet. """
+    return self._unmet
+
+  def remaining_sims(self):
+    """
+    Estimates the number of additional simulations needed to meet all targets,
+    based on the inverse square root relationship between error and number of
+    simulations. Returns None if no estimate is possible (yet).
+    """
+    total_sims = self.job.total_sims
+    if total_sims == 0:
+      return None
+    estimates = [0]
+    for error, goal in self.unmet_targets():
+      if error == float('inf') or goal == 0.0:
+        return None
+      estimates.append(int(total_sims * ((error / goal)**2 - 1) + 1))
+    return max(estimates)
+
+  def out_of_budget(self):
+    return self.budget is not None and self.budget.expired
+
+  def batch_size(self):
+    """
+    The number of simulations this job may have in flight at the same time.
+    """
+    spw, init_batch_size, min_batch_size, max_batch_size = self.job.batch_params(
+        None, self.init_batch_size, self.min_batch_size, self.max_batch_size)
+    if self.job.total_sims == 0:
+      num_trials = init_batch_size
+    else:
+      exp_add_sims = self.remaining_sims()
+      if exp_add_sims is None:
+        num_trials = max_batch_size
+      else:
+        num_trials = max(min(max_batch_size, exp_add_sims,
+                             self.job.total_sims + 1), min_batch_size)
+    if self.budget is not None:
+      affordable = self.budget.affordable_sims(
+          self.job.batch_tuner.effective_seconds_per_sim(spw), self.job.processes)
+      if affordable is not None:
+        num_trials = min(num_trials, affordable)
+    return max(0, min(num_trials, self.max_sims - self.sims_done))
+
+  def converged(self):
+    # Timed-out trajectories must have been re-run before the job converges
+    return (self.sims_done >= self._forced_sims and not self.unmet_targets()
+            and self.job.pending_reruns == 0 and self.reruns_in_flight == 0)
+
+  def can_submit(self):
+    if self.finished or self.out_of_budget():
+      return False
+    if self.job.pending_reruns > 0:
+      return True
+    if self.converged():
+      return False
+    return (self.sims_in_flight < self.batch_size()
+            and self.sims_done + self.sims_in_flight < self.max_sims)
+
+  def weight(self):
+    """
+    Fraction of the estimated remaining simulations that are in flight. The
+    scheduler submits to the job with the smallest weight, so that jobs far
+    from their goal get proportionally more of the workers.
+    """
+    remaining = self.remaining_sims()
+    if remaining is None:
+      remaining = self.batch_size()
+    return self.sims_in_flight / max(remaining, 1)
+
+
+class SimulationScheduler:
+  """
+  Runs the simulations of several MultistrandJobs at the same time.
+
+  Rather than simulating one job until it reaches its error goal and only then
+  moving on to the next (which leaves cores idle during the tail of every batch
+  and while errors are re-estimated), the scheduler keeps a bounded number of
+  tasks in flight across all jobs. Whenever a task returns, its results are
+  added to the job, the job's estimates are updated, and a new task is
+  submitted to whichever unfinished job has the smallest share of in-flight
+  simulations relative to its estimated remaining simulations.
+
+  Timed-out trajectories of jobs with timeout escalation are re-run (see
+  MultistrandJob.rerun_tasks()) before any new simulations of the same job are
+  submitted, and a job has not converged while any re-runs are outstanding.
+
+  A job stops receiving new tasks as soon as its (partial) results meet all
+  targets, but it is only considered finished once all of its in-flight tasks
+  have returned and the targets are still met, so that fast trajectories that
+  return early do not bias the decision to stop.
+
+  Jobs with multiprocessing disabled are simulated in the main process, one
+  task at a time.
+
+  Each job may have a time budget (see sim_utils.Budget), which can be shared
+  by several jobs or be part of a larger budget. The busy time of every
+  returned task is charged to the budget of its job; a job whose budget is
+  used up receives no new tasks and is finished once its in-flight tasks have
+  returned.
+
+  Args:
+    sims_per_worker (int, optional): Number of simulations per task. Chosen
+      per job by its batch tuner if not given.
+    max_in_flight (int, optional): Maximum number of tasks in flight. Defaults
+      to twice the number of worker processes.
+  """
+  def __init__(self, sims_per_worker = None, max_in_flight = None):
+    self.sims_per_worker = sims_per_worker
+    self.max_in_flight = max_in_flight
+    self._jobs = []
+
+  def add_job(self, job, targets, max_sims,
+      init_batch_size = None,
+      min_batch_size = None,
+      max_batch_size = None,
+      on_done = None,
+      status_func = None,
+      budget = None):
+    """
+    Schedules a MultistrandJob.
+
+    Args:
+      job (MultistrandJob): The job to simulate.
+      targets (list): Tuples (reaction, stat, rel_goal) that must be met.
+      max_sims (int): Maximum number of additional simulations for this job.
+      init_batch_size, min_batch_size, max_batch_size (int, optional): Bounds
+        on the number of simulations in flight for this job, as in
+        MultistrandJob.reduce_error_to(). Chosen by the job's batch tuner if
+        not given.
+      on_done (function, optional): Called with the job and the number of
+        simulations run for it, once the job is finished.
+      status_func (function, optional): Called with the number of simulations
+        run for this job so far, whenever new results have been added.
+      budget (sim_utils.Budget, optional): A time budget for this job.
+    """
+    self._jobs.append(ScheduledJob(job, targets, max_sims,
+      init_batch_size, min_batch_size, max_batch_size, on_done, status_func,
+      budget))
+
+  def _finish(self, sjob):
+    sjob.finished = True
+    if sjob.on_done is not None:
+      sjob.on_done(sjob.job, sjob.sims_done)
+
+  def _next_job(self):
+    candidates = [sjob for sjob in self._jobs if sjob.can_submit()]
+    if not candidates:
+      return None
+    return min(candidates, key = lambda sjob: sjob.weight())
+
+  def run(self):
+    """
+    Simulates until every job has met its targets or used up its budget.
+    """
+    results = queue.Queue()
+    max_in_flight = self.max_in_flight
+    if max_in_flight is None:
+      max_in_flight = 2 * max([sjob.job.worker_pool.processes
+                               for sjob in self._jobs], default = 1)
+    tasks_in_flight = 0
+
+    def submit(sjob):
+      job = sjob.job
+      reruns = job.rerun_tasks(max_tasks = 1)
+      if reruns:
+        sjob.reruns_in_flight += 1
+        run_task(sjob, reruns[0])
+        return
+      sims_per_worker = self.sims_per_worker
+      if sims_per_worker is None:
+        sims_per_worker = job.batch_tuner.sims_per_worker()
+      num_sims = min(sims_per_worker,
+                     sjob.max_sims - sjob.sims_done - sjob.sims_in_flight)
+      if sjob.budget is not None:
+        # Do not submit more than fits into the remaining budget
+        num_sims = min(num_sims, sjob.batch_size() - sjob.sims_in_flight)
+      sjob.sims_in_flight += num_sims
+      run_task(sjob, job.simulation_task(num_sims))
+
+    def run_task(sjob, task):
+      job = sjob.job
+      if job.multiprocessing:
+        job.worker_pool.apply_async(multistrandjob.run_sims_global, (task,),
+            callback = lambda res: results.put((sjob, res, None)),
+            error_callback = lambda err: results.put((sjob, None, err)))
+      else:
+        results.put((sjob, multistrandjob.run_sims_global(task), None))
+
+    try:
+      while True:
+        for sjob in self._jobs:
+          if (not sjob.finished and sjob.sims_in_flight == 0
+              and sjob.reruns_in_flight == 0 and not sjob.can_submit()):
+            self._finish(sjob)
+
+        while tasks_in_flight < max_in_flight:
+          sjob = self._next_job()
+          if sjob is None:
+            break
+          submit(sjob)
+          tasks_in_flight += 1
+          if not sjob.job.multiprocessing:
+            # Process each result before simulating the next task
+            break
+        if tasks_in_flight == 0:
+          break
+
+        sjob, res, err = results.get()
+        tasks_in_flight -= 1
+        if err is not None:
+          raise err
+        sjob.add_results(res)
+    except KeyboardInterrupt:
+      print("\nSIGINT: Terminating Multistrand processes prematurely...")
+      for sjob in self._jobs:
+        sjob.job.worker_pool.terminate()
+      raise KeyboardInterrupt
@@ -5,6 +5,7 @@
 
 import sys
 import math
+import time
 import numpy as np
 
 
@@ -50,34 +51,347 @@ def print_progress_table(col_headers, col_widths = None, col_init_data = None,
   return update_progress
 
 
+class Budget:
+  """
+  A time budget for simulations, given as wall-clock seconds, CPU seconds, or
+  both. The wall clock starts with the first call to start() (or any query);
+  CPU time is whatever the jobs that use the budget charge to it: the busy time
+  of every returned Multistrand task, or the wall time of a NUPACK batch times
+  the number of processes sampling it.
+
+  A budget may be shared, e.g. by all resting sets of a System, so that it caps
+  their combined cost. It may also be part of a parent budget, which is then
+  charged as well and whose limits apply too (e.g. a budget per reaction within
+  a budget for the whole System).
+
+  Jobs check the budget before submitting more work and size their batches to
+  fit the remaining budget, so that they stop cleanly (with all submitted
+  simulations included) at about the deadline rather than beyond it.
+
+  Args:
+    wall_seconds (float, optional): Wall-clock time limit.
+    cpu_seconds (float, optional): CPU time limit, summed over all processes.
+    parent (Budget, optional): A budget that this budget is part of.
+  """
+  def __init__(self, wall_seconds = None, cpu_seconds = None, parent = None):
+    self.wall_seconds = wall_seconds
+    self.cpu_seconds = cpu_seconds
+    self.parent = parent
+    self._started_at = None
+    self._cpu_used = 0.0
+
+  def start(self):
+    """ Starts the wall clock, unless it is running already. """
+    if self._started_at is None:
+      self._started_at = time.monotonic()
+    if self.parent is not None:
+      self.parent.start()
+
+  @property
+  def wall_used(self):
+    self.start()
+    return time.monotonic() - self._started_at
+
+  @property
+  def cpu_used(self):
+    return self._cpu_used
+
+  def charge(self, cpu_seconds):
+    """ Adds cpu_seconds of work to the CPU time used. """
+    self._cpu_used += cpu_seconds
+    if self.parent is not None:
+      self.parent.charge(cpu_seconds)
+
+  def remaining(self, processes = 1):
+    """
+    Returns the remaining budget in CPU seconds that the given number of busy
+    processes can use, or None if the budget is unlimited.
+    """
+    limits = []
+    if self.wall_seconds is not None:
+      limits.append((self.wall_seconds - self.wall_used) * processes)
+    if self.cpu_seconds is not None:
+      limits.append(self.cpu_seconds - self._cpu_used)
+    if self.parent is not None:
+      parent_remaining = self.parent.remaining(processes)
+      if parent_remaining is not None:
+        limits.append(parent_remaining)
+    return max(0.0, min(limits)) if limits else None
+
+  @property
+  def expired(self):
+    remaining = self.remaining()
+    return remaining is not None and remaining <= 0
+
+  def affordable_sims(self, seconds_per_sim, processes = 1):
+    """
+    Returns the number of simulations that fit into the remaining budget, when
+    each takes seconds_per_sim on one of processes busy processes. Returns None
+    if the budget or the time per simulation is unknown.
+    """
+    remaining = self.remaining(processes)
+    if remaining is None or not seconds_per_sim:
+      return None
+    return int(remaining / seconds_per_sim)
+
+  def __str__(self):
+    limits = []
+    if self.wall_seconds is not None:
+      limits.append("{:.1f}/{:.1f} s wall".format(self.wall_used, self.wall_seconds))
+    if self.cpu_seconds is not None:
+      limits.append("{:.1f}/{:.1f} s CPU".format(self._cpu_used, self.cpu_seconds))
+    if self.parent is not None:
+      limits.append("within {}".format(self.parent))
+    return ', '.join(limits) if limits else 'unlimited'
+
+
+def budget_gap_message(name, error, goal, exp_add_sims):
+  """
+  Describes how far an estimate is from its error goal after its time budget
+  ran out, or returns None if the goal has been met.
+  """
+  if error <= goal:
+    return None
+  if error == float('inf') or goal == 0.0 or exp_add_sims is None:
+    return "# Time budget exhausted for {}: error goal not reached, no estimate yet.".format(name)
+  return ("# Time budget exhausted for {}: error is {:.2f}x the goal, "
+          "about {:d} more simulations needed.").format(name, error / goal, exp_add_sims)
+
+
 ################################
 # CUSTOM STATISTICAL FUNCTIONS
 ################################ 
 
+class TagSummary:
+  """
+  Running sufficient statistics of the simulations that ended with one tag:
+  the number of simulations, mean and sum of squared deviations (M2) of the
+  end times and, if available, of the collision rates (kcoll), and the kcoll-
+  weighted mean and M2 of the end times. Batches are merged with the pairwise
+  update of Chan et al., which avoids the cancellation of naive sums of
+  squares, so that all statistics agree with a two-pass computation over the
+  full history to within rounding.
+  """
+  def __init__(self):
+    self.n = 0
+    self.t_mean = 0.0
+    self.t_m2 = 0.0
+    self.k_sum = 0.0
+    self.k_mean = 0.0
+    self.k_m2 = 0.0
+    self.kk_sum = 0.0
+    self.kt_mean = 0.0  # kcoll-weighted
+    self.kt_m2 = 0.0    # kcoll-weighted
+
+  @staticmethod
+  def _merge(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return mean_a + delta * n_b / n, m2_a + m2_b + delta * delta * n_a * n_b / n
+
+  def add(self, times, kcolls = None):
+    """ Adds a batch of end times (and kcoll values) with this tag. """
+    n_b = len(times)
+    if n_b == 0:
+      return
+    t_mean = float(times.mean())
+    self.t_mean, self.t_m2 = self._merge(self.n, self.t_mean, self.t_m2,
+        n_b, t_mean, float(((times - t_mean)**2).sum()))
+
+    if kcolls is not None:
+      k_mean = float(kcolls.mean())
+      self.k_mean, self.k_m2 = self._merge(self.n, self.k_mean, self.k_m2,
+          n_b, k_mean, float(((kcolls - k_mean)**2).sum()))
+      k_sum = float(kcolls.sum())
+      if k_sum > 0:
+        kt_mean = float((kcolls * times).sum()) / k_sum
+        kt_m2 = float((kcolls * (times - kt_mean)**2).sum())
+        if self.k_sum > 0:
+          self.kt_mean, self.kt_m2 = self._merge(self.k_sum, self.kt_mean,
+              self.kt_m2, k_sum, kt_mean, kt_m2)
+        else:
+          self.kt_mean, self.kt_m2 = kt_mean, kt_m2
+      self.k_sum += k_sum
+      self.kk_sum += float((kcolls**2).sum())
+    self.n += n_b
+
+  def merge(self, other):
+    """ Adds the simulations summarised by other, another TagSummary. """
+    if other.n == 0:
+      return
+    self.t_mean, self.t_m2 = self._merge(self.n, self.t_mean, self.t_m2,
+        other.n, other.t_mean, other.t_m2)
+    self.k_mean, self.k_m2 = self._merge(self.n, self.k_mean, self.k_m2,
+        other.n, other.k_mean, other.k_m2)
+    if other.k_sum > 0:
+      if self.k_sum > 0:
+        self.kt_mean, self.kt_m2 = self._merge(self.k_sum, self.kt_mean,
+            self.kt_m2, other.k_sum, other.kt_mean, other.kt_m2)
+      else:
+        self.kt_mean, self.kt_m2 = other.kt_mean, other.kt_m2
+    self.k_sum += other.k_sum
+    self.kk_sum += other.kk_sum
+    self.n += other.n
+
+  def remove(self, time, kcoll = None):
+    """
+    Removes a single simulation with the given end time (and kcoll value) that
+    was added before, by inverting the update of add().
+    """
+    n = self.n - 1
+    if n == 0:
+      self.__init__()
+      return
+    t_mean = (self.n * self.t_mean - time) / n
+    self.t_m2 = max(0.0, self.t_m2 - (time - t_mean) * (time - self.t_mean))
+    self.t_mean = t_mean
+
+    if kcoll is not None:
+      k_mean = (self.n * self.k_mean - kcoll) / n
+      self.k_m2 = max(0.0, self.k_m2 - (kcoll - k_mean) * (kcoll - self.k_mean))
+      self.k_mean = k_mean
+      k_sum = self.k_sum - kcoll
+      if k_sum > 0:
+        kt_mean = (self.k_sum * self.kt_mean - kcoll * time) / k_sum
+        self.kt_m2 = max(0.0,
+            self.kt_m2 - kcoll * (time - kt_mean) * (time - self.kt_mean))
+        self.kt_mean = kt_mean
+      else:
+        self.kt_mean, self.kt_m2 = 0.0, 0.0
+      self.k_sum = k_sum
+      self.kk_sum -= kcoll * kcoll
+    self.n = n
+
+  def to_dict(self):
+    return dict(vars(self))
+
+  @classmethod
+  def from_dict(cls, d):
+    tag_summary = cls()
+    tag_summary.__dict__.update(d)
+    return tag_summary
+
+  def t_var(self):
+    return self.t_m2 / (self.n - 1)
+
+  def k_var(self):
+    return self.k_m2 / (self.n - 1)
+
+
+class ResultsSummary:
+  """
+  Running summary of the simulation results of a MultistrandJob, from which
+  all the statistics below are computed in O(1) time, independent of the
+  number of simulations. A job updates its summary with every batch of new
+  results (see add()). Summaries of a complete results dict (as returned by
+  MultistrandJob.get_simulation_data()) are created with from_results().
+  """
+  def __init__(self):
+    self._tags = {}
+    self.n_valid = 0
+    self.kcoll_max = float('nan')
+
+  @classmethod
+  def from_results(cls, ms_results):
+    summary = cls()
+    summary.add(ms_results['tags'], ms_results['times'], ms_results['valid'],
+                ms_results.get('kcoll'))
+    return summary
+
+  def to_dict(self):
+    """
+    Returns the summary as a dict of plain Python values (e.g. to store it in a
+    database along with the results, see kinda.objects.io_KinDA).
+    """
+    return {'tags': [[tag, ts.to_dict()] for tag, ts in self._tags.items()],
+            'n_valid': self.n_valid, 'kcoll_max': self.kcoll_max}
+
+  @classmethod
+  def from_dict(cls, d):
+    summary = cls()
+    summary._tags = {int(tag): TagSummary.from_dict(ts) for tag, ts in d['tags']}
+    summary.n_valid = d['n_valid']
+    summary.kcoll_max = d['kcoll_max']
+    return summary
+
+  def add(self, tags, times, valid, kcolls = None):
+    """ Adds a batch of results, given as arrays with one entry per simulation. """
+    tags = np.asarray(tags)
+    if len(tags) == 0:
+      return
+    times = np.asarray(times, dtype = np.float64)
+    self.n_valid += int(np.sum(valid))
+    if kcolls is not None:
+      kcolls = np.asarray(kcolls, dtype = np.float64)
+      batch_max = float(kcolls.max())
+      if not batch_max <= self.kcoll_max:
+        self.kcoll_max = batch_max
+    for tag in np.unique(tags):
+      mask = tags == tag
+      tag_summary = self._tags.setdefault(int(tag), TagSummary())
+      tag_summary.add(times[mask], None if kcolls is None else kcolls[mask])
+
+  def merge(self, other):
+    """ Adds the results summarised by other, another ResultsSummary. """
+    for tag, tag_summary in other._tags.items():
+      self._tags.setdefault(tag, TagSummary()).merge(tag_summary)
+    self.n_valid += other.n_valid
+    if not other.kcoll_max <= self.kcoll_max:
+      self.kcoll_max = other.kcoll_max
+
+  def remove(self, tag, time, valid, kcoll = None):
+    """
+    Removes a single simulation that was added before, e.g. to replace it with
+    a re-run. The maximum collision rate is not updated.
+    """
+    tag_summary = self._tags[int(tag)]
+    tag_summary.remove(float(time), None if kcoll is None else float(kcoll))
+    if tag_summary.n == 0:
+      del self._tags[int(tag)]
+    self.n_valid -= int(valid)
+
+  def tags(self):
+    """ The set of tags that occurred in at least one simulation. """
+    return set(self._tags)
+
+  def __getitem__(self, tag):
+    """ Returns the TagSummary for this tag (empty if the tag never occurred). """
+    return self._tags.get(tag, TagSummary())
+
+  def count(self, tag):
+    return self[tag].n
+
+
+def as_summary(ms_results):
+  """
+  Returns ms_results if it is a ResultsSummary, or a ResultsSummary of the
+  given results dict otherwise. All statistical functions below accept both.
+  """
+  if isinstance(ms_results, ResultsSummary):
+    return ms_results
+  return ResultsSummary.from_results(ms_results)
+
 def time_mean(success_tag, ms_results):
   """ Returns the average success time of a simulation. """
-  success_times = np.ma.array(ms_results['times'], mask=(ms_results['tags']!=success_tag))
-  n_s = int(np.sum(~success_times.mask))
-  if n_s > 0:
-    return float(success_times.mean())
+  s = as_summary(ms_results)[success_tag]
+  if s.n > 0:
+    return float(s.t_mean)
   else:
     return float('nan')
 
 def time_std(success_tag, ms_results):
   """ Returns the sample standard deviation for a successful simulation time. """
-  success_times = np.ma.array(ms_results['times'], mask=(ms_results['tags']!=success_tag))
-  n_s = int(np.sum(~success_times.mask))
-  if n_s > 1:
-    return float(success_times.std(ddof=1))
+  s = as_summary(ms_results)[success_tag]
+  if s.n > 1:
+    return float(math.sqrt(s.t_var()))
   else:
     return float('inf')
 
 def time_error(success_tag, ms_results):
   """ Returns the standard error on the mean simulation time. """
-  success_times = np.ma.array(ms_results['times'], mask=(ms_results['tags']!=success_tag))
-  n_s = int(np.sum(~success_times.mask))
-  if n_s > 1:
-    return float(success_times.std(ddof=1) / math.sqrt(n_s))
+  s = as_summary(ms_results)[success_tag]
+  if s.n > 1:
+    return float(math.sqrt(s.t_var()) / math.sqrt(s.n))
   else:
     return float('inf')
 
@@ -86,10 +400,9 @@ def rate_mean(success_tag, ms_results):
   follow an exponential distribution with a mean of 1/r. In this case,
   the correct estimate for the rate is the harmonic mean of the r's.
   If no data has been collected, returns NaN."""
-  success_times = np.ma.array(ms_results['times'], mask=(ms_results['tags']!=success_tag))
-  n_s = int(np.sum(~success_times.mask))
-  if n_s > 0:
-    return float(1./success_times.mean())
+  s = as_summary(ms_results)[success_tag]
+  if s.n > 0:
+    return float(np.float64(1.) / s.t_mean)
   else:
     return float('nan')
 
@@ -104,13 +417,11 @@ def rate_error(success_tag, ms_results):
   of r=1/t, the error in the rates has the same proportion of the estimated
   rate as the error in the times.
   If 1 or fewer data points are collected, returns float('inf')."""
-  success_times = np.ma.array(ms_results['times'], mask=(ms_results['tags']!=success_tag))
-  n_s = int(np.sum(~success_times.mask))
-  if n_s > 1:
-    time_mean = success_times.mean()
-    time_error = success_times.std(ddof=1) / math.sqrt(n_s)
+  s = as_summary(ms_results)[success_tag]
+  if s.n > 1:
+    time_error = math.sqrt(s.t_var()) / math.sqrt(s.n)
     # Based on estimated local linearity of relationship between t and r=1/t
-    return float(time_error / time_mean**2)
+    return float(time_error / np.float64(s.t_mean)**2)
   else:
     return float('inf')
 
@@ -118,46 +429,43 @@ def kcoll_mean(success_tag, ms_results):
   """ Computes the expected kcoll rate, given the sampled kcolls
   from Multistrand trajectories.
   If no kcoll values have been collected for this reaction, returns NaN. """
-  success_kcolls = np.ma.array(ms_results['kcoll'], mask=(ms_results['tags']!=success_tag))
-  n = int(np.sum(ms_results['valid']))
-  n_s = int(np.sum(~success_kcolls.mask))
-  if n_s > 0:
-    return float(success_kcolls.mean())
+  summary = as_summary(ms_results)
+  s = summary[success_tag]
+  n = summary.n_valid
+  if s.n > 0:
+    return float(s.k_mean)
   elif n > 1:
-    return float(ms_results['kcoll'].max())
+    return float(summary.kcoll_max)
   else:
     return float('nan')
 
 def kcoll_std(success_tag, ms_results):
   """ Computes the standard deviation on kcoll, given the sampled values.
   If less than 2 kcoll values have been collected for this reaction, returns float('inf'). """
-  success_kcolls = np.ma.array(ms_results['kcoll'], mask=(ms_results['tags']!=success_tag))
-  n_s = int(np.sum(~success_kcolls.mask))
-  if n_s > 1:
-    return float(success_kcolls.std(ddof=1))
+  s = as_summary(ms_results)[success_tag]
+  if s.n > 1:
+    return float(math.sqrt(s.k_var()))
   else:
     return float('inf')
 
 def kcoll_error(success_tag, ms_results):
   """ Computes the standard error on the expected value of kcoll.  """
-  success_kcolls = np.ma.array(ms_results['kcoll'], mask=(ms_results['tags']!=success_tag))
-  n_s = int(np.sum(~success_kcolls.mask))
-  if n_s > 1:
-    return float(success_kcolls.std(ddof=1) / math.sqrt(n_s))
+  s = as_summary(ms_results)[success_tag]
+  if s.n > 1:
+    return float(math.sqrt(s.k_var()) / math.sqrt(s.n))
   else:
     return float('inf')
 
 def k1_mean(success_tag, ms_results):
   """ Reports the expected value of k1, the rate constant for
   the bimolecular step of a resting-set reaction. """
-  success_kcolls = np.ma.array(ms_results['kcoll'], mask=(ms_results['tags']!=success_tag))
-  n = int(np.sum(ms_results['valid']))
-  n_s = int(np.sum(~success_kcolls.mask))
-  tags = ms_results['tags']
-  if n_s > 0:
-    return float(np.sum(success_kcolls) / (n + 2.0))
+  summary = as_summary(ms_results)
+  s = summary[success_tag]
+  n = summary.n_valid
+  if s.n > 0:
+    return float(s.k_sum / (n + 2.0))
   elif n > 0:
-    return float(ms_results['kcoll'].max() * (n_s + 1.0) / (n + 2.0))
+    return float(summary.kcoll_max * (s.n + 1.0) / (n + 2.0))
   else:
     return float('nan')
 
@@ -169,20 +477,21 @@ def k1_std(success_tag, ms_results):
 def k1_error(success_tag, ms_results):
   """ Reports the standard error on the expected value of k1.
   See the KinDA paper for a derivation. """
-  success_kcolls = np.ma.array(ms_results['kcoll'], mask=(ms_results['tags']!=success_tag))
-  n = int(np.sum(ms_results['valid']))
-  n_s = int(np.sum(~success_kcolls.mask))
+  summary = as_summary(ms_results)
+  s = summary[success_tag]
+  n = summary.n_valid
+  n_s = s.n
   if n_s > 0:
-    gamma = float(np.sum(success_kcolls))
+    gamma = s.k_sum
     return float(gamma/(n+2.) * math.sqrt((2.*n - n_s + 1.) / (n_s * (n+3.))))
   else:
     return float('inf')
 
 def bernoulli_mean(success_tag, ms_results):
   """ Expectation of the bernoulli random variable S_i based on Bayesian analysis """
-  tag_mask = ms_results['tags']==success_tag
-  n = int(np.sum(ms_results['valid']))
-  n_s = int(tag_mask.sum())
+  summary = as_summary(ms_results)
+  n = summary.n_valid
+  n_s = summary.count(success_tag)
   return (n_s + 1.0) / (n + 2.0)
 
 def bernoulli_std(success_tag, ms_results):
@@ -194,19 +503,17 @@ def bernoulli_std(success_tag, ms_results):
 
 def bernoulli_error(success_tag, ms_results):
   """ Returns the standard error of the mean of S_i. """
-  tag_mask = ms_results['tags']==success_tag
-  n = int(np.sum(ms_results['valid']))
-  n_s = int(tag_mask.sum())
+  summary = as_summary(ms_results)
+  n = summary.n_valid
+  n_s = summary.count(success_tag)
   return math.sqrt((n_s+1.0)*(n-n_s+1)/((n+3)*(n+2)*(n+2)));
  
 def k2_mean(success_tag, ms_results):
   """ Returns the expectation of k2, the rate constant for the
   unimolecular step of a resting-set reaction. """
-  success_kcolls = np.ma.array(ms_results['kcoll'], mask=(ms_results['tags']!=success_tag))
-  success_t2s = np.ma.array(ms_results['times'], mask=(ms_results['tags']!=success_tag))
-  n_s = int(np.sum(~success_t2s.mask))
-  if n_s > 0:
-    return float(np.sum(success_kcolls) / np.sum(success_kcolls*success_t2s))
+  s = as_summary(ms_results)[success_tag]
+  if s.n > 0 and s.k_sum > 0:
+    return float(np.float64(1.) / s.kt_mean)
   else:
     return float('nan')
 
@@ -215,19 +522,19 @@ def k2_std(success_tag, ms_results):
   return k2_error(success_tag, ms_results)
 
 def k2_error(success_tag, ms_results):
-  success_kcolls = np.ma.array(ms_results['kcoll'], mask=(ms_results['tags']!=success_tag))
-  success_t2s = np.ma.array(ms_results['times'], mask=(ms_results['tags']!=success_tag))
-  n_s_eff = np.sum(success_kcolls)**2 / np.sum(success_kcolls ** 2)
-  if n_s_eff > 1:
-    time_mean = np.sum(success_kcolls*success_t2s) / np.sum(success_kcolls)
-    time_std = np.sqrt(np.sum(success_kcolls * (success_t2s - time_mean)**2) / np.sum(success_kcolls))
-    time_err = time_std / np.sqrt(n_s_eff - 1)
-    return float(time_err / time_mean**2)
+  s = as_summary(ms_results)[success_tag]
+  if s.kk_sum > 0 and s.k_sum**2 / s.kk_sum > 1:
+    n_s_eff = s.k_sum**2 / s.kk_sum
+    time_mean = s.kt_mean
+    time_std = math.sqrt(s.kt_m2 / s.k_sum)
+    time_err = time_std / math.sqrt(n_s_eff - 1)
+    return float(time_err / np.float64(time_mean)**2)
   else:
     return float('inf')
 
 def uni_kfast(ms_results, unimolecular_k1_scale):
-  tags_set = set(ms_results['tags'])
+  ms_results = as_summary(ms_results)
+  tags_set = ms_results.tags()
   k2_all = [uni_k2_mean(t, ms_results) for t in tags_set]
   p_all = [bernoulli_mean(t, ms_results) for t in tags_set]
   kfast_all = [k2/p for k2,p in zip(k2_all, p_all) if not math.isnan(k2)]
@@ -0,0 +1,163 @@
+# startpool.py
+#
+# Implements a pool of Boltzmann-sampled start structures for the Multistrand
+# simulations of a resting set, shared by all Multistrand jobs in which the
+# resting set is a reactant.
+
+import numpy as np
+
+import multistrand.utils.thermo as nupack
+
+from .. import options
+from ..objects.structure import dotparen_pair_table
+from . import workerpool
+from .workerpool import WorkerPool
+
+
+# Multistrand dangles settings given as numbers
+_MS_DANGLES = {0: 'none', 1: 'some', 2: 'all'}
+
+def boltzmann_nupack_params(multistrand_params):
+  """
+  Returns the NUPACK parameters with which Multistrand samples the Boltzmann
+  distribution of its start complexes under the given Multistrand
+  parameters (temperatures above 273 are taken to be in Kelvin, as by
+  Multistrand).
+  """
+  params = dict(options.multistrand_params, **multistrand_params)
+  dangles = params['dangles']
+  temperature = params['temperature']
+  return {
+    'ensemble': _MS_DANGLES.get(dangles, str(dangles).lower()),
+    'material': params['substrate_type'].lower(),
+    'celsius': temperature - 273.15 if temperature > 273 else temperature,
+    'sodium': params['sodium'],
+    'magnesium': params['magnesium']
+  }
+
+def sample_start_structures(task):
+  """
+  Global function for drawing start structures, used for multiprocessing. The
+  task consists of the key of a registered job spec (see
+  StartStatePool.job_key) and the number of structures to draw from NUPACK
+  in one call, so that the partition function is computed once for all of
+  them. Returns the accepted structures (dot-paren strings) and the number of
+  structures drawn.
+  """
+  (job_key, num_samples) = task
+  job_spec = workerpool.get_job_spec(job_key)
+  strand_seqs = [strand.sequence for strand in job_spec['strands']]
+  structs = [s.dp() for s in
+             nupack.sample(strand_seqs, num_samples, **job_spec['nupack_params'])]
+  pair_tables = np.array([dotparen_pair_table(s) for s in structs])
+  accepted = job_spec['selector'].select(pair_tables)
+  return [s for s, ok in zip(structs, accepted) if ok], len(structs)
+
+
+class StartStatePool:
+  """
+  Boltzmann-sampled start structures of a resting set that satisfy its start
+  macrostate, for the Multistrand jobs of all reactions of the resting set.
+
+  Multistrand would sample the start complexes of every trajectory itself,
+  calling the selector for each sampled structure and recomputing the
+  partition function in every worker and for every job with this reactant.
+  Instead, structures are drawn from NUPACK in bulk, judged all at once by
+  the selector (see kinda.statistics.stats_utils.create_boltzmann_selector())
+  and kept in the pool until take() hands them to a job as explicit start
+  structures. Each structure is handed out only once, so the start states of
+  all trajectories remain independent samples.
+
+  Args:
+    restingset (dna.RestingSet): The resting set; structures are sampled for
+      the strands of its first complex, as is the Multistrand start complex
+      (see io_Multistrand.to_Multistrand_restingstates()).
+    selector: The start macrostate selector of the resting set.
+    nupack_params (dict, optional): NUPACK parameters matching those of the
+      Multistrand simulations (see boltzmann_nupack_params()).
+    bulk_size (int, optional): Minimum number of structures drawn at once.
+      Defaults to the multistrand_start_bulk_size parameter.
+    worker_pool (WorkerPool, optional): Worker processes used for
+      multiprocessing. A private pool is created if none is given.
+    multiprocessing (bool, optional): Sample on the worker processes.
+      Defaults to True.
+  """
+  def __init__(self, restingset, selector, nupack_params = {}, bulk_size = None,
+               worker_pool = None, multiprocessing = True):
+    self._restingset = restingset
+    self._strands = next(iter(restingset.complexes)).strands
+    self._selector = selector
+    self._nupack_params = dict(nupack_params)
+    if bulk_size is None:
+      bulk_size = options.kinda_params['multistrand_start_bulk_size']
+    self._bulk_size = bulk_size
+    self.multiprocessing = multiprocessing
+    self.worker_pool = worker_pool if worker_pool is not None else WorkerPool()
+    self._job_key = None
+
+    # Accepted structures that have not been handed out yet
+    self._structures = []
+    self.total_sampled = 0
+    self.total_accepted = 0
+
+  @property
+  def restingset(self):
+    return self._restingset
+
+  @property
+  def job_key(self):
+    """
+    The key under which the job spec (strands, selector and NUPACK
+    parameters) is registered with self.worker_pool. Registered on first
+    access.
+    """
+    if self._job_key is None:
+      self._job_key = workerpool.new_job_key('start')
+      self.worker_pool.register_job_spec(self._job_key, {
+        'strands': self._strands,
+        'selector': self._selector,
+        'nupack_params': self._nupack_params})
+    return self._job_key
+
+  @property
+  def acceptance_rate(self):
+    """ The fraction of the sampled structures accepted by the selector. """
+    if self.total_sampled == 0:
+      return None
+    return self.total_accepted / self.total_sampled
+
+  def __len__(self):
+    return len(self._structures)
+
+  def take(self, num):
+    """ Removes num start structures from the pool and returns them. """
+    if len(self._structures) < num:
+      self.top_up(num - len(self._structures))
+    taken = self._structures[:num]
+    del self._structures[:num]
+    return taken
+
+  def top_up(self, num):
+    """
+    Samples until at least num more structures have been accepted. The
+    number drawn is estimated from the acceptance rate so far, and split
+    across the worker processes in parts of at least the bulk size.
+    """
+    needed = len(self._structures) + num
+    while len(self._structures) < needed:
+      missing = needed - len(self._structures)
+      rate = self.acceptance_rate
+      num_samples = max(self._bulk_size,
+                        missing if not rate else int(missing / rate) + 1)
+      if self.multiprocessing:
+        # Each call to NUPACK draws at least bulk_size structures
+        tasks = max(1, min(self.worker_pool.processes,
+                           num_samples // self._bulk_size))
+        args = [(self.job_key, -(-num_samples // tasks))] * tasks
+        results = self.worker_pool.imap_unordered(sample_start_structures, args)
+      else:
+        results = [sample_start_structures((self.job_key, num_samples))]
+      for accepted, num_sampled in results:
+        self._structures.extend(accepted)
+        self.total_sampled += num_sampled
+        self.total_accepted += len(accepted)
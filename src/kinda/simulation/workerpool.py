@@ -0,0 +1,210 @@
+# workerpool.py
+#
+# Defines the WorkerPool class, a session-scoped pool of worker processes that
+# is shared by all Multistrand and NUPACK jobs instead of spawning a new pool
+# for every batch of simulations, and the registry through which workers look
+# up the specification of the job they are asked to work on.
+
+import os
+import atexit
+import shutil
+import signal
+import itertools as it
+import tempfile
+
+import dill
+import multiprocess
+
+
+# Job specs known to this process, keyed by job key. In the main process, specs
+# are added by WorkerPool.register_job_spec(); in worker processes, they are
+# loaded from the pool's spec directory on first use and then kept.
+_job_specs = {}
+# Directory with the pickled job specs of the pool this worker belongs to. Set
+# by the worker initializer; None in the main process.
+_spec_dir = None
+_job_key_counter = it.count()
+
+
+def new_job_key(prefix):
+  """ Returns a job key that is unique within this Python session. """
+  return '{}{}'.format(prefix, next(_job_key_counter))
+
+
+def get_job_spec(job_key):
+  """
+  Returns the spec registered under job_key. Worker processes read each spec
+  from disk only once, so that tasks need to carry nothing but the job key.
+  """
+  if job_key not in _job_specs:
+    with open(os.path.join(_spec_dir, job_key + '.pkl'), 'rb') as f:
+      _job_specs[job_key] = dill.load(f)
+  return _job_specs[job_key]
+
+
+def _init_worker(spec_dir):
+  """ Initializer of each worker process. """
+  global _spec_dir
+  _spec_dir = spec_dir
+
+
+class WorkerPool:
+  """
+  A pool of 'spawn' worker processes that is started once, on first use, and
+  then reused by every job and every batch submitted to it. Each worker thus
+  imports Multistrand/NUPACK only once per session rather than once per batch.
+
+  A System owns one WorkerPool and hands it to all of its stats objects, but a
+  pool may also be created explicitly and passed to individual jobs. The worker
+  processes are stopped by shutdown(), which is also registered to run at
+  interpreter exit. After shutdown() or terminate(), the pool is restarted
+  transparently the next time work is submitted.
+
+  Jobs register a small, immutable spec (e.g. the Multistrand options of a
+  MultistrandJob, without any collected data) once under a unique job key, see
+  register_job_spec(). Tasks then only carry the job key and a trajectory
+  count, and workers fetch the spec through get_job_spec().
+
+  Args:
+    processes (int, optional): Number of worker processes. Defaults to the
+      number of cpus, as given by `multiprocess.cpu_count()`.
+  """
+  def __init__(self, processes = None):
+    self._mp_ctx = multiprocess.get_context('spawn')
+    self._processes = processes
+    self._pool = None
+    self._spec_dir = None
+    self._registered_specs = {}
+    self._atexit_registered = False
+
+  @property
+  def processes(self):
+    """ The number of worker processes used by this pool. """
+    if self._processes is None:
+      return self._mp_ctx.cpu_count()
+    return self._processes
+
+  @property
+  def running(self):
+    """ True iff the worker processes have been started and not yet stopped. """
+    return self._pool is not None
+
+  def start(self):
+    """
+    Creates the worker processes, unless they are running already.
+
+    Due to a Python bug, SIGINT events (e.g. produced by Ctrl-C) do not cause
+    the worker processes to terminate gracefully, causing the result-handling
+    loop to hang indefinitely and forcing the main process to be halted
+    externally. This is resolved by removing the SIGINT handler before creating
+    the worker processes, so that all workers ignore SIGINT, allowing the main
+    process to handle SIGINT and terminate them without hanging (see
+    terminate()). The original SIGINT handler is restored immediately after
+    creating the worker processes (otherwise the main process would ignore
+    SIGINT as well). Note that this workaround produces a short time interval
+    in which all SIGINT signals are ignored.
+    """
+    if self._pool is not None:
+      return
+
+    # Make all registered job specs available to the new workers
+    self._spec_dir = tempfile.mkdtemp(prefix = 'kinda-jobs-')
+    for job_key, spec in self._registered_specs.items():
+      self._write_job_spec(job_key, spec)
+
+    # Temporarily remove the SIGINT event handler
+    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+      # Create Pool instance and worker processes
+      self._pool = self._mp_ctx.Pool(processes = self.processes,
+          initializer = _init_worker, initargs = (self._spec_dir,))
+    finally:
+      # Restore original SIGINT event handler
+      if sigint_handler is None:  sigint_handler = signal.SIG_DFL
+      signal.signal(signal.SIGINT, sigint_handler)
+
+    if not self._atexit_registered:
+      atexit.register(self.shutdown)
+      self._atexit_registered = True
+
+  def register_job_spec(self, job_key, spec):
+    """
+    Makes spec available to the main process and to all worker processes (now
+    and after any restart) under the given job key. Specs must not be modified
+    after registration.
+    """
+    self._registered_specs[job_key] = spec
+    _job_specs[job_key] = spec
+    if self._pool is not None:
+      self._write_job_spec(job_key, spec)
+
+  def _write_job_spec(self, job_key, spec):
+    # Write to a temporary file first, so that workers never see partial specs
+    path = os.path.join(self._spec_dir, job_key + '.pkl')
+    with open(path + '.tmp', 'wb') as f:
+      dill.dump(spec, f)
+    os.replace(path + '.tmp', path)
+
+  def imap_unordered(self, func, args):
+    """
+    Submits func(arg) for every arg in args, starting the worker processes if
+    necessary. Returns an iterator over the results in order of completion.
+    """
+    self.start()
+    return self._pool.imap_unordered(func, args)
+
+  def apply_async(self, func, args, callback = None, error_callback = None):
+    """
+    Submits a single call func(*args), starting the worker processes if
+    necessary. The callbacks are called from a helper thread of the main
+    process with the result or the exception, respectively.
+    """
+    self.start()
+    return self._pool.apply_async(func, args,
+        callback = callback, error_callback = error_callback)
+
+  def terminate(self):
+    """
+    Kills the worker processes immediately, discarding any outstanding work.
+    Used to handle SIGINT in the main process.
+    """
+    if self._pool is None:
+      return
+    self._pool.terminate()
+    self._pool.join()
+    self._pool = None
+    self._remove_spec_dir()
+
+  def shutdown(self):
+    """
+    Lets the worker processes finish their outstanding work and stops them.
+    """
+    if self._pool is None:
+      return
+    self._pool.close()
+    self._pool.join()
+    self._pool = None
+    self._remove_spec_dir()
+
+  def _remove_spec_dir(self):
+    if self._spec_dir is not None:
+      shutil.rmtree(self._spec_dir, ignore_errors = True)
+      self._spec_dir = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.shutdown()
+    else:
+      self.terminate()
+
+  def __getstate__(self):
+    # Worker processes cannot be transferred to another process; a copy of this
+    # object starts its own workers if it is ever used.
+    state = self.__dict__.copy()
+    state['_pool'] = None
+    state['_spec_dir'] = None
+    state['_atexit_registered'] = False
+    return state
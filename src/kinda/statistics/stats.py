@@ -15,6 +15,7 @@ from typing import List, Tuple
 
 from ..simulation.multistrandjob import FirstPassageTimeModeJob, FirstStepModeJob
 from ..simulation.nupackjob import NupackSampleJob
+from ..simulation.resultcache import nupack_cache_key
 
 
 class RestingSetRxnStats:
@@ -149,7 +150,7 @@ class RestingSetRxnStats:
       return self.get_multistrandjob().total_sims
     else:
       tag_id = self.get_multistrandjob().tag_id_dict[tag]
-      return (self.get_simulation_data()['tags'] == tag_id).sum()
+      return self.get_multistrandjob().get_simulation_summary().count(tag_id)
 
   def get_num_successful_sims(self):
     return self.get_num_sims(tag = self.get_multistrand_tag())
@@ -158,17 +159,25 @@ class RestingSetRxnStats:
     return self.get_num_sims() - self.get_num_successful_sims() - self.get_num_timeout_sims()
 
   def get_num_timeout_sims(self):
-    return self.get_num_sims() - self.get_simulation_data()['valid'].sum()
+    return self.get_num_sims() - self.get_multistrandjob().get_simulation_summary().n_valid
     
   def get_raw_stat(self, stat, relative_error, max_sims, verbose = 0, 
-      init_batch_size = 50, 
-      min_batch_size = 50, 
-      max_batch_size = 500, 
+      init_batch_size = None, 
+      min_batch_size = None, 
+      max_batch_size = None, 
       sims_per_update = 1, 
-      sims_per_worker = 1):
+      sims_per_worker = None,
+      streaming = False,
+      budget = None):
     """ General function to reduce the error on the given statistic
     to below the given threshold and return the value and standard
-    error of the statistic. """
+    error of the statistic. With streaming = True, the stopping rule
+    is checked as simulation results arrive rather than after each
+    batch (see MultistrandJob.reduce_error_to()). Batch sizes and
+    sims_per_worker that are not given are tuned automatically from
+    the measured simulation throughput. Simulation stops early once
+    the given time budget (a kinda.simulation.sim_utils.Budget) is
+    used up. """
     # Reduce error to threshold
     self.multijob.reduce_error_to(relative_error, max_sims, 
         reaction = self.multijob_tag, 
@@ -178,6 +187,8 @@ class RestingSetRxnStats:
         max_batch_size = max_batch_size,
         sims_per_update = sims_per_update,
         sims_per_worker = sims_per_worker,
+        streaming = streaming,
+        budget = budget,
         verbose = verbose)
 
     # Calculate and return statistic
@@ -212,7 +223,8 @@ class RestingSetStats:
         - spurious reactions (RestingSetRxnStats)
   """
 
-  def __init__(self, restingset, kinda_params = {}, nupack_params = {}):
+  def __init__(self, restingset, kinda_params = {}, nupack_params = {},
+               worker_pool = None):
     """ Initialize a RestingSetStats object from a DNAObjects.RestingSet
     object. The stats objects for reaction data should be added later
     with the add_XXX_rxn() functions. """
@@ -226,8 +238,11 @@ class RestingSetStats:
         restingset,
         similarity_threshold = kinda_params.get('nupack_similarity_threshold', None),
         multiprocessing = kinda_params.get('nupack_multiprocessing', True),
-        nupack_params = nupack_params
+        nupack_params = nupack_params,
+        worker_pool = worker_pool,
+        sample_bulk_size = kinda_params.get('nupack_sample_bulk_size')
     )
+    self.sampler.cache_key = nupack_cache_key(self.sampler, nupack_params)
     
     ## Set up MFE structures list
     self.mfe_structs = []
@@ -257,7 +272,9 @@ class RestingSetStats:
 
   def get_conformation_probs(self, relative_error = 0.50, max_sims = 100000, spurious = True, verbose = 0, **kwargs):
     """ Returns the probability and probability error for all
-    conformations in the resting set as a dictionary. """
+    conformations in the resting set as a dictionary. A time budget
+    given as budget = kinda.simulation.sim_utils.Budget(...) is shared
+    by the conformations. """
     names = [c.name for c in self.restingset.complexes]
     if spurious:
         names += [None]
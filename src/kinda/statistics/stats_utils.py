@@ -12,10 +12,15 @@
 import sys
 import itertools as it
 
+import numpy as np
+
 from .. import objects as dna
 from ..objects.utils import (
   restingset_count_by_complex_macrostate, restingset_count_by_domain_macrostate)
+from ..objects.structure import UNSPECIFIED
 from ..simulation.multistrandjob import FirstPassageTimeModeJob, FirstStepModeJob
+from ..simulation.resultcache import multistrand_cache_key
+from ..simulation.startpool import StartStatePool, boltzmann_nupack_params
 from .stats import RestingSetRxnStats, RestingSetStats
 
 
@@ -41,11 +46,13 @@ def listminuslist(minuend, subtrahend):
 ######################################
 
 def make_RestingSetRxnStats(restingsets, detailed_rxns, condensed_rxns,
-    kinda_params = {}, multistrand_params = {}):
+    kinda_params = {}, multistrand_params = {}, worker_pool = None):
   """
   A convenience function, creating a dict mapping reactions to stats objects
   such that all stats objects with the same reactants share a Multistrand job
-  object for improved efficiency.
+  object for improved efficiency. All Multistrand jobs run their simulations on
+  the given worker_pool, and the jobs with the same reactant take their start
+  structures from the same StartStatePool.
   """
   # print("KinDA: Constructing internal KinDA objects...\r")
   sys.stdout.flush()
@@ -61,6 +68,28 @@ def make_RestingSetRxnStats(restingsets, detailed_rxns, condensed_rxns,
   if kinda_params['enable_unimolecular_reactions']:
     all_reactants |= set([(r,) for r in restingsets])
 
+  # Make a pool of Boltzmann-sampled start structures for each resting set,
+  # shared by all Multistrand jobs with that reactant
+  start_macrostate_mode = kinda_params.get('start_macrostate_mode', 'ordered-complex')
+  similarity_threshold = kinda_params['multistrand_similarity_threshold']
+  multiprocessing = kinda_params.get('multistrand_multiprocessing', True)
+  nupack_params = boltzmann_nupack_params(multistrand_params)
+  start_pools = {
+    restingset: StartStatePool(
+        restingset,
+        create_boltzmann_selector(
+            restingset,
+            mode = start_macrostate_mode,
+            similarity_threshold = similarity_threshold
+        ),
+        nupack_params = nupack_params,
+        bulk_size = kinda_params.get('multistrand_start_bulk_size'),
+        worker_pool = worker_pool,
+        multiprocessing = multiprocessing
+    )
+    for restingset in restingsets
+  }
+
   # Make a Multistrand simulation job for each reactant group
   reactants_to_mjob = {}
   for i, reactants in enumerate(all_reactants):
@@ -90,37 +119,30 @@ def make_RestingSetRxnStats(restingsets, detailed_rxns, condensed_rxns,
       in zip(enum_prods + spurious_prods, tags, spurious_flags)
     ]
     
-    # Make Boltzmann sampling selector functions for each reactant
-    start_macrostate_mode = kinda_params.get('start_macrostate_mode', 'ordered-complex')
-    similarity_threshold = kinda_params['multistrand_similarity_threshold']
-    boltzmann_selectors = [
-        create_boltzmann_selector(
-            restingset, 
-            mode = start_macrostate_mode,
-            similarity_threshold = similarity_threshold
-        )
-        for restingset in reactants
-    ]
-
     # Make Multistrand job
-    multiprocessing = kinda_params.get('multistrand_multiprocessing', True)
+    reactant_pools = [start_pools[restingset] for restingset in reactants]
     if len(reactants) == 2:
       job = FirstStepModeJob(
           reactants,
           stop_conditions,
-          boltzmann_selectors = boltzmann_selectors,
+          start_pools = reactant_pools,
           multiprocessing = multiprocessing,
-          multistrand_params = multistrand_params
+          multistrand_params = multistrand_params,
+          worker_pool = worker_pool,
+          timeout_escalation = kinda_params.get('multistrand_timeout_escalation')
       )
     elif len(reactants) == 1:
       job = FirstPassageTimeModeJob(
           reactants,
           stop_conditions,
           unimolecular_k1_scale = kinda_params['unimolecular_k1_scale'],
-          boltzmann_selectors = boltzmann_selectors,
+          start_pools = reactant_pools,
           multiprocessing = multiprocessing,
-          multistrand_params = multistrand_params
+          multistrand_params = multistrand_params,
+          worker_pool = worker_pool,
+          timeout_escalation = kinda_params.get('multistrand_timeout_escalation')
       )
+    job.cache_key = multistrand_cache_key(job, reactants, stop_conditions, kinda_params)
     reactants_to_mjob[reactants] = job
 
     # print(f"KinDA: Constructing internal KinDA objects... "
@@ -332,12 +354,16 @@ def create_stop_macrostate(state, tag, spurious, options):
 
 
 ## Boltzmann sample-and-select functions must be picklable
-## to be used with the multiprocessing library
+## to be used with the multiprocessing library. Besides judging a single
+## structure, each selector judges a stack of pair tables at once (see
+## kinda.simulation.startpool.StartStatePool).
 class OrderedComplexSelector:
   def __init__(self, restingset):
     self._restingset = restingset # not actually used
   def __call__(self, struct):
     return True
+  def select(self, pair_tables):
+    return np.ones(len(pair_tables), dtype = bool)
 
 class CountByComplexSelector:
   def __init__(self, restingset, threshold):
@@ -349,6 +375,15 @@ class CountByComplexSelector:
         dna.utils.defect(complex, kinda_struct) < 1-self._threshold
         for complex in self._restingset.complexes
     )
+  def select(self, pair_tables):
+    pair_tables = np.atleast_2d(pair_tables)
+    selected = np.zeros(len(pair_tables), dtype = bool)
+    for complex in self._restingset.complexes:
+      defects = np.count_nonzero(
+        (complex.structure.pair_table != pair_tables)
+        & (pair_tables != UNSPECIFIED), axis = 1)
+      selected |= defects < 1-self._threshold
+    return selected
 
 class CountByDomainSelector:
   def __init__(self, restingset, threshold):
@@ -360,6 +395,13 @@ class CountByDomainSelector:
         dna.utils.max_domain_defect(complex, kinda_struct) < 1-self._threshold
         for complex in self._restingset.complexes
     )
+  def select(self, pair_tables):
+    pair_tables = np.atleast_2d(pair_tables)
+    selected = np.zeros(len(pair_tables), dtype = bool)
+    for complex in self._restingset.complexes:
+      selected |= (dna.utils.max_domain_defects_to(complex, pair_tables)
+                   < 1-self._threshold)
+    return selected
 
 
 def create_boltzmann_selector(restingset, mode, similarity_threshold = None):
@@ -387,34 +429,40 @@ def create_boltzmann_selector(restingset, mode, similarity_threshold = None):
     return CountByDomainSelector(restingset, similarity_threshold)
 
 
-def make_RestingSetStats(restingsets, kinda_params = {}, nupack_params = {}):
+def make_RestingSetStats(restingsets, kinda_params = {}, nupack_params = {},
+    worker_pool = None):
   """ A convenience function to make RestingSetStats objects for
   a list of given RestingSets. Returns a dict mapping the RestingSets
   to their corresponding stats objects. """
   rs_to_stats = {
       rs: RestingSetStats(rs, 
         kinda_params = kinda_params, 
-        nupack_params = nupack_params) for rs in restingsets}
+        nupack_params = nupack_params,
+        worker_pool = worker_pool) for rs in restingsets}
   return rs_to_stats
   
 
 def make_stats(complexes, restingsets, detailed_rxns, condensed_rxns,
-        kinda_params = {}, multistrand_params = {}, nupack_params = {}):
+        kinda_params = {}, multistrand_params = {}, nupack_params = {},
+        worker_pool = None):
   """
   Creates a RestingSetRxnStats object for each resting-set reaction
-  and a RestingSetStats object for each resting set.
+  and a RestingSetStats object for each resting set. All stats objects share
+  the given worker_pool for their Multistrand and NUPACK computations.
   """
 
   # Make RestingSetRxnStats objects for condensed reactions and predicted
   # spurious reactions.
   rxn_to_stats = make_RestingSetRxnStats(restingsets,
-          detailed_rxns, condensed_rxns, kinda_params, multistrand_params)
+          detailed_rxns, condensed_rxns, kinda_params, multistrand_params,
+          worker_pool)
 
   # Collect all resting sets, including spurious ones predicted by make_RestingSetRxnStats()
   # and make RestingSetStats for each.
   rs_rxns = list(rxn_to_stats.keys())
   restingsets = set(restingsets + [rs for rxn in rs_rxns for rs in rxn.reactants+rxn.products])
-  rs_to_stats = make_RestingSetStats(restingsets, kinda_params, nupack_params)
+  rs_to_stats = make_RestingSetStats(restingsets, kinda_params, nupack_params,
+                                     worker_pool)
   
   condensed_rxns_set = set(condensed_rxns)
 
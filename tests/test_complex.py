@@ -0,0 +1,32 @@
+# test_complex.py
+
+from kinda.objects import Domain, Strand, Complex
+
+
+def make_complex(rotation = 0):
+  a = Domain(name = 'a', sequence = 'ACGTA')
+  b = Domain(name = 'b', sequence = 'GGCAT')
+  strands = [Strand(name = 'OB', domains = [a, b]),
+             Strand(name = 'C', domains = [b.complement, a.complement]),
+             Strand(name = 'LB', domains = [a])]
+  cpx = Complex(name = 'cpx', strands = strands,
+                structure = '((((((((((+))))))))))+.....')
+  cpx.rotate_strands(rotation)
+  return cpx
+
+def canonical_names(cpx):
+  strands, structure = cpx.canonical_form
+  return [s.name for s in strands], structure.to_dotparen()
+
+
+def test_canonical_form_after_rotation():
+  for amount in range(1, 3):
+    for cached_form in (False, True):
+      cpx = make_complex()
+      hash(cpx)
+      if cached_form:
+        cpx.canonical_form
+      cpx.rotate_strands(amount)
+      fresh = make_complex(amount)
+      assert canonical_names(cpx) == canonical_names(fresh)
+      assert cpx == fresh and hash(cpx) == hash(fresh)
@@ -0,0 +1,91 @@
+# test_io_KinDA.py
+
+import numpy as np
+import pytest
+
+from kinda.objects import io_KinDA, io_SQLite
+from kinda.simulation.multistrandjob import MS_TIMEOUT
+
+from test_resultcache import make_system, bimolecular_job
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+@pytest.mark.parametrize('db_format', ['json', 'pickle', 'npy', 'npz', 'sqlite'])
+def test_export_import_round_trip(tmp_path, db_format, lazy):
+  path = str(tmp_path / 'data.{}'.format(db_format))
+  system = make_system()
+  job, tag = bimolecular_job(system)
+  job.set_simulation_data({
+    'tags': [tag, tag, -1], 'times': [0.5, 1.5, 2.0], 'valid': [1, 1, 0],
+    'kcoll': [1e6, 2e6, 3e6]})
+  job.set_invalid_simulation_data([{'type': 'timeout', 'seed': 5,
+    'simulation_index': 2, 'simulation_time': 2.0}])
+  io_KinDA.export_data(system, path, use_pickle = (db_format == 'pickle'),
+                       db_format = db_format)
+
+  restored = io_KinDA.import_data(path, use_pickle = (db_format == 'pickle'),
+                                  lazy = lazy)
+  restored_job, restored_tag = bimolecular_job(restored)
+  assert restored_job.total_sims == 3
+  rxn_tag = next(t for t, i in job.tag_id_dict.items() if i == tag)
+  for stat in ['prob', 'kcoll']:
+    assert (restored_job.get_statistic(rxn_tag, stat)
+            == pytest.approx(job.get_statistic(rxn_tag, stat)))
+  data = restored_job.get_simulation_data()
+  assert list(data['tags']) == [restored_tag, restored_tag, -1]
+  assert np.allclose(data['times'], [0.5, 1.5, 2.0])
+  assert np.allclose(data['kcoll'], [1e6, 2e6, 3e6])
+  assert [info['seed'] for info in restored_job.get_invalid_simulation_data()] == [5]
+
+  # The restored data can be exported again
+  io_KinDA.export_data(restored, str(tmp_path / 'again.{}'.format(db_format)),
+                       use_pickle = (db_format == 'pickle'), db_format = db_format)
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_sqlite_resume(tmp_path, lazy):
+  path = str(tmp_path / 'data.sqlite')
+  system = make_system()
+  job, tag = bimolecular_job(system)
+  job.set_simulation_data({'tags': [tag], 'times': [0.5], 'valid': [1],
+                           'kcoll': [1e6]})
+  io_KinDA.export_data(system, path, db_format = 'sqlite')
+
+  restored = io_KinDA.import_data(path, lazy = lazy)
+  writer = io_SQLite.SQLiteWriter(restored, path, resume = True)
+  restored_job, restored_tag = bimolecular_job(restored)
+  restored_job.add_simulation_data({'tags': [restored_tag], 'times': [1.5],
+                                    'valid': [1], 'kcoll': [2e6]})
+  writer.close()
+
+  data = bimolecular_job(io_KinDA.import_data(path))[0].get_simulation_data()
+  assert np.allclose(data['times'], [0.5, 1.5])
+
+def test_sqlite_concurrent_reruns(tmp_path):
+  # Two writers re-run different timed-out trajectories of the same batch
+  path = str(tmp_path / 'data.sqlite')
+  system = make_system()
+  job, tag = bimolecular_job(system)
+  timeout = job.tag_id_dict[MS_TIMEOUT]
+  job.set_simulation_data({'tags': [timeout, timeout], 'times': [2.0, 2.0],
+                           'valid': [0, 0], 'kcoll': [1e6, 2e6]})
+  job.set_invalid_simulation_data([
+    {'type': 'timeout', 'seed': seed, 'simulation_index': i, 'simulation_time': 2.0}
+    for i, seed in enumerate([5, 6])])
+  io_KinDA.export_data(system, path, db_format = 'sqlite')
+
+  restored = [io_KinDA.import_data(path) for _ in range(2)]
+  writers = [io_SQLite.SQLiteWriter(r, path, resume = True) for r in restored]
+  for index, r in enumerate(restored):
+    rerun_job, rerun_tag = bimolecular_job(r)
+    rerun_job.process_rerun({
+      'rerun': {'simulation_index': index, 'simulation_time': 20.0},
+      'tags': [rerun_tag], 'times': [10.0 + index], 'valid': [1],
+      'kcoll': [1e6 * (index + 1)]})
+  for writer in writers:
+    writer.close()
+
+  final_job, final_tag = bimolecular_job(io_KinDA.import_data(path))
+  data = final_job.get_simulation_data()
+  assert list(data['tags']) == [final_tag, final_tag]
+  assert np.allclose(data['times'], [10.0, 11.0])
+  assert final_job.get_invalid_simulation_data() == []
@@ -0,0 +1,41 @@
+# test_multistrandjob.py
+
+from kinda import options
+from kinda.objects import Domain, Strand, Complex, RestingSet, Macrostate
+from kinda.simulation import sim_utils
+from kinda.simulation.multistrandjob import FirstPassageTimeModeJob
+
+
+def make_job(**kargs):
+  d = Domain(name = 'a', sequence = 'ACGTACGT')
+  s = Strand(name = 's', domains = [d])
+  c = Complex(name = 'c', strands = [s], structure = '........')
+  stop = Macrostate(name = 'stop', type = 'exact', complex = c)
+  return FirstPassageTimeModeJob([RestingSet(complexes = [c])], [stop],
+      multiprocessing = False, multistrand_params = options.multistrand_params,
+      **kargs)
+
+def set_lazy_timeouts(job, loads):
+  # Two trajectories, of which the first timed out
+  def loader():
+    loads.append(True)
+    return {'valid': [0, 1], 'tags': [-1, 0], 'times': [1.0, 0.5]}
+  job.set_lazy_simulation_data(loader, 2, sim_utils.ResultsSummary())
+  job.set_invalid_simulation_data([{'type': 'timeout', 'seed': 5,
+    'simulation_index': 0, 'simulation_time': 1.0}])
+
+
+def test_lazy_restore_with_timeouts_stays_unloaded():
+  loads = []
+  job = make_job()
+  set_lazy_timeouts(job, loads)
+  assert not loads and job.pending_reruns == 0
+
+  loads = []
+  job = make_job(timeout_escalation = [10.0])
+  set_lazy_timeouts(job, loads)
+  assert not loads and job.pending_reruns == 1
+
+  # The stored tag is checked once the re-run is due
+  tasks = job.rerun_tasks()
+  assert loads and len(tasks) == 1 and tasks[0][2]['seed'] == 5
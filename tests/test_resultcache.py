@@ -0,0 +1,55 @@
+# test_resultcache.py
+
+import numpy as np
+
+from kinda import System
+from kinda.objects import (
+  Domain, Strand, Complex, RestingSet, Reaction, RestingSetReaction)
+from kinda.simulation.resultcache import ResultCache
+
+
+def make_system():
+  """ A system with the bimolecular reaction X + Y -> XY. """
+  t = Domain(name = 't', sequence = 'GCTAC')
+  a = Domain(name = 'a', sequence = 'ACGTACGTAC')
+  x = Strand(name = 'x', domains = [t, a])
+  y = Strand(name = 'y', domains = [a.complement, t.complement])
+  cx = Complex(name = 'X', strands = [x], structure = '..')
+  cy = Complex(name = 'Y', strands = [y], structure = '..')
+  cxy = Complex(name = 'XY', strands = [x, y], structure = '((+))')
+  rx, ry, rxy = [RestingSet(name = c.name, complexes = [c]) for c in (cx, cy, cxy)]
+  return System(complexes = [cx, cy, cxy],
+                restingsets = [rx, ry, rxy],
+                detailed_reactions = [Reaction(reactants = [cx, cy], products = [cxy])],
+                condensed_reactions = [RestingSetReaction(reactants = [rx, ry],
+                                                          products = [rxy])],
+                enumeration = False)
+
+def bimolecular_job(system):
+  rxn = next(rxn for rxn in system.get_reactions(arity = 2) if len(rxn.products) == 1)
+  job = system.get_stats(rxn).get_multistrandjob()
+  return job, job.tag_id_dict[str(rxn)]
+
+
+def test_cache_round_trip(tmp_path):
+  path = str(tmp_path / 'cache.sqlite')
+  system = make_system()
+  job, tag = bimolecular_job(system)
+  assert job.cache_key is not None
+  cache = ResultCache(path)
+  assert cache.attach(system) == 0
+  job.add_simulation_data({
+    'tags': [tag, tag, -1], 'times': [0.5, 1.5, 2.0], 'valid': [1, 1, 0],
+    'kcoll': [1e6, 2e6, 3e6]})
+  cache.sync()
+  cache.close()
+
+  restored = make_system()
+  restored_job, restored_tag = bimolecular_job(restored)
+  cache = ResultCache(path)
+  assert cache.attach(restored) >= 1
+  cache.close()
+  data = restored_job.get_simulation_data()
+  assert list(data['tags']) == [restored_tag, restored_tag, -1]
+  assert np.allclose(data['times'], [0.5, 1.5, 2.0])
+  assert np.allclose(data['kcoll'], [1e6, 2e6, 3e6])
@@ -0,0 +1,26 @@
+# test_structure.py
+
+import pytest
+
+from kinda.objects import Domain, Strand, Structure
+from kinda.objects.structure import dotparen_pair_table, UNBOUND
+
+
+def make_strands():
+  a = Domain(name = 'a', sequence = 'ACGT')
+  return [Strand(name = 's1', domains = [a]), Strand(name = 's2', domains = [a.complement])]
+
+
+def test_dotparen_pair_table():
+  assert list(dotparen_pair_table('((..+..))')) == [7, 6, UNBOUND, UNBOUND,
+                                                     UNBOUND, UNBOUND, 1, 0]
+  for structure in ['((..+...)', '(...+.)))', ')...+...(']:
+    with pytest.raises(ValueError):
+      dotparen_pair_table(structure)
+
+def test_unbalanced_structure():
+  strands = make_strands()
+  assert Structure(strands = strands, structure = '((((+))))').bound_to(0, 0) == (1, 3)
+  for structure in ['((((+...)', '....+)...', '((((+((((', '(+.']:
+    with pytest.raises(ValueError):
+      Structure(strands = strands, structure = structure)